@@ -1,43 +1,160 @@
 #!/usr/bin/python
 """Build vendored packages."""
 
+import argparse
 import os
+import subprocess
+import sys
+import time
 
+from vendir import config
+from vendir import dedup
+from vendir import jobs
+from vendir import log
+from vendir import manifest
+from vendir import package
 from vendir import root
+from vendir import runner
+from vendir import scheduler
+from vendir import trace
+from vendir import usage
 
 CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+CONFIG = config.ConfigSectionMap()
+
+
+def _setup(name, component_dir, args):
+    """Run a component's setup.py from its own directory."""
+    cwd = os.path.join(CURRENT_DIR, component_dir)
+    cmd = runner.tool_cmd(['/usr/bin/python', 'setup.py'] + args)
+    # Name the component's trace after the task, like python2 or python3
+    env = dict(os.environ)
+    env[trace.COMPONENT_ENV] = name
+    with trace.span(name):
+        return subprocess.call(cmd, cwd=cwd, env=env)
 
 
 def build_openssl(*args):
     """Build the openssl project."""
-    openssl_dir = os.path.join(CURRENT_DIR, 'openssl')
-    os.chdir(openssl_dir)
-    cmd = ['/usr/bin/python', 'setup.py', '-vv', '-p', '-b', '-i']
-    os.system(' '.join(cmd))
+    return _setup('openssl', 'openssl', ['-vv', '-p', '-b', '-i'])
 
 
 def build_python(version):
     """Build the python project."""
-    openssl_dir = os.path.join(CURRENT_DIR, 'python')
-    os.chdir(openssl_dir)
-    cmd = ['/usr/bin/python', 'setup.py', '-vv', '-p', '-b', '--py', version]
-    os.system(' '.join(cmd))
+    return _setup('python' + version, 'python',
+                  ['-vv', '-p', '-b', '--py', version])
 
 
 def build_tlsssl():
     """Build the tlsssl project."""
-    tslssl_dir = os.path.join(CURRENT_DIR, 'tlsssl')
-    os.chdir(tslssl_dir)
-    cmd = ['/usr/bin/python', 'setup.py', '-vv', '-p', '-b']
-    os.system(' '.join(cmd))
+    return _setup('tlsssl', 'tlsssl', ['-vv', '-p', '-b'])
+
+
+# Every component and the components it needs to be installed first.
+# Python and tlsssl link against the OpenSSL that build_openssl installs.
+COMPONENTS = {
+    'openssl': (build_openssl, []),
+    'python2': (lambda: build_python('2'), ['openssl']),
+    'python3': (lambda: build_python('3'), ['openssl']),
+    'tlsssl': (build_tlsssl, ['openssl']),
+}
+
+
+# The package each component writes, in the order they are combined
+PACKAGES = [
+    ('openssl', os.path.join('openssl', 'openssl-{}.pkg'.format(
+        CONFIG['openssl_version']))),
+    ('python2', os.path.join('python', 'python-{}.pkg'.format(
+        CONFIG['python2_version']))),
+    ('python3', os.path.join('python', 'python-{}.pkg'.format(
+        CONFIG['python3_version']))),
+    ('tlsssl', os.path.join('tlsssl', 'tlsssl-{}.pkg'.format(
+        CONFIG['tlsssl_version']))),
+]
+# The combined package of every component
+COMBINED_PKG = os.path.join(CURRENT_DIR, 'build', 'vendored.pkg')
+
+
+def combine():
+    """Report the files the packages share and combine them for tar."""
+    manifests = [manifest.path_for(package.output_path(
+                 os.path.join(CURRENT_DIR, output)))
+                 for _, output in PACKAGES]
+    try:
+        return dedup.run(manifests, COMBINED_PKG)
+    except (IOError, OSError) as err:
+        log.error("Unable to combine the packages: {}".format(err))
+        return 1
+
+
+def start_trace():
+    """
+    Send the traces of this run to their own directory under report_dir.
+
+    Returns:
+      The run directory or None when tracing is disabled
+
+    """
+    if not trace.enabled():
+        return None
+    run_dir = os.path.join(trace.report_dir(),
+                           time.strftime('build-%Y%m%d-%H%M%S'))
+    os.environ[trace.REPORT_DIR_ENV] = run_dir
+    trace.component = 'build'
+    return run_dir
+
+
+def report_trace(run_dir):
+    """Merge the component traces and log where the time and CPU went."""
+    if run_dir is None:
+        return
+    output = os.path.join(run_dir, 'trace.json')
+    try:
+        events = trace.merge(run_dir, output)
+        resources = usage.merge(run_dir, os.path.join(run_dir, 'usage.json'))
+    except (IOError, OSError) as err:
+        log.warn("Unable to merge the build traces: {}".format(err))
+        return
+    trace.report(events)
+    durations = dict((name, seconds) for component, name, _, seconds
+                     in trace.summary(events)
+                     if component == trace.component and name in COMPONENTS)
+    path, total = scheduler.critical_path(COMPONENTS, durations)
+    log.info("Critical path: {} ({:.1f}s)".format(' -> '.join(path), total))
+    usage.report(resources)
+    log.info("Build trace written to '{}'. Open it in "
+             "https://ui.perfetto.dev or chrome://tracing".format(output))
 
 
 def main():
     """Build our required packages."""
+    parser = argparse.ArgumentParser(prog='vendored build',
+                                     description='Build and package every '
+                                     'vendored component in dependency '
+                                     'order.')
+    parser.add_argument('-j', '--jobs', type=int,
+                        default=int(CONFIG['build_jobs'] or 1),
+                        help='Number of components to build at the same '
+                        'time. Defaults to build_jobs from config.ini.')
+    parser.add_argument('-v', '--verbose', action='count', default=1,
+                        help="Increase verbosity level. Repeatable up to "
+                        "2 times (-vv)")
+    args = parser.parse_args()
+    log.verbose = args.verbose
+
     root.root_check()
-    build_openssl()
-    build_python('2')
-    build_python('3')
+    run_dir = start_trace()
+    # Components built at the same time share one pool of make jobs
+    with jobs.jobserver(jobs.make_jobs()):
+        results = scheduler.run(COMPONENTS, jobs=args.jobs)
+    failed = any(result != scheduler.SUCCESS for result in results.values())
+    if not failed:
+        failed = combine() != 0
+    for name in scheduler.order(COMPONENTS):
+        log.info("{:<10} {}".format(name, results[name]))
+    report_trace(run_dir)
+    if failed:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
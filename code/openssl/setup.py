@@ -10,10 +10,8 @@ NOTE: OpenSSL 1.1 is not supported at this time due to large API changes.
 from distutils.dir_util import mkpath
 import os
 import shutil
-import subprocess
 import sys
 import inspect
-import tempfile
 import argparse
 
 # our libs. kind of hacky since this isn't a valid python package.
@@ -22,12 +20,20 @@ CURRENT_DIR = os.path.dirname(
 PARENT_DIR = os.path.dirname(CURRENT_DIR)
 sys.path.insert(0, PARENT_DIR)
 
+from vendir import artifacts  # noqa
+from vendir import ccache  # noqa
+from vendir import certs  # noqa
 from vendir import config  # noqa
-from vendir import hash_helper  # noqa
+from vendir import extract  # noqa
+from vendir import fetch  # noqa
+from vendir import fingerprint  # noqa
+from vendir import jobs  # noqa
 from vendir import log  # noqa
 from vendir import package  # noqa
 from vendir import runner  # noqa
 from vendir import root  # noqa
+from vendir import slim  # noqa
+from vendir import trace  # noqa
 
 
 CONFIG = config.ConfigSectionMap()
@@ -35,74 +41,76 @@ OPENSSL_BUILD_DIR = os.path.abspath(CONFIG['openssl_build_dir'])
 BASE_INSTALL_PATH = CONFIG['base_install_path']
 BASE_INSTALL_PATH_S = CONFIG['base_install_path'].lstrip('/')
 PKG_PAYLOAD_DIR = os.path.join(OPENSSL_BUILD_DIR, 'payload')
+# PKG_PAYLOAD_DIR with the payload_profile applied, which is packaged
+SLIM_PAYLOAD_DIR = os.path.join(OPENSSL_BUILD_DIR, 'slim-payload')
 OPENSSL_VERSION = CONFIG['openssl_version']
 
 
 def download_and_extract_openssl():
     """Download openssl distribution and extract it to OPENSSL_BUILD_DIR."""
-    if os.path.isdir(OPENSSL_BUILD_DIR):
-        shutil.rmtree(OPENSSL_BUILD_DIR, ignore_errors=True)
-    mkpath(OPENSSL_BUILD_DIR)
-    # Download openssl
-    log.info("Downloading OpenSSL from: {}".format(CONFIG['openssl_dist']))
-    temp_filename = os.path.join(tempfile.mkdtemp(), 'tempdata')
-    cmd = ['/usr/bin/curl', '--show-error', '--no-buffer',
-           '--fail', '--progress-bar',
-           '--speed-time', '30',
-           '--location',
-           '--url', CONFIG['openssl_dist'],
-           '--output', temp_filename]
-    # We are calling os.system so we can get download progress live
-    rc = runner.system(cmd)
-    if rc == 0 or rc is True:
-        log.debug("OpenSSL download successfully")
-    else:
-        log.error("OpenSSL download failed with exit code: '{}'".format(rc))
+    # Download, verify and extract in a single pass. The extracted tree only
+    # replaces OPENSSL_BUILD_DIR when the hash matches.
+    log.info("Downloading and extracting OpenSSL from: {}".format(
+             CONFIG['openssl_dist']))
+    try:
+        fetch.fetch_and_extract(CONFIG['openssl_dist'],
+                                CONFIG['openssl_dist_hash'],
+                                OPENSSL_BUILD_DIR,
+                                exclude=extract.excludes('openssl'))
+    except fetch.FetchError as err:
+        log.error("OpenSSL download has failed: {}".format(err))
         sys.exit(1)
+    log.debug("Extraction completed successfully")
 
-    # Verify openssl download hash
-    download_hash = hash_helper.getsha256hash(temp_filename)
-    config_hash = CONFIG['openssl_dist_hash']
-    if download_hash != config_hash:
-        log.error("Hash verification of OpenSSL download has failed. Download "
-                  "hash of '{}' does not match config hash '{}'".format(
-                    download_hash, config_hash))
-        sys.exit(1)
-    else:
-        log.detail("Hash verification of OpenSSL successfully")
-
-    # Extract openssl to the openssl_build_dir
-    log.info("Extracting OpenSSL...")
-    cmd = ['/usr/bin/tar', '-xf', temp_filename, '-C', OPENSSL_BUILD_DIR,
-           '--strip-components', '1']
-    out = runner.Popen(cmd)
-    if out[2] == 0:
-        log.debug("Extraction completed successfullyly")
-    else:
-        log.error("Extraction has failed: {}".format(out[1]))
-    os.remove(temp_filename)
+
+def configure_cmd():
+    """Return the OpenSSL Configure command."""
+    openssl_install = os.path.join(BASE_INSTALL_PATH, 'openssl')
+    return ['./Configure',
+            '--prefix={}'.format(openssl_install),
+            '--openssldir={}'.format(openssl_install),
+            'darwin64-x86_64-cc',
+            'enable-ec_nistp_64_gcc_128',
+            'no-ssl2',
+            'no-ssl3',
+            'no-zlib',
+            'shared',
+            'enable-cms',
+            'no-comp',
+            ]
+
+
+def artifact_inputs():
+    """Return every input that changes the OpenSSL payload."""
+    return [CONFIG['openssl_dist'], CONFIG['openssl_dist_hash'],
+            extract.excludes('openssl'), OPENSSL_VERSION, BASE_INSTALL_PATH,
+            configure_cmd()]
+
+
+def build_phases(force=False):
+    """
+    Return the fingerprinted build phases for OpenSSL.
+
+    A phase only re-runs when its inputs, or the inputs of an earlier phase,
+    have changed since the last successful build.
+    """
+    phases = fingerprint.Phases(OPENSSL_BUILD_DIR + '.fingerprint.json',
+                                force=force)
+    phases.add('extract',
+               [CONFIG['openssl_dist'], CONFIG['openssl_dist_hash'],
+                extract.excludes('openssl')],
+               outputs=[os.path.join(OPENSSL_BUILD_DIR, 'Configure')])
+    phases.add('configure', [OPENSSL_VERSION, configure_cmd()],
+               outputs=[os.path.join(OPENSSL_BUILD_DIR, 'Makefile')])
+    phases.add('make')
+    phases.add('install', [PKG_PAYLOAD_DIR], outputs=[PKG_PAYLOAD_DIR])
+    return phases
 
 
-def build():
+def build(phases):
     """Build OpenSSL from source."""
     # Step 1: change into our build directory
     os.chdir(OPENSSL_BUILD_DIR)
-    # Don't compile openssl if the skip option is passed
-    # Step 2: Run the Configure setup of OpenSSL to set correct paths
-    openssl_install = os.path.join(BASE_INSTALL_PATH, 'openssl')
-    log.info("Configuring OpenSSL...")
-    cmd = ['./Configure',
-           '--prefix={}'.format(openssl_install),
-           '--openssldir={}'.format(openssl_install),
-           'darwin64-x86_64-cc',
-           'enable-ec_nistp_64_gcc_128',
-           'no-ssl2',
-           'no-ssl3',
-           'no-zlib',
-           'shared',
-           'enable-cms',
-           'no-comp',
-           ]
     # OpenSSL 1.0 to 1.1 has some pretty major API and build differences.
     # Manage the build control with the following. NOTE: 1.1 is not
     # supported at this time. Hopefully in a future release.
@@ -116,29 +124,48 @@ def build():
     else:
         OLD_VERSION = True
         TMP_DIR_FLAG = "INSTALL_PREFIX"
-    # If running 1.0 use runner.system() else runner.Popen()
-    if OLD_VERSION:
-        out = runner.system(cmd)
-    else:
-        out = runner.Popen(cmd)
-    log.debug("Configuring returned value: {}".format(out))
+
+    # Step 2: Run the Configure setup of OpenSSL to set correct paths
+    if phases.needed('configure'):
+        phases.start('configure')
+        log.info("Configuring OpenSSL...")
+        cmd = configure_cmd()
+        # If running 1.0 use runner.system() else runner.Popen()
+        with trace.span('configure'):
+            if OLD_VERSION:
+                rc = runner.system(cmd)
+            else:
+                rc = runner.Popen(cmd)[2]
+        log.debug("Configuring returned value: {}".format(rc))
+        if rc != 0:
+            log.error("OpenSSL configure failed")
+            sys.exit(1)
+        phases.done('configure')
 
     # Step 3: compile openssl. this will take a while.
-    # FIXME: We need to check return codes.
-    #        This command is required for OpenSSL lower than 1.1
-    log.info("Compiling OpenSSL. This will take a while time...")
-    if OLD_VERSION:
-        log.detail("Running OpenSSL make depend routine...")
-        cmd = ['/usr/bin/make', 'depend']
-        proc = subprocess.Popen(cmd, bufsize=-1, stdout=sys.stdout)
-        (output, dummy_error) = proc.communicate()
-        sys.stdout.flush()  # does this help?
-
-    log.detail("Running OpenSSL make routine...")
-    cmd = ['/usr/bin/make']
-    proc = subprocess.Popen(cmd, bufsize=-1, stdout=sys.stdout)
-    (output, dummy_error) = proc.communicate()
-    sys.stdout.flush()  # does this help?
+    if phases.needed('make'):
+        phases.start('make')
+        log.info("Compiling OpenSSL. This will take a while time...")
+        # This command is required for OpenSSL lower than 1.1
+        if OLD_VERSION:
+            log.detail("Running OpenSSL make depend routine...")
+            cmd = jobs.make_cmd('depend', parallel=False)
+            with trace.span('make depend'):
+                out = runner.stream(cmd,
+                                    log_file=runner.step_log('make depend'))
+            if out[2] != 0:
+                log.error("OpenSSL make depend failed: {}".format(out[1]))
+                sys.exit(1)
+
+        log.detail("Running OpenSSL make routine...")
+        # OpenSSL 1.0.x makefiles are not safe to run in parallel
+        cmd = jobs.make_cmd(parallel=not OLD_VERSION)
+        with trace.span('make'):
+            out = runner.stream(cmd, log_file=runner.step_log('make'))
+        if out[2] != 0:
+            log.error("OpenSSL make failed: {}".format(out[1]))
+            sys.exit(1)
+        phases.done('make')
 
     # log.detail("Running OpenSSL make test routine...")
     # cmd = ['/usr/bin/make', 'test']
@@ -146,14 +173,29 @@ def build():
     # (output, dummy_error) = proc.communicate()
     # sys.stdout.flush()  # does this help?
 
-    mkpath(PKG_PAYLOAD_DIR)
-    log.detail("Running OpenSSL make install routine...")
-    cmd = ['/usr/bin/make',
-           '{}={}'.format(TMP_DIR_FLAG, PKG_PAYLOAD_DIR),
-           'install']
-    print("ran a command: {}".format(' '.join(cmd)))
-    out = runner.Popen(cmd, stdout=sys.stdout)
-    sys.stdout.flush()  # does this help?
+    if phases.needed('install'):
+        phases.start('install')
+        # Start from an empty payload so removed files do not linger
+        if os.path.isdir(PKG_PAYLOAD_DIR):
+            shutil.rmtree(PKG_PAYLOAD_DIR, ignore_errors=True)
+        mkpath(PKG_PAYLOAD_DIR)
+        log.detail("Running OpenSSL make install routine...")
+        cmd = jobs.make_cmd('{}={}'.format(TMP_DIR_FLAG, PKG_PAYLOAD_DIR),
+                            'install', parallel=False)
+        print("ran a command: {}".format(' '.join(cmd)))
+        with trace.span('make install'):
+            out = runner.stream(cmd, log_file=runner.step_log('make install'))
+        if out[2] != 0:
+            log.error("OpenSSL make install failed: {}".format(out[1]))
+            sys.exit(1)
+        phases.done('install')
+
+
+def host_files():
+    """Return the payload paths current_certs() writes for this host."""
+    openssl_dir = os.path.join(BASE_INSTALL_PATH_S, 'openssl')
+    return [os.path.join(openssl_dir, 'cert.pem'),
+            os.path.join(openssl_dir, 'certs')]
 
 
 def current_certs():
@@ -162,22 +204,32 @@ def current_certs():
 
     This helps work around a limitation with bundling your own version of
     OpenSSL. We copy the certs from Apple's 'SystemRootCertificates.keychain'
-    into OPENSSL_BUILD_DIR/cert.pem
+    (or the cert_source from config.ini) into OPENSSL_BUILD_DIR/cert.pem
+    and into a hashed 'certs' directory that OpenSSL reads on demand.
     https://goo.gl/s6vvwl
     """
     log.info("Writing the 'cert.pem' file from Apple's System Root Certs...")
-    cmd = ['/usr/bin/security', 'find-certificate', '-a', '-p',
-           '/System/Library/Keychains/SystemRootCertificates.keychain']
-    out = runner.Popen(cmd)
-    # Take the command output, out[0], and write the file to cert.pem
-    cert_path = os.path.join(PKG_PAYLOAD_DIR, BASE_INSTALL_PATH_S,
-                             'openssl', 'cert.pem')
+    openssl_dir = os.path.join(PKG_PAYLOAD_DIR, BASE_INSTALL_PATH_S,
+                               'openssl')
+    try:
+        with trace.span('certs'):
+            pem = certs.bundle()
+    except (IOError, OSError) as e:
+        log.error("Unable to read the root certificates: {}".format(e))
+        return
+    # Write the bundle to cert.pem
+    cert_path = os.path.join(openssl_dir, 'cert.pem')
     try:
         f = open(cert_path, "w")
-        f.write(out[0])
+        f.write(pem)
         f.close()
     except(IOError) as e:
         log.error("Unable to write 'cert.pem': {}".format(e))
+    try:
+        certs.write_hashed_dir(pem, os.path.join(openssl_dir, 'certs'))
+    except (IOError, OSError) as e:
+        log.error("Unable to write the hashed 'certs' directory: "
+                  "{}".format(e))
 
 
 def main():
@@ -191,8 +243,14 @@ def main():
     parser.add_argument('-s', '--skip', action='store_true',
                         help='Skip recompiling if possible. Only recommended '
                              'for development purposes.')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='Rebuild every phase even when its inputs have '
+                             'not changed.')
     parser.add_argument('-p', '--pkg', action='store_true',
                         help='Package the OpenSSL output directory.')
+    parser.add_argument('--verify', action='store_true',
+                        help='Build the package twice and check both are '
+                             'byte for byte identical.')
     parser.add_argument('-i', '--install', action='store_true',
                         help='Install the OpenSSL package.')
     parser.add_argument('-v', '--verbose', action='count', default=1,
@@ -218,8 +276,23 @@ def main():
             log.debug("Skip flag was provided. We will not compile OpenSSL "
                       "on this run.")
         else:
-            download_and_extract_openssl()
-            build()
+            inputs = artifact_inputs()
+            artifact_key = artifacts.key('openssl', inputs)
+            # --force always compiles, even when a prebuilt payload exists
+            if args.force or not artifacts.pull('openssl', artifact_key,
+                                                PKG_PAYLOAD_DIR):
+                phases = build_phases(force=args.force)
+                if phases.needed('extract'):
+                    phases.start('extract')
+                    download_and_extract_openssl()
+                    phases.done('extract')
+                cache_stats = ccache.activate(OPENSSL_BUILD_DIR)
+                build(phases)
+                ccache.report(cache_stats)
+                # The certs come from this host so never publish them. A
+                # skipped install phase still has those of the last run.
+                artifacts.publish('openssl', artifact_key, PKG_PAYLOAD_DIR,
+                                  {'inputs': inputs}, exclude=host_files())
             current_certs()
 
     if args.pkg:
@@ -228,22 +301,28 @@ def main():
         # via relative paths
         os.chdir(CURRENT_DIR)
         version = CONFIG['openssl_version']
-        rc = package.pkg(root=PKG_PAYLOAD_DIR,
+        slim.stage_payload(PKG_PAYLOAD_DIR, SLIM_PAYLOAD_DIR, 'openssl')
+        rc = package.pkg(root=SLIM_PAYLOAD_DIR,
                          version=version,
                          identifier="{}.openssl".format(CONFIG['pkgid']),
                          output='openssl-{}.pkg'.format(version),
+                         force=args.force,
+                         verify=args.verify,
                          )
         if rc == 0:
             log.info("OpenSSL packaged properly")
         else:
             log.error("Looks like package creation failed")
+            # Exit non-zero so build.py stops the builds that need OpenSSL
+            sys.exit(1)
 
     if args.install:
         log.info("Installing OpenSSL pacakge...")
         os.chdir(CURRENT_DIR)
-        cmd = ['/usr/sbin/installer', '-pkg',
-               'openssl-{}.pkg'.format(version), '-tgt', '/']
-        runner.Popen(cmd)
+        rc = package.install('openssl-{}.pkg'.format(OPENSSL_VERSION))
+        if rc != 0:
+            log.error("OpenSSL install failed")
+            sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -6,7 +6,6 @@ import os
 import shutil
 import sys
 import inspect
-import tempfile
 import argparse
 
 # our libs. kind of hacky since this isn't a valid python package.
@@ -15,12 +14,21 @@ CURRENT_DIR = os.path.dirname(
 PARENT_DIR = os.path.dirname(CURRENT_DIR)
 sys.path.insert(0, PARENT_DIR)
 
+from vendir import artifacts  # noqa
+from vendir import bytecode  # noqa
+from vendir import ccache  # noqa
 from vendir import config  # noqa
-from vendir import hash_helper  # noqa
+from vendir import extract  # noqa
+from vendir import fetch  # noqa
+from vendir import fingerprint  # noqa
+from vendir import jobs  # noqa
 from vendir import log  # noqa
 from vendir import package  # noqa
 from vendir import runner  # noqa
 from vendir import root  # noqa
+from vendir import slim  # noqa
+from vendir import trace  # noqa
+from vendir import wheelhouse  # noqa
 
 
 CONFIG = config.ConfigSectionMap()
@@ -34,108 +42,190 @@ PYTHON3_INSTALL = os.path.join(BASE_INSTALL_PATH, 'Python', '3.6')
 OPENSSL_INSTALL_PATH = os.path.join(CONFIG['base_install_path'], 'openssl')
 
 
-def dl_and_extract_python(dist_url, dist_hash):
-    """Download Python distribution and extract it to PYTHON_BUILD_DIR."""
-    if os.path.isdir(PYTHON_BUILD_DIR):
-        shutil.rmtree(PYTHON_BUILD_DIR, ignore_errors=True)
-    mkpath(PYTHON_BUILD_DIR)
-    # Download Python
-    log.info("Downloading Python from: {}".format(dist_url))
-    temp_filename = os.path.join(tempfile.mkdtemp(), 'tempdata')
-    cmd = ['/usr/bin/curl', '--show-error', '--no-buffer',
-           '--fail', '--progress-bar',
-           '--speed-time', '30',
-           '--location',
-           '--url', dist_url,
-           '--output', temp_filename]
-    # We are calling os.system so we can get download progress live
-    rc = runner.system(cmd)
-    if rc == 0 or rc is True:
-        log.debug("Python download successful")
-    else:
-        log.error("Python download failed with exit code: '{}'".format(rc))
-        sys.exit(1)
+def python_build_dir(py_version):
+    """
+    Return the build directory for a Python version.
+
+    Each major version gets its own directory under PYTHON_BUILD_DIR so
+    Python 2 and Python 3 can be built at the same time.
+    """
+    return os.path.join(PYTHON_BUILD_DIR, py_version.split('.')[0])
 
-    # Verify Python download hash
-    download_hash = hash_helper.getsha256hash(temp_filename)
-    config_hash = dist_hash
-    if download_hash != config_hash:
-        log.error("Hash verification of Python download has failed. Download "
-                  "hash of '{}' does not match config hash '{}'".format(
-                    download_hash, config_hash))
+
+def dl_and_extract_python(dist_url, dist_hash, build_dir):
+    """Download Python distribution and extract it to build_dir."""
+    # Download, verify and extract in a single pass. The extracted tree only
+    # replaces build_dir when the hash matches.
+    log.info("Downloading and extracting Python from: {}".format(dist_url))
+    try:
+        fetch.fetch_and_extract(dist_url, dist_hash, build_dir,
+                                exclude=extract.excludes('python'))
+    except fetch.FetchError as err:
+        log.error("Python download has failed: {}".format(err))
         sys.exit(1)
-    else:
-        log.detail("Hash verification of Python successful")
-
-    # Extract Python to the PYTHON_BUILD_DIR
-    log.info("Extracting Python...")
-    cmd = ['/usr/bin/tar', '-xf', temp_filename, '-C', PYTHON_BUILD_DIR,
-           '--strip-components', '1']
-    out = runner.Popen(cmd)
-    if out[2] == 0:
-        log.debug("Extraction completed successfully")
-    else:
-        log.error("Extraction has failed: {}".format(out[0]))
-    os.remove(temp_filename)
+    log.debug("Extraction completed successfully")
+
+
+def setup_dist_lines():
+    """Return the extra module lines Python 2 adds to Modules/Setup.dist."""
+    return ["_socket socketmodule.c timemodule.c\n",
+            "_ssl _ssl.c -DUSE_SSL "
+            "-I{0}/include -I{0}/include/openssl -L{0}/lib "
+            "-lssl -lcrypto".format(OPENSSL_INSTALL_PATH)]
+
+
+def configure_cmd(py_install_path):
+    """Return the Python configure command."""
+    return ['./configure',
+            '--prefix={}'.format(py_install_path),
+            #    'CPPFLAGS=-I{}/include'.format(OPENSSL_INSTALL_PATH),
+            #    'LDFLAGS=-L{}/lib'.format(OPENSSL_INSTALL_PATH),
+            'CFLAGS=-I{}/include'.format(OPENSSL_INSTALL_PATH),
+            'LDFLAGS=-L{}/lib'.format(OPENSSL_INSTALL_PATH),
+            '--enable-shared',
+            '--enable-toolbox-glue',
+            '--with-ensurepip=install',
+            '--enable-ipv6',
+            '--with-threads',
+            '--datarootdir={}/share'.format(py_install_path),
+            '--datadir={}/share'.format(py_install_path),
+            # '--enable-optimizations',  # adding this flag will run tests
+            ]
+
+
+def requirements_file(py_version):
+    """Return the pip requirements file for a Python version."""
+    py_major_ver = py_version.split('.')[0]
+    return os.path.join(CURRENT_DIR, 'requirements{}.txt'.format(py_major_ver))
+
+
+def artifact_inputs(py_version, py_install_path, dist_url, dist_hash):
+    """Return every input that changes the payload of a Python version."""
+    # Hash the requirements by content since their path differs per host
+    requirements = fingerprint.file_hashes(requirements_file(py_version))
+    return [dist_url, dist_hash, extract.excludes('python'), py_version,
+            BASE_INSTALL_PATH, configure_cmd(py_install_path),
+            setup_dist_lines(),
+            CONFIG['openssl_version'], CONFIG['openssl_dist_hash'],
+            sorted(requirements.values()), bytecode.levels(),
+            bytecode.epoch()]
+
+
+def build_phases(py_version, py_install_path, dist_url, dist_hash,
+                 force=False):
+    """
+    Return the fingerprinted build phases for a Python version.
+
+    A phase only re-runs when its inputs, or the inputs of an earlier phase,
+    have changed since the last successful build.
+    """
+    build_dir = python_build_dir(py_version)
+    phases = fingerprint.Phases(build_dir + '.fingerprint.json', force=force)
+    phases.add('extract', [dist_url, dist_hash, extract.excludes('python')],
+               outputs=[os.path.join(build_dir, 'configure')])
+    # The OpenSSL we link against is an input of the compile as well
+    phases.add('configure',
+               [configure_cmd(py_install_path), setup_dist_lines(),
+                CONFIG['openssl_version'], CONFIG['openssl_dist_hash']],
+               outputs=[os.path.join(build_dir, 'Makefile')])
+    phases.add('make')
+    phases.add('install', [py_install_path],
+               outputs=[os.path.join(py_install_path, 'bin')])
+    phases.add('pip', [fingerprint.file_hashes(requirements_file(py_version))])
+    phases.add('bytecode', [bytecode.levels(), bytecode.epoch()])
+    return phases
 
 
-def build(py_version, py_install_path, skip):
+def build(py_version, py_install_path, skip, phases):
     """Build custom Python from source."""
     py_major_ver = py_version.split('.')[0]
     log.debug("Currently building: {}".format(py_major_ver))
+    build_dir = python_build_dir(py_version)
     # Step 1: change into our build directory
-    os.chdir(PYTHON_BUILD_DIR)
+    os.chdir(build_dir)
     # Don't compile Python if the skip option is passed
     if skip:
         log.info("Python compile skipped due to -skip option")
         return
-    # Step 1.5: Add extra modules
-    if py_major_ver == '2':
-        setup_dist = os.path.join(PYTHON_BUILD_DIR, 'Modules/Setup.dist')
-        with open(setup_dist, "a") as f:
-            log.debug("Adding additional modules to be included...")
-            f.write("_socket socketmodule.c timemodule.c\n")
-            f.write("_ssl _ssl.c -DUSE_SSL "
-                    "-I{0}/include -I{0}/include/openssl -L{0}/lib "
-                    "-lssl -lcrypto".format(OPENSSL_INSTALL_PATH))
-    # Step 2: Run the Configure setup of Python to set correct paths
-    os.chdir(PYTHON_BUILD_DIR)
-    if os.path.isdir(py_install_path):
-        shutil.rmtree(py_install_path, ignore_errors=True)
-    mkpath(py_install_path)
-    log.info("Configuring Python...")
-    cmd = ['./configure',
-           '--prefix={}'.format(py_install_path),
-           #    'CPPFLAGS=-I{}/include'.format(OPENSSL_INSTALL_PATH),
-           #    'LDFLAGS=-L{}/lib'.format(OPENSSL_INSTALL_PATH),
-           'CFLAGS=-I{}/include'.format(OPENSSL_INSTALL_PATH),
-           'LDFLAGS=-L{}/lib'.format(OPENSSL_INSTALL_PATH),
-           '--enable-shared',
-           '--enable-toolbox-glue',
-           '--with-ensurepip=install',
-           '--enable-ipv6',
-           '--with-threads',
-           '--datarootdir={}/share'.format(py_install_path),
-           '--datadir={}/share'.format(py_install_path),
-           # '--enable-optimizations',  # adding this flag will run tests
-           ]
-    runner.Popen(cmd, stdout=sys.stdout)
+    if phases.needed('configure'):
+        phases.start('configure')
+        # Step 1.5: Add extra modules
+        if py_major_ver == '2':
+            setup_dist = os.path.join(build_dir, 'Modules/Setup.dist')
+            with open(setup_dist) as f:
+                current = f.read()
+            # configure can re-run on an extracted tree so only add once
+            with open(setup_dist, "a") as f:
+                log.debug("Adding additional modules to be included...")
+                for line in setup_dist_lines():
+                    if line.strip() not in current:
+                        f.write(line)
+        # Step 2: Run the Configure setup of Python to set correct paths
+        os.chdir(build_dir)
+        log.info("Configuring Python...")
+        cmd = configure_cmd(py_install_path)
+        with trace.span('configure'):
+            out = runner.stream(cmd, log_file=runner.step_log('configure'))
+        if out[2] != 0:
+            log.error("Python configure failed: {}".format(out[1]))
+            sys.exit(1)
+        phases.done('configure')
+
     # Step 3: compile Python. this will take a while.
+    if phases.needed('make'):
+        phases.start('make')
+        log.info("Compiling Python. This will take a while time...")
+        log.detail("Running Python make routine...")
+        cmd = jobs.make_cmd()
+        with trace.span('make'):
+            out = runner.stream(cmd, log_file=runner.step_log('make'))
+        if out[2] != 0:
+            log.error("Python make failed: {}".format(out[1]))
+            sys.exit(1)
+        phases.done('make')
+
+    if phases.needed('install'):
+        phases.start('install')
+        # Start from an empty install so removed files do not linger
+        if os.path.isdir(py_install_path):
+            shutil.rmtree(py_install_path, ignore_errors=True)
+        mkpath(py_install_path)
+        log.detail("Running Python make install routine...")
+        # make install is not reliably parallel safe for CPython
+        cmd = jobs.make_cmd('install', parallel=False)
+        with trace.span('make install'):
+            out = runner.stream(cmd, log_file=runner.step_log('make install'))
+        if out[2] != 0:
+            log.error("Python make install failed: {}".format(out[1]))
+            sys.exit(1)
+        phases.done('install')
 
-    # FIXME: We need to check return codes.
-    log.info("Compiling Python. This will take a while time...")
-    log.detail("Running Python make routine...")
-    cmd = ['/usr/bin/make']
-    runner.Popen(cmd, stdout=sys.stdout)
-    sys.stdout.flush()  # does this help?
-
-    log.debug("Create some temp files thats")
-    log.detail("Running Python make install routine...")
-    cmd = ['/usr/bin/make', 'install']
-    runner.Popen(cmd, stdout=sys.stdout)
-    sys.stdout.flush()  # does this help?
     # Step 4: Install pip + requirements
-    os.chdir(os.path.join(py_install_path, 'bin'))
+    if phases.needed('pip'):
+        phases.start('pip')
+        install_requirements(py_version, py_install_path)
+        phases.done('pip')
+
+    # Step 5: Byte-compile the stdlib and site-packages
+    if phases.needed('bytecode'):
+        phases.start('bytecode')
+        compile_bytecode(py_version, py_install_path)
+        phases.done('bytecode')
+
+
+def install_requirements(py_version, py_install_path):
+    """Install pip and the requirements into a built Python."""
+    py_major_ver = py_version.split('.')[0]
+    bin_dir = os.path.join(py_install_path, 'bin')
+    os.chdir(bin_dir)
+    if py_major_ver == '2':
+        interpreter = 'python2.7'
+    elif py_major_ver == '3':
+        interpreter = 'python3.6'
+    # Build or reuse the wheels of this interpreter so the installs below
+    # do not need the network
+    house = wheelhouse.prepare(os.path.join(bin_dir, interpreter),
+                               requirements_file(py_version))
     # Update pip to latest
     log.info("Upgrading pip...")
     if py_major_ver == '2':
@@ -143,16 +233,42 @@ def build(py_version, py_install_path, skip):
     elif py_major_ver == '3':
         cmd = ['./pip3']
     cmd = cmd + ['install', '--upgrade', 'pip']
-    runner.Popen(cmd, stdout=sys.stdout)
+    with trace.span('pip upgrade'):
+        runner.stream(cmd + wheelhouse.offline_args(house),
+                      log_file=runner.step_log('pip upgrade'))
     # Install all pip modules from requirements.txt
     log.info("Install requirements...")
-    if py_major_ver == '2':
-        cmd = ['./python2.7', '-m', 'pip', 'install', '-r',
-               os.path.join(CURRENT_DIR, 'requirements2.txt')]
-    elif py_major_ver == '3':
-        cmd = ['./python3.6', '-m', 'pip', 'install', '-r',
-               os.path.join(CURRENT_DIR, 'requirements3.txt')]
-    runner.Popen(cmd, stdout=sys.stdout)
+    cmd = ['./' + interpreter, '-m', 'pip', 'install', '-r',
+           requirements_file(py_version)]
+    with trace.span('requirements'):
+        out = runner.stream(cmd + wheelhouse.offline_args(house),
+                            log_file=runner.step_log('requirements'))
+    if out[2] != 0 and house:
+        log.warn("Installing from the wheelhouse failed: {}".format(out[1]))
+        wheelhouse.remove(house)
+        with trace.span('requirements'):
+            out = runner.stream(cmd, log_file=runner.step_log('requirements'))
+    if out[2] != 0:
+        log.error("Installing Python requirements failed: {}".format(out[1]))
+        sys.exit(1)
+
+
+def compile_bytecode(py_version, py_install_path):
+    """Byte-compile the stdlib and site-packages of a built Python."""
+    levels = bytecode.levels()
+    if not levels:
+        log.detail("Bytecode compile disabled by python_bytecode_levels")
+        return
+    short_version = '.'.join(py_version.split('.')[:2])
+    python = os.path.join(py_install_path, 'bin', 'python' + short_version)
+    lib_dir = os.path.join(py_install_path, 'lib', 'python' + short_version)
+    log.info("Byte-compiling the Python payload...")
+    try:
+        stats = bytecode.compile_tree(python, lib_dir, levels)
+    except (IOError, OSError) as err:
+        log.error("Byte-compiling Python failed: {}".format(err))
+        sys.exit(1)
+    bytecode.report(stats)
 
 
 def main():
@@ -166,8 +282,14 @@ def main():
     parser.add_argument('-s', '--skip', action='store_true',
                         help='Skip recompiling if possible. Only recommended '
                              'for development purposes.')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='Rebuild every phase even when its inputs have '
+                             'not changed.')
     parser.add_argument('-p', '--pkg', action='store_true',
                         help='Package the Python output directory.')
+    parser.add_argument('--verify', action='store_true',
+                        help='Build the package twice and check both are '
+                             'byte for byte identical.')
     parser.add_argument('-v', '--verbose', action='count', default=1,
                         help="Increase verbosity level. Repeatable up to "
                         "2 times (-vv)")
@@ -205,31 +327,53 @@ def main():
         sys.stderr('Unsupported python version\n')
         sys.exit(1)
 
+    component = 'python' + py_version.split('.')[0]
+    inputs = artifact_inputs(py_version, py_install_path, dist_url, dist_hash)
+    artifact_key = artifacts.key(component, inputs)
+    # --force always compiles, even when a prebuilt payload exists
+    if args.build and not (skip or args.force) and \
+            artifacts.pull(component, artifact_key, py_install_path):
+        args.build = False
+
     if args.build:
         log.info("Bulding Python...")
 
+        phases = build_phases(py_version, py_install_path, dist_url,
+                              dist_hash, force=args.force)
         # When the skip option is passed and the build directory exists, skip
         # download and compiling of Python. Note we still do linking.
         if skip:
             log.debug("Skip flag was provided. We will not compile Python "
                       "on this run.")
-        else:
-            dl_and_extract_python(dist_url, dist_hash)
-            # reset trigger flag as we needed to download Python
-            skip = False
+        elif phases.needed('extract'):
+            phases.start('extract')
+            dl_and_extract_python(dist_url, dist_hash,
+                                  python_build_dir(py_version))
+            phases.done('extract')
 
-        build(py_version, py_install_path, skip=skip)
+        cache_stats = ccache.activate(python_build_dir(py_version))
+        build(py_version, py_install_path, skip=skip, phases=phases)
+        ccache.report(cache_stats)
+        if not skip:
+            artifacts.publish(component, artifact_key, py_install_path,
+                              {'inputs': inputs})
 
     if args.pkg:
         log.info("Building a package for Python...")
         # Change back into our local directory so we can output our package
         # via relative paths
         os.chdir(CURRENT_DIR)
-        rc = package.pkg(root=py_install_path,
+        # Slim a copy so the install stays complete for the next incremental
+        # build and the artifact store
+        payload_dir = python_build_dir(py_version) + '-payload'
+        slim.stage_payload(py_install_path, payload_dir, component)
+        rc = package.pkg(root=payload_dir,
                          version=py_version,
                          identifier="{}.python".format(CONFIG['pkgid']),
                          install_location=py_install_path,
                          output='python-{}.pkg'.format(py_version),
+                         force=args.force,
+                         verify=args.verify,
                          )
         if rc == 0:
             log.info("Python packaged properly")
@@ -0,0 +1,791 @@
+#!/usr/bin/python
+"""
+Benchmark the build pipeline against a stub toolchain.
+
+Compile time hides how long the rest of a build takes: downloading,
+hashing, extracting, staging, logging, packaging and the orchestration in
+build.py. This harness runs the real build.py and setup scripts on a copy
+of the code in a work directory, against synthetic OpenSSL and Python
+tarballs with a configurable number and size of files. curl, make,
+pkgbuild, installer, install_name_tool, otool, security, patch, cc, strip,
+python and tar installs into / are replaced by small stub executables through
+VENDIR_TOOLS_DIR (see vendir.runner.tool()) so a run needs no network, no
+compiler and no macOS. The stubs do the file work of the real tools, like
+make install copying every file into the install prefix, but nothing else.
+
+Every run writes the usual Chrome trace, which is turned into a table of
+the time and throughput of each phase per component. The first run is
+cold. Later runs reuse the build directories, so they measure the
+incremental path where fingerprints, the download cache and the package
+manifests skip work, unless --cold is passed.
+
+Run it with the Python 2.7 the build uses. Nothing outside the work
+directory is touched and root is not required.
+
+Usage:
+    python tests/benchmark.py
+    python tests/benchmark.py --files 5000 --file-size 32768 --runs 3
+    python tests/benchmark.py --backend tar --json results.json
+    python tests/benchmark.py --baseline results.json   1 on a regression
+"""
+
+# standard libs
+import argparse
+import ConfigParser
+import glob
+import gzip
+import hashlib
+import inspect
+import json
+import os
+import random
+import shutil
+import struct
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+
+# our libs. kind of hacky since this isn't a valid python package.
+CURRENT_DIR = os.path.dirname(
+    os.path.abspath(inspect.getfile(inspect.currentframe())))
+PARENT_DIR = os.path.dirname(CURRENT_DIR)
+sys.path.insert(0, PARENT_DIR)
+
+from vendir import certs  # noqa
+from vendir import log  # noqa
+from vendir import runner  # noqa
+from vendir import trace  # noqa
+
+# Spans whose throughput is measured against the distribution tarball or
+# against the installed payload of their component
+DIST_SPANS = ('download', 'extract')
+PAYLOAD_SPANS = ('manifest', 'pkgbuild', 'tar', 'verify', 'install',
+                 'artifact pull', 'artifact publish')
+
+# Phases faster than this are too noisy to flag as regressions
+MIN_SECONDS = 0.05
+
+# Files and directories of the code tree that are not copied to the work
+# directory, like build outputs of earlier real builds
+IGNORE = ('*.pyc', '__pycache__', '*.pkg', '*.tar.*', '*.manifest.json',
+          '_src', '_patch', 'payload', 'tests', 'build', '.git')
+
+# The environment variable the installer stub checks its extraction
+# against so a stub install can never write outside the work directory
+BENCH_ROOT_ENV = 'VENDIR_BENCH_ROOT'
+
+PYTHON_STUB = """#!{python}
+# Run a script like /usr/bin/python would, without the root check
+import os
+import sys
+script = os.path.abspath(sys.argv[1])
+sys.argv = sys.argv[1:]
+sys.path[0] = os.path.dirname(script)
+sys.path.insert(1, {code_dir!r})
+from vendir import root
+root.root_check = lambda: None
+execfile(script, {{'__name__': '__main__', '__file__': script}})
+"""
+
+CURL_STUB = """#!{python}
+# Write a file:// --url to stdout
+import shutil
+import sys
+import urlparse
+url = sys.argv[sys.argv.index('--url') + 1]
+with open(urlparse.urlparse(url).path, 'rb') as f:
+    shutil.copyfileobj(f, sys.stdout, 2**16)
+"""
+
+MAKE_STUB = """#!{python}
+# Print compiler lines for build targets. install copies the _install tree
+# of the distribution into DESTDIR or INSTALL_PREFIX plus the prefix that
+# the configure stub wrote to the Makefile.
+import os
+import shutil
+import sys
+args = [arg for arg in sys.argv[1:] if not arg.startswith('-')]
+variables = dict(arg.split('=', 1) for arg in args if '=' in arg)
+targets = [arg for arg in args if '=' not in arg] or ['all']
+with open('Makefile') as f:
+    prefix = dict(line.strip().split('=', 1) for line in f
+                  if '=' in line)['prefix']
+for target in targets:
+    if target != 'install':
+        for i in range({make_lines}):
+            sys.stdout.write('cc -c -Os -Wall src/{{0}}/file{{1}}.c -o '
+                             'src/{{0}}/file{{1}}.o\\n'.format(target, i))
+        continue
+    dest = (variables.get('DESTDIR') or
+            variables.get('INSTALL_PREFIX') or '') + prefix
+    for dirpath, dirnames, filenames in os.walk('_install'):
+        target_dir = os.path.join(dest, os.path.relpath(dirpath, '_install'))
+        if not os.path.isdir(target_dir):
+            os.makedirs(target_dir)
+        for name in filenames:
+            target_path = os.path.join(target_dir, name)
+            shutil.copy2(os.path.join(dirpath, name), target_path)
+            sys.stdout.write('install -m 644 {{}}\\n'.format(target_path))
+"""
+
+PKGBUILD_STUB = """#!{python}
+# Write the --root tree to a tar archive below --install-location
+import os
+import sys
+import tarfile
+args = sys.argv[1:]
+root = args[args.index('--root') + 1]
+location = args[args.index('--install-location') + 1].lstrip('/')
+output = args[-1]
+archive = tarfile.open(output, 'w')
+for name in sorted(os.listdir(root)):
+    archive.add(os.path.join(root, name), os.path.join(location, name))
+archive.close()
+print('pkgbuild: Wrote package to {{}}'.format(output))
+"""
+
+# Extraction shared by the installer and tar stubs. Members must be inside
+# the work directory. Directories above it, like /tmp, are skipped so their
+# owner and mode are never changed.
+EXTRACT = """
+import os
+import subprocess
+import sys
+import tarfile
+DECOMPRESS = {{'.gz': 'gzip', '.xz': 'xz', '.zst': 'zstd'}}
+
+
+def extract(path, target):
+    bench_root = os.path.realpath(os.environ['{bench_root_env}'])
+    program = DECOMPRESS.get(os.path.splitext(path)[1])
+    if program:
+        proc = subprocess.Popen([program, '-dc', path],
+                                stdout=subprocess.PIPE)
+        archive = tarfile.open(fileobj=proc.stdout, mode='r|')
+    else:
+        archive = tarfile.open(path, 'r|')
+    for member in archive:
+        dest = os.path.realpath(os.path.join(target, member.name))
+        if dest == bench_root or dest.startswith(bench_root + os.sep):
+            archive.extract(member, target)
+        elif not (member.isdir() and
+                  (bench_root + os.sep).startswith(dest.rstrip(os.sep) +
+                                                   os.sep)):
+            sys.stderr.write('{{}} is outside {{}}\\n'.format(dest,
+                                                              bench_root))
+            sys.exit(1)
+    archive.close()
+"""
+
+INSTALLER_STUB = """#!{python}
+# Install a pkgbuild stub archive
+""" + EXTRACT + """
+args = sys.argv[1:]
+extract(args[args.index('-pkg') + 1], args[args.index('-tgt') + 1])
+print('installer: The install was successful.')
+"""
+
+TAR_STUB = """#!{python}
+# Installs of tar packages into / go through the guarded extraction. Every
+# other tar command runs the real tar.
+""" + EXTRACT + """
+args = sys.argv[1:]
+if '-x' in args and '-f' in args and '-C' in args and \\
+        args[args.index('-C') + 1] == '/':
+    extract(args[args.index('-f') + 1], '/')
+else:
+    os.execv({tar!r}, [{tar!r}] + args)
+"""
+
+OTOOL_STUB = """#!/bin/sh
+# The libraries a dylib links against
+printf '%s:\\n' "$2"
+printf '\\t{openssl}/lib/libcrypto.1.0.0.dylib (compatibility version 1.0.0, \
+current version 1.0.0)\\n'
+printf '\\t/usr/lib/libSystem.B.dylib (compatibility version 1.0.0, \
+current version 1252.0.0)\\n'
+"""
+
+CC_STUB = """#!/bin/sh
+# Write the -o output
+while [ $# -gt 0 ]; do
+    if [ "$1" = "-o" ]; then
+        printf 'compiled\\n' > "$2"
+        exit 0
+    fi
+    shift
+done
+"""
+
+PATCH_STUB = """#!/bin/sh
+# patch source diff -o dest. The diff does not apply to synthetic sources.
+cp "$1" "$4"
+"""
+
+SECURITY_STUB = """#!/bin/sh
+# find-certificate -a -p prints every root certificate as PEM
+cat '{certs}'
+"""
+
+NOOP_STUB = """#!/bin/sh
+# Accept every argument and succeed
+exit 0
+"""
+
+CONFIGURE_SCRIPT = """#!/bin/sh
+# Record the prefix for the make stub
+for arg in "$@"; do
+    case "$arg" in
+        --prefix=*) prefix="${arg#--prefix=}" ;;
+    esac
+done
+echo "prefix=$prefix" > Makefile
+echo "Configured for $prefix"
+"""
+
+PIP_SCRIPT = """#!/bin/sh
+echo "pip stub: $*"
+"""
+
+INTERPRETER_SCRIPT = """#!/bin/sh
+# pip is stubbed, everything else runs on the real interpreter
+if [ "$1" = "-m" ] && [ "$2" = "pip" ]; then
+    echo "pip stub: $*"
+    exit 0
+fi
+exec {python} "$@"
+"""
+
+MAKE_SSL_DATA_SCRIPT = """import sys
+with open(sys.argv[2], 'w') as f:
+    f.write('/* generated by the benchmark */\\n')
+"""
+
+
+def _words(size, seed=0):
+    """Return size bytes of compressible, source like comment lines."""
+    rand = random.Random(seed)
+    # Random lines for the first 256 KB, repeated after that
+    vocabulary = ['ssl', 'ctx', 'buffer', 'return', 'static', 'int', 'void',
+                  'const', 'char', 'size_t', 'if', 'else', 'for', 'while',
+                  'NULL', 'error', 'length', 'data', 'cert', 'key', 'hash']
+    lines = []
+    total = 0
+    while total < min(size, 2**18):
+        line = '# ' + ' '.join(rand.choice(vocabulary)
+                               for _ in range(rand.randint(4, 12))) + '\n'
+        lines.append(line)
+        total += len(line)
+    text = ''.join(lines)
+    return (text * (size // len(text) + 1))[:size]
+
+
+class Content(object):
+    """Distinct synthetic file contents cut from one shared text block."""
+
+    def __init__(self, file_size):
+        """Prepare contents of about file_size bytes per file."""
+        self.file_size = file_size
+        self.block = _words(max(2**20, file_size * 4))
+
+    def get(self, name, index):
+        """Return the content of file number index."""
+        header = '# {}\n'.format(name)
+        size = max(0, self.file_size - len(header))
+        offset = (index * 7919) % (len(self.block) - size)
+        return header + self.block[offset:offset + size]
+
+
+def _add(archive, name, data, mode=0o644):
+    """Add a file with data to an open tarfile."""
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mode = mode
+    info.mtime = 1500000000
+    archive.addfile(info, _StringFile(data))
+
+
+class _StringFile(object):
+    """A minimal file object over a string for TarFile.addfile()."""
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def read(self, size=-1):
+        if size < 0:
+            size = len(self.data) - self.pos
+        chunk = self.data[self.pos:self.pos + size]
+        self.pos += len(chunk)
+        return chunk
+
+
+def _compress(tar_path, suffix):
+    """Compress tar_path to tar_path + suffix and return the new path."""
+    output = tar_path + suffix
+    if suffix == '.xz':
+        with open(output, 'wb') as out:
+            rc = subprocess.call(['xz', '-0', '-T0', '-c', tar_path],
+                                 stdout=out)
+        if rc != 0:
+            raise OSError("Unable to compress '{}' with xz".format(tar_path))
+    else:
+        with open(tar_path, 'rb') as source:
+            dest = gzip.GzipFile(output, 'wb', 1, mtime=0)
+            shutil.copyfileobj(source, dest, 2**20)
+            dest.close()
+    os.remove(tar_path)
+    return output
+
+
+def make_dist(path, top, scripts, installed, suffix):
+    """
+    Write a synthetic distribution tarball.
+
+    Args:
+      path: the tarball path without the compression suffix
+      top: the top level directory every member is below
+      scripts: a dict of path -> (content, mode) outside the _install tree
+      installed: a dict of path -> (content, mode) that make install copies
+      suffix: '.gz' or '.xz'
+
+    Returns:
+      A tuple of (tarball path, bytes make install copies)
+
+    """
+    archive = tarfile.open(path, 'w')
+    for name in sorted(scripts):
+        data, mode = scripts[name]
+        _add(archive, os.path.join(top, name), data, mode)
+    payload_bytes = 0
+    for name in sorted(installed):
+        data, mode = installed[name]
+        _add(archive, os.path.join(top, '_install', name), data, mode)
+        payload_bytes += len(data)
+    archive.close()
+    return _compress(path, suffix), payload_bytes
+
+
+def _tree(content, prefix, files, extension):
+    """Return files synthetic entries spread over directories of 100."""
+    entries = {}
+    for index in range(files):
+        name = '{}/d{:03d}/f{:05d}{}'.format(prefix, index // 100, index,
+                                             extension)
+        entries[name] = (content.get(name, index), 0o644)
+    return entries
+
+
+def _sha256(path):
+    """Return the sha256 hex digest of path."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**20), ''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _der(tag, contents):
+    """Return a DER element."""
+    length = len(contents)
+    if length < 0x80:
+        return chr(tag) + chr(length) + contents
+    size = struct.pack('>I', length).lstrip('\0')
+    return chr(tag) + chr(0x80 | len(size)) + size + contents
+
+
+def make_certs(count):
+    """
+    Return a PEM bundle of count certificates with distinct subjects.
+
+    Only the structure up to the subject is real, which is all the hashed
+    certificate directory reads. The keys and signatures are random bytes.
+    """
+    rsa = _der(0x30, _der(0x06, '2a864886f70d010101'.decode('hex')) +
+               _der(0x05, ''))
+    signature = _der(0x30, _der(0x06, '2a864886f70d01010b'.decode('hex')))
+    validity = _der(0x30, _der(0x17, '180101000000Z') +
+                    _der(0x17, '380101000000Z'))
+    bundle = []
+    for index in range(count):
+        name = _der(0x30, _der(0x31, _der(0x30, _der(0x06, '550403'.decode(
+            'hex')) + _der(0x13, 'Benchmark Root CA {}'.format(index)))) +
+            _der(0x31, _der(0x30, _der(0x06, '55040a'.decode('hex')) +
+                            _der(0x0c, 'Vendored  Benchmark'))))
+        tbs = _der(0x30, _der(0xa0, _der(0x02, '\x02')) +
+                   _der(0x02, struct.pack('>I', index + 1)) + signature +
+                   name + validity + name +
+                   _der(0x30, rsa + _der(0x03, '\0' + os.urandom(140))))
+        der = _der(0x30, tbs + signature + _der(0x03, '\0' +
+                                                os.urandom(256)))
+        bundle.append(certs.to_pem(der))
+    return ''.join(bundle)
+
+
+def _write(path, data, mode=0o644):
+    """Write data to path with mode."""
+    with open(path, 'w') as f:
+        f.write(data)
+    os.chmod(path, mode)
+
+
+class Workspace(object):
+    """The work directory of a benchmark and everything generated in it."""
+
+    def __init__(self, path, args):
+        """Lay out the workspace at path for the parsed args."""
+        self.path = os.path.abspath(path)
+        self.args = args
+        self.code_dir = os.path.join(self.path, 'code')
+        self.tools_dir = os.path.join(self.path, 'tools')
+        self.dist_dir = os.path.join(self.path, 'dist')
+        self.report_dir = os.path.join(self.path, 'reports')
+        self.base_install_path = os.path.join(self.path, 'root', 'Library',
+                                              'vendored')
+        # component -> tarball path and {'dist': bytes, 'payload': bytes}
+        self.dists = {}
+        self.sizes = {}
+        self.config = {}
+
+    def prepare(self):
+        """Generate the distributions, tools, code copy and config.ini."""
+        for name in ('dist', 'reports'):
+            directory = os.path.join(self.path, name)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+        started = time.time()
+        self.make_dists()
+        log.info("Generated synthetic distributions in {:.1f}s".format(
+                 time.time() - started))
+        self.make_tools()
+        self.copy_code()
+
+    def make_dists(self):
+        """Write the OpenSSL and Python distributions."""
+        args = self.args
+        content = Content(args.file_size)
+        template = ConfigParser.RawConfigParser()
+        template.read(os.path.join(PARENT_DIR, 'config.ini'))
+        openssl_version = template.get('DEFAULT', 'openssl_version')
+        installed = _tree(content, 'share/bench', args.files, '.txt')
+        for lib in ('libssl', 'libcrypto'):
+            installed['lib/{}.dylib'.format(lib)] = (
+                content.get(lib, args.files), 0o755)
+        dist, payload = make_dist(
+            os.path.join(self.dist_dir,
+                         'openssl-{}.tar'.format(openssl_version)),
+            'openssl-{}'.format(openssl_version),
+            {'Configure': (CONFIGURE_SCRIPT, 0o755)}, installed, '.gz')
+        self._dist('openssl', dist, payload)
+
+        xz = '.xz' if _which('xz') else '.gz'
+        for major, binary, pip in (('2', 'python2.7', 'pip'),
+                                   ('3', 'python3.6', 'pip3')):
+            version = template.get('DEFAULT', 'python{}_version'.format(major))
+            py_dir = 'lib/' + binary
+            installed = _tree(content, py_dir, args.files, '.py')
+            installed['bin/' + binary] = (INTERPRETER_SCRIPT.format(
+                python=sys.executable), 0o755)
+            installed['bin/' + pip] = (PIP_SCRIPT, 0o755)
+            scripts = {'configure': (CONFIGURE_SCRIPT, 0o755),
+                       'Modules/Setup.dist': ('# Synthetic Setup.dist\n',
+                                              0o644)}
+            dist, payload = make_dist(
+                os.path.join(self.dist_dir, 'Python-{}.tar'.format(version)),
+                'Python-{}'.format(version), scripts, installed, xz)
+            self._dist('python' + major, dist, payload)
+            self.config['python{}_dist'.format(major)] = 'file://' + dist
+            self.config['python{}_dist_hash'.format(major)] = _sha256(dist)
+        self.config['openssl_dist'] = 'file://' + self.dists['openssl']
+        self.config['openssl_dist_hash'] = _sha256(self.dists['openssl'])
+
+    def _dist(self, component, path, payload):
+        """Remember the sizes of a generated distribution."""
+        self.dists[component] = path
+        self.sizes[component] = {'dist': os.path.getsize(path),
+                                 'payload': payload}
+        log.detail("{}: {:.1f} MB tarball, {:.1f} MB installed".format(
+                   component, self.sizes[component]['dist'] / 2.0**20,
+                   payload / 2.0**20))
+
+    def make_tools(self):
+        """Write the stub executables."""
+        if os.path.isdir(self.tools_dir):
+            shutil.rmtree(self.tools_dir)
+        os.makedirs(self.tools_dir)
+        values = {'python': sys.executable, 'code_dir': self.code_dir,
+                  'make_lines': self.args.make_lines,
+                  'bench_root_env': BENCH_ROOT_ENV,
+                  'openssl': os.path.join(self.base_install_path, 'openssl'),
+                  'tar': _which('tar'),
+                  'certs': os.path.join(self.tools_dir, 'roots.pem')}
+        _write(values['certs'], make_certs(150))
+        stubs = {'python': PYTHON_STUB, 'curl': CURL_STUB, 'make': MAKE_STUB,
+                 'pkgbuild': PKGBUILD_STUB, 'installer': INSTALLER_STUB,
+                 'tar': TAR_STUB, 'otool': OTOOL_STUB, 'cc': CC_STUB,
+                 'patch': PATCH_STUB, 'security': SECURITY_STUB,
+                 'install_name_tool': NOOP_STUB, 'strip': NOOP_STUB}
+        for name, template in stubs.items():
+            _write(os.path.join(self.tools_dir, name),
+                   template.format(**values), 0o755)
+
+    def copy_code(self):
+        """Copy the code tree, seed the tlsssl sources and write config.ini."""
+        if os.path.isdir(self.code_dir):
+            shutil.rmtree(self.code_dir)
+        shutil.copytree(PARENT_DIR, self.code_dir,
+                        ignore=shutil.ignore_patterns(*IGNORE))
+        # tlsssl only downloads its sources when their hashes do not match
+        src_dir = os.path.join(self.code_dir, 'tlsssl', '_src')
+        os.makedirs(src_dir)
+        content = Content(self.args.file_size)
+        sources = {'ssl.py': ('ssl_py_hash', content.get('ssl.py', 1)),
+                   '_ssl.c': ('ssl_c_hash', content.get('_ssl.c', 2)),
+                   'make_ssl_data.py': ('make_ssl_data_py_hash',
+                                        MAKE_SSL_DATA_SCRIPT),
+                   'socketmodule.h': ('socketmodule_h_hash',
+                                      content.get('socketmodule.h', 3))}
+        for name, (key, data) in sources.items():
+            path = os.path.join(src_dir, name)
+            _write(path, data)
+            self.config[key] = _sha256(path)
+        self.write_config()
+
+    def write_config(self):
+        """Point every path in config.ini into the work directory."""
+        parser = ConfigParser.RawConfigParser()
+        parser.read(os.path.join(PARENT_DIR, 'config.ini'))
+        values = dict(self.config)
+        values.update({
+            'base_install_path': self.base_install_path,
+            'openssl_build_dir': os.path.join(self.path, 'build', 'openssl'),
+            'python_build_dir': os.path.join(self.path, 'build', 'python'),
+            'download_cache_dir': os.path.join(self.path, 'cache',
+                                               'downloads'),
+            'hash_cache_path': os.path.join(self.path, 'cache',
+                                            'hashes.sqlite'),
+            'wheelhouse_dir': os.path.join(self.path, 'cache',
+                                           'wheelhouse'),
+            'compiler_cache': '',
+            'report_dir': self.report_dir,
+            'log_dir': os.path.join(self.path, 'logs'),
+            'artifact_store': (os.path.join(self.path, 'artifacts')
+                               if self.args.artifact_store else ''),
+            'pkg_backend': self.args.backend,
+            'sign_cert_cn': '',
+        })
+        for key, value in values.items():
+            parser.set('DEFAULT', key, value)
+        with open(os.path.join(self.code_dir, 'config.ini'), 'w') as f:
+            parser.write(f)
+
+    def reset(self):
+        """
+        Remove the outputs of earlier runs for a cold run.
+
+        The artifact store is kept since it stands in for a store shared
+        with other hosts.
+        """
+        for name in ('build', 'root', 'cache', 'logs'):
+            path = os.path.join(self.path, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+        self.copy_code()
+
+    def run(self, index):
+        """
+        Run build.py once.
+
+        Returns:
+          A dict with the wall time, exit code and trace.summary() rows
+
+        """
+        run_report_dir = os.path.join(self.report_dir, 'run-{}'.format(index))
+        env = dict(os.environ)
+        env.update({runner.TOOLS_DIR_ENV: self.tools_dir,
+                    trace.REPORT_DIR_ENV: run_report_dir,
+                    BENCH_ROOT_ENV: self.path,
+                    'PATH': self.tools_dir + os.pathsep +
+                    env.get('PATH', '')})
+        env.pop('MAKEFLAGS', None)
+        env.pop('SOURCE_DATE_EPOCH', None)
+        output = os.path.join(self.path, 'run-{}.log'.format(index))
+        cmd = [os.path.join(self.tools_dir, 'python'),
+               os.path.join(self.code_dir, 'build.py'),
+               '-j', str(self.args.jobs)]
+        started = time.time()
+        with open(output, 'w') as out:
+            rc = subprocess.call(cmd, cwd=self.code_dir, env=env,
+                                 stdout=out, stderr=subprocess.STDOUT)
+        wall = time.time() - started
+        result = {'run': index, 'wall': wall, 'returncode': rc,
+                  'log': output, 'spans': []}
+        traces = glob.glob(os.path.join(run_report_dir, '*', 'trace.json'))
+        if traces:
+            events = trace.load(sorted(traces)[-1])
+            result['spans'] = [self._row(*row)
+                               for row in trace.summary(events)]
+        return result
+
+    def _row(self, component, span_name, count, seconds):
+        """Return a summary row with its throughput in MB/s or None."""
+        sizes = self.sizes.get(component, {})
+        size = None
+        if span_name in DIST_SPANS:
+            size = sizes.get('dist')
+        elif span_name in PAYLOAD_SPANS:
+            size = sizes.get('payload')
+        rate = None
+        if size and seconds > 0:
+            rate = size * count / 2.0**20 / seconds
+        return {'component': component, 'span': span_name, 'count': count,
+                'seconds': seconds, 'mb_per_s': rate}
+
+
+def _which(name):
+    """Return the path of an executable on PATH or None."""
+    for directory in os.environ.get('PATH', '').split(os.pathsep):
+        path = os.path.join(directory, name)
+        if os.access(path, os.X_OK):
+            return path
+    return None
+
+
+def report(result, kind):
+    """Log the phase table of a run."""
+    log.info("Run {} ({}): {:.2f}s, exit code {}".format(
+             result['run'], kind, result['wall'], result['returncode']))
+    log.info("{:<12} {:<24} {:>6} {:>10} {:>10}".format(
+             'component', 'span', 'count', 'seconds', 'MB/s'))
+    for row in result['spans']:
+        rate = row['mb_per_s']
+        log.info("{:<12} {:<24} {:>6} {:>10.3f} {:>10}".format(
+                 row['component'], row['span'][:24], row['count'],
+                 row['seconds'], '{:.1f}'.format(rate) if rate else '-'))
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compare the phases of each run with the same run of a baseline.
+
+    Runs of a different kind, like a cold run against an incremental one,
+    are not compared.
+
+    Returns:
+      A list of (run, component, span, seconds, baseline seconds) tuples
+      that are slower than the baseline by more than tolerance
+
+    """
+    regressions = []
+    for result, previous in zip(results, baseline.get('runs', [])):
+        if result.get('kind') != previous.get('kind'):
+            continue
+        before = dict(((row['component'], row['span']), row['seconds'])
+                      for row in previous['spans'])
+        for row in result['spans']:
+            key = (row['component'], row['span'])
+            if key not in before or before[key] < MIN_SECONDS:
+                continue
+            if row['seconds'] > before[key] * (1 + tolerance):
+                regressions.append((result['run'],) + key +
+                                   (row['seconds'], before[key]))
+    return regressions
+
+
+def main():
+    """Generate a workspace, run the builds and report the phase timings."""
+    parser = argparse.ArgumentParser(prog='vendored benchmark',
+                                     description='Time the build pipeline '
+                                     'against synthetic distributions and a '
+                                     'stub toolchain.')
+    parser.add_argument('--files', type=int, default=1000,
+                        help='Files installed by each synthetic '
+                             'distribution.')
+    parser.add_argument('--file-size', type=int, default=16384,
+                        help='Size of each synthetic file in bytes.')
+    parser.add_argument('--make-lines', type=int, default=5000,
+                        help='Output lines printed by each stub make.')
+    parser.add_argument('--runs', type=int, default=2,
+                        help='Number of builds. Runs after the first are '
+                             'incremental unless --cold is passed.')
+    parser.add_argument('--cold', action='store_true',
+                        help='Remove every build output between runs.')
+    parser.add_argument('-j', '--jobs', type=int, default=3,
+                        help='Components build.py builds at the same time.')
+    parser.add_argument('--backend', default='pkgbuild',
+                        choices=['pkgbuild', 'tar'],
+                        help='The pkg_backend to package with.')
+    parser.add_argument('--artifact-store', action='store_true',
+                        help='Publish and pull payloads through an artifact '
+                             'store in the work directory.')
+    parser.add_argument('--work-dir',
+                        help='Directory to generate everything in. Defaults '
+                             'to a temporary directory.')
+    parser.add_argument('--keep', action='store_true',
+                        help='Keep the work directory afterwards.')
+    parser.add_argument('--json',
+                        help='Write the results to this file.')
+    parser.add_argument('--baseline',
+                        help='Results of an earlier --json run. Exit 1 when '
+                             'a phase is slower by more than --tolerance.')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Allowed slow down against the baseline, as a '
+                             'fraction.')
+    parser.add_argument('-v', '--verbose', action='count', default=1,
+                        help="Increase verbosity level. Repeatable up to "
+                        "2 times (-vv)")
+    args = parser.parse_args()
+    log.verbose = args.verbose
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='vendored-bench-')
+    workspace = Workspace(work_dir, args)
+    log.info("Benchmarking in '{}'".format(workspace.path))
+    results = []
+    try:
+        workspace.prepare()
+        for index in range(args.runs):
+            if index and args.cold:
+                workspace.reset()
+            result = workspace.run(index)
+            kind = 'cold' if index == 0 or args.cold else 'incremental'
+            result['kind'] = kind
+            results.append(result)
+            report(result, kind)
+            if result['returncode'] != 0:
+                with open(result['log']) as f:
+                    tail = f.readlines()[-40:]
+                log.error("The build failed:\n{}".format(''.join(tail)))
+                break
+    finally:
+        if not (args.keep or args.work_dir):
+            shutil.rmtree(workspace.path, ignore_errors=True)
+
+    data = {'params': {'files': args.files, 'file_size': args.file_size,
+                       'make_lines': args.make_lines, 'jobs': args.jobs,
+                       'backend': args.backend, 'cold': args.cold,
+                       'artifact_store': args.artifact_store},
+            'sizes': workspace.sizes,
+            'runs': results}
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+        log.info("Results written to '{}'".format(args.json))
+
+    failed = any(result['returncode'] != 0 for result in results)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for run, component, span_name, seconds, before in regressions:
+            log.warn("Run {} {} '{}' took {:.2f}s, {:.2f}s in the "
+                     "baseline".format(run, component, span_name, seconds,
+                                       before))
+        failed = failed or bool(regressions)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
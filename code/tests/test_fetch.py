@@ -0,0 +1,102 @@
+"""
+Tests for extracting distributions from the download cache.
+
+Usage:
+    python tests/test_fetch.py
+"""
+
+import hashlib
+import inspect
+import io
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import unittest
+
+# our libs. kind of hacky since this isn't a valid python package.
+CURRENT_DIR = os.path.dirname(
+    os.path.abspath(inspect.getfile(inspect.currentframe())))
+PARENT_DIR = os.path.dirname(CURRENT_DIR)
+sys.path.insert(0, PARENT_DIR)
+
+from vendir import cache  # noqa
+from vendir import fetch  # noqa
+from vendir import hash_helper  # noqa
+from vendir import trace  # noqa
+from vendir import usage  # noqa
+
+URL = 'https://example.com/dist-1.0.tar.gz'
+
+
+def make_tarball(path):
+    """Write a small gzipped distribution to path and return its sha256."""
+    with tarfile.open(path, 'w:gz') as archive:
+        for name in ('dist-1.0/README', 'dist-1.0/src/main.c'):
+            data = ('x' * 4096 + name) * 16
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+class FromCacheTest(unittest.TestCase):
+    """Tests for fetch._from_cache()."""
+
+    def setUp(self):
+        """Point the caches and reports at a temporary directory."""
+        self.work = tempfile.mkdtemp(prefix='test-fetch-')
+        self.configs = [(module.CONFIG, dict(module.CONFIG))
+                        for module in (cache, hash_helper)]
+        self.report_dir = os.environ.get(trace.REPORT_DIR_ENV)
+        cache.CONFIG['download_cache_dir'] = os.path.join(self.work, 'cache')
+        cache.CONFIG['download_cache_size_mb'] = ''
+        hash_helper.CONFIG['hash_cache_path'] = os.path.join(
+            self.work, 'hashes.sqlite')
+        os.environ[trace.REPORT_DIR_ENV] = os.path.join(self.work, 'reports')
+        self.dest = os.path.join(self.work, 'dist')
+        tarball = os.path.join(self.work, 'dist-1.0.tar.gz')
+        self.sha256 = make_tarball(tarball)
+        cache.put(tarball, self.sha256)
+
+    def tearDown(self):
+        """Restore the config and remove the temporary directory."""
+        # Drop what the test recorded so nothing is written at exit
+        del trace._events[:]
+        del usage._records[:]
+        if hash_helper._db is not None:
+            hash_helper._db.close()
+            hash_helper._db = None
+        for config, saved in self.configs:
+            config.clear()
+            config.update(saved)
+        if self.report_dir is None:
+            os.environ.pop(trace.REPORT_DIR_ENV, None)
+        else:
+            os.environ[trace.REPORT_DIR_ENV] = self.report_dir
+        shutil.rmtree(self.work, ignore_errors=True)
+
+    def test_hit(self):
+        """Extract a cached distribution."""
+        self.assertTrue(fetch._from_cache(URL, self.sha256, self.dest, 1))
+        self.assertTrue(os.path.isfile(os.path.join(self.dest, 'src',
+                                                    'main.c')))
+
+    def test_truncated_entry(self):
+        """Remove a truncated entry and report a miss."""
+        path = cache.path_for(self.sha256)
+        with open(path, 'rb') as f:
+            data = f.read()
+        with open(path, 'wb') as f:
+            f.write(data[:len(data) // 2])
+        self.assertFalse(fetch._from_cache(URL, self.sha256, self.dest, 1))
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(os.path.exists(self.dest))
+        self.assertEqual([], [name for name in os.listdir(self.work)
+                              if name.startswith('.fetch-')])
+
+
+if __name__ == '__main__':
+    unittest.main()
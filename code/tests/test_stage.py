@@ -0,0 +1,71 @@
+"""
+Tests for staging payloads without changing the install they come from.
+
+Usage:
+    python tests/test_stage.py
+"""
+
+import inspect
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+# our libs. kind of hacky since this isn't a valid python package.
+CURRENT_DIR = os.path.dirname(
+    os.path.abspath(inspect.getfile(inspect.currentframe())))
+PARENT_DIR = os.path.dirname(CURRENT_DIR)
+sys.path.insert(0, PARENT_DIR)
+
+from vendir import package  # noqa
+from vendir import stage  # noqa
+
+MTIME = 1500000000
+
+
+class StageTreeTest(unittest.TestCase):
+    """Tests for stage.stage_tree() and the steps that follow it."""
+
+    def setUp(self):
+        """Create an install with one file and a known mtime."""
+        self.work = tempfile.mkdtemp(prefix='test-stage-')
+        self.install = os.path.join(self.work, 'install')
+        self.payload = os.path.join(self.work, 'payload')
+        os.makedirs(os.path.join(self.install, 'lib'))
+        self.source = os.path.join(self.install, 'lib', 'libssl.dylib')
+        with open(self.source, 'w') as f:
+            f.write('payload')
+        os.utime(self.source, (MTIME, MTIME))
+        self.staged = os.path.join(self.payload, 'lib', 'libssl.dylib')
+
+    def tearDown(self):
+        """Remove the temporary directory."""
+        shutil.rmtree(self.work, ignore_errors=True)
+
+    def test_make_private(self):
+        """Keep the source mtime when a private copy is changed."""
+        stage.stage_tree(self.install, self.payload)
+        stage.make_private(self.staged)
+        os.utime(self.staged, (0, 0))
+        self.assertEqual(1, os.stat(self.source).st_nlink)
+        self.assertEqual(MTIME, os.stat(self.source).st_mtime)
+
+    def test_normalize_mtimes(self):
+        """Keep the source mtime when a hardlinked payload is normalized."""
+        stage.stage_tree(self.install, self.payload)
+        package.normalize_mtimes(self.payload, 0)
+        self.assertEqual(0, os.stat(self.staged).st_mtime)
+        self.assertEqual(MTIME, os.stat(self.source).st_mtime)
+        with open(self.source) as f:
+            self.assertEqual('payload', f.read())
+
+    def test_mutable(self):
+        """Never hardlink a tree staged as mutable."""
+        stage.stage_tree(self.install, self.payload, mutable=True)
+        self.assertEqual(1, os.stat(self.source).st_nlink)
+        self.assertEqual(MTIME, os.stat(self.staged).st_mtime)
+
+
+if __name__ == '__main__':
+    unittest.main()
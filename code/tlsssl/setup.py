@@ -3,7 +3,6 @@
 # standard libs
 from distutils.dir_util import mkpath
 import os
-import urllib2
 import shutil
 import sys
 import stat
@@ -17,11 +16,14 @@ CURRENT_DIR = os.path.dirname(
 PARENT_DIR = os.path.dirname(CURRENT_DIR)
 sys.path.insert(0, PARENT_DIR)
 
+from vendir import ccache  # noqa
 from vendir import config  # noqa
-from vendir import hash_helper  # noqa
+from vendir import fetch  # noqa
 from vendir import log  # noqa
 from vendir import package  # noqa
 from vendir import runner  # noqa
+from vendir import stage  # noqa
+from vendir import trace  # noqa
 
 
 CONFIG = config.ConfigSectionMap()
@@ -36,7 +38,8 @@ HEADER_SRC = os.path.join(CONFIG['base_install_path'], 'openssl/include')
 def download_python_source_files():
     """Download CPython source files from Github.
 
-    Verify the sha hash and redownload if they do not match.
+    Verify the sha hash and redownload if they do not match. The files are
+    downloaded concurrently and only replace an existing file once verified.
     """
     log.info("Downloading and verifying python source files...")
     src_dir = os.path.join(CURRENT_DIR, '_src')
@@ -55,35 +58,15 @@ def download_python_source_files():
       ['socketmodule.h',   '{}Modules/socketmodule.h'.format(gh_url),
        CONFIG['socketmodule_h_hash']],
     ]
-    # Verify we have the correct python source files else download it
+    # Verify we have the correct python source files else download them
     log.detail("Downloading & checking hash of python source files...")
-    for fname, url, sha256 in fp:
-        # This is a dual check step for file existence and hash matching
-        log.debug("Checking source file: {}...".format(fname))
-        if not os.path.isfile(fname) or (
-                hash_helper.getsha256hash(fname) != sha256):
-            log.info("Downloading '{}' source file...".format(fname))
-            log.debug("Download url: {}".format(url))
-            try:
-                data = urllib2.urlopen(url)
-                f = open(fname, "w")
-                content = data.read()
-                f.write(content)
-                f.close()
-                # Verify the hash of the source file we just downloaded
-                download_file_hash = hash_helper.getsha256hash(fname)
-                if download_file_hash != sha256:
-                    log.warn("The hash for '{}' does not match the expected "
-                             "hash. The downloaded hash is '{}'".format(
-                              fname, download_file_hash))
-                else:
-                    log.debug("The download file '{}' matches our expected "
-                              "hash of '{}'".format(fname, sha256))
-            except(urllib2.HTTPError, urllib2.URLError,
-                   OSError, IOError) as err:
-                log.error("Unable to download '{}' "
-                          "due to {}\n".format(fname, err))
-                sys.exit(1)
+    entries = [(url, sha256, os.path.join(src_dir, fname))
+               for fname, url, sha256 in fp]
+    try:
+        fetch.fetch_files(entries)
+    except fetch.FetchError as err:
+        log.error("Unable to download python source files: {}".format(err))
+        sys.exit(1)
     # We are done with _src directory for now so go back to script root path
     os.chdir(CURRENT_DIR)
 
@@ -117,17 +100,17 @@ def patch():
     if not os.path.isfile(os.path.join(patch_dir, "socketmodule.h")):
         log.debug("Copying 'socketmodule.h' to the _patch dir")
         source = os.path.join(CURRENT_DIR, "_src", "socketmodule.h")
-        shutil.copy(source, os.path.realpath(os.path.join(patch_dir)))
+        stage.stage_file(source, os.path.realpath(os.path.join(patch_dir)))
 
     if not os.path.isfile(os.path.join(patch_dir, "_ssl.c")):
         log.debug("Copying '_ssl.c' to the _patch dir")
         source = os.path.join(CURRENT_DIR, "_src", "_ssl.c")
-        shutil.copy(source, os.path.realpath(os.path.join(patch_dir)))
+        stage.stage_file(source, os.path.realpath(os.path.join(patch_dir)))
 
     if not os.path.isfile(os.path.join(patch_dir, "ssl.py")):
         log.debug("Copying 'ssl.py' to the _patch dir")
         source = os.path.join(CURRENT_DIR, "_src", "ssl.py")
-        shutil.copy(source, os.path.realpath(os.path.join(patch_dir)))
+        stage.stage_file(source, os.path.realpath(os.path.join(patch_dir)))
 
     log.detail("All patch files are created...")
 
@@ -154,7 +137,7 @@ def build():
     mkpath(build_dir)
     # Step 3.5: copy ssl.py to the build directory
     log.info("Copy 'ssl.py' to the build directory...")
-    shutil.copy(os.path.join(CURRENT_DIR, '_patch/ssl.py'), build_dir)
+    stage.stage_file(os.path.join(CURRENT_DIR, '_patch/ssl.py'), build_dir)
     workspace_rel = os.path.join(build_dir)
     workspace_abs = os.path.realpath(workspace_rel)
     # Step 4: copy and rename the dylibs to there
@@ -164,9 +147,10 @@ def build():
     ssl_tmp = os.path.join(workspace_abs, "libtlsssl.dylib")
     crypt_tmp = os.path.join(workspace_abs, "libtlscrypto.dylib")
     try:
-        shutil.copy(ssl_src, ssl_tmp)
-        shutil.copy(crypt_src, crypt_tmp)
-    except(IOError) as err:
+        # install_name_tool edits these in place so they are never hardlinks
+        stage.stage_file(ssl_src, ssl_tmp, mutable=True)
+        stage.stage_file(crypt_src, crypt_tmp, mutable=True)
+    except(IOError, OSError) as err:
         log.warn("tlsssl has a dependency on OpenSSL 1.0.1+ as such you "
                  "must build and install OpenSSL from ../openssl.")
         log.error("Build failed and will now exit!")
@@ -183,29 +167,50 @@ def build():
     st = os.stat(crypt_tmp)
     os.chmod(crypt_tmp, st.st_mode | stat.S_IWUSR)
 
-    cmd = ['/usr/bin/install_name_tool', '-id', ssl_dest, ssl_tmp]
-    out = runner.Popen(cmd)
-    runner.pprint(out, 'debug')
-
-    cmd = ['/usr/bin/install_name_tool', '-id', crypt_dest, crypt_tmp]
-    out = runner.Popen(cmd)
-    runner.pprint(out, 'debug')
-
+    # Step 8 (compile): patch in the additional paths and linkages
+    # NOTE: This command will output a few warnings that are hidden at
+    #       build time. Just an FYI in case this needs to be resolved in
+    #       the future.
+    system_python_path = ("/System/Library/Frameworks/Python.framework/"
+                          "Versions/2.7/include/python2.7")
+    compile_cmd = [
+        "cc", "-fno-strict-aliasing", "-fno-common", "-dynamic", "-arch",
+        "x86_64", "-arch", "i386", "-g", "-Os", "-pipe", "-fno-common",
+        "-fno-strict-aliasing", "-fwrapv", "-DENABLE_DTRACE", "-DMACOSX",
+        "-DNDEBUG", "-Wall", "-Wstrict-prototypes", "-Wshorten-64-to-32",
+        "-DNDEBUG", "-g", "-fwrapv", "-Os", "-Wall", "-Wstrict-prototypes",
+        "-DENABLE_DTRACE", "-arch", "x86_64", "-arch", "i386", "-pipe",
+        "-I{}".format(HEADER_SRC),
+        "-I{}".format(system_python_path),
+        "-c", "_patch/_ssl.c", "-o", "build/_ssl.o"]
     # Step 6: change the link between ssl and crypto
     # This part is a bit trickier - we need to take the existing entry
-    # for libcrypto on libssl and remap it to the new location
-    cmd = ['/usr/bin/otool', '-L', ssl_tmp]
-    out = runner.Popen(cmd)
-    runner.pprint(out, 'debug')
+    # for libcrypto on libssl and remap it to the new location. otool reads
+    # the untouched copy in LIBS_SRC so it can run while the ids change.
+    # None of these commands touch the same file so they run at the same
+    # time.
+    ssl_id, crypt_id, otool, compiled = runner.run_many([
+        ['/usr/bin/install_name_tool', '-id', ssl_dest, ssl_tmp],
+        ['/usr/bin/install_name_tool', '-id', crypt_dest, crypt_tmp],
+        ['/usr/bin/otool', '-L', ssl_src],
+        compile_cmd,
+    ])
+    for out in (ssl_id, crypt_id, otool):
+        runner.pprint(out, 'debug')
+    if compiled.ok:
+        log.debug("Build of '_ssl.o' completed successfullyly")
+    else:
+        log.error("Build has failed: {}".format(compiled.error))
 
     old_path = re.findall('^\t(/[^\(]+?libcrypto.*?.dylib)',
-                          out[0],
+                          otool.output,
                           re.MULTILINE)[0]
     log.debug("The old path was: {}".format(old_path))
 
     cmd = ['/usr/bin/install_name_tool', '-change', old_path, crypt_dest,
            ssl_tmp]
-    out = runner.Popen(cmd)
+    with trace.span('install_name_tool', dylib='libtlsssl'):
+        out = runner.Popen(cmd)
     runner.pprint(out, 'debug')
     # Step 7: cleanup permissions
     # NOTE: Same. I don't think this I needed any longer
@@ -213,32 +218,14 @@ def build():
     os.chmod(ssl_tmp, st.st_mode & ~stat.S_IWUSR)
     st = os.stat(crypt_tmp)
     os.chmod(crypt_tmp, st.st_mode & ~stat.S_IWUSR)
-    # Step 8: patch in the additional paths and linkages
-    # NOTE: This command will output a few warnings that are hidden at
-    #       build time. Just an FYI in case this needs to be resolved in
-    #       the future.
-    system_python_path = ("/System/Library/Frameworks/Python.framework/"
-                          "Versions/2.7/include/python2.7")
-    cmd = ["cc", "-fno-strict-aliasing", "-fno-common", "-dynamic", "-arch",
-           "x86_64", "-arch", "i386", "-g", "-Os", "-pipe", "-fno-common",
-           "-fno-strict-aliasing", "-fwrapv", "-DENABLE_DTRACE", "-DMACOSX",
-           "-DNDEBUG", "-Wall", "-Wstrict-prototypes", "-Wshorten-64-to-32",
-           "-DNDEBUG", "-g", "-fwrapv", "-Os", "-Wall", "-Wstrict-prototypes",
-           "-DENABLE_DTRACE", "-arch", "x86_64", "-arch", "i386", "-pipe",
-           "-I{}".format(HEADER_SRC),
-           "-I{}".format(system_python_path),
-           "-c", "_patch/_ssl.c", "-o", "build/_ssl.o"]
-    out = runner.Popen(cmd)
-    if out[2] == 0:
-        log.debug("Build of '_ssl.o' completed successfullyly")
-    else:
-        log.error("Build has failed: {}".format(out[1]))
 
+    # Step 8 (link): this reads libtlsssl so it waits for the -change above
     cmd = ["cc", "-bundle", "-undefined", "dynamic_lookup", "-arch",
            "x86_64", "-arch", "i386", "-Wl,-F.", "build/_ssl.o",
            "-L{}".format(workspace_abs), "-ltlsssl", "-ltlsssl", "-o",
            "build/_ssl.so"]
-    out = runner.Popen(cmd)
+    with trace.span('link'):
+        out = runner.Popen(cmd)
     if out[2] == 0:
         log.debug("Build of '_ssl.so' completed successfullyly")
     else:
@@ -258,6 +245,9 @@ def main():
                         help='Compile the tlsssl binaries')
     parser.add_argument('-p', '--pkg', action='store_true',
                         help='Package the tlsssl output directory.')
+    parser.add_argument('--verify', action='store_true',
+                        help='Build the package twice and check both are '
+                             'byte for byte identical.')
     parser.add_argument('-v', '--verbose', action='count', default=1,
                         help="Increase verbosity level. Repeatable up to "
                         "2 times (-vv)")
@@ -271,9 +261,11 @@ def main():
 
     if args.build:
         log.info("Bulding tslssl...")
+        cache_stats = ccache.activate(CURRENT_DIR)
         download_python_source_files()
         patch()
         build()
+        ccache.report(cache_stats)
 
     if args.pkg:
         # FIXME: This has grown out of control. Move this outside of main!
@@ -291,13 +283,16 @@ def main():
         mkpath(payload_lib_dir)
         log.detail("Changing file permissions for 'ssl.py'...")
         # ssl.py needs to have chmod 644 so non-root users can import this
+        # It may be a hardlink of _patch/ssl.py so give it its own inode first
+        stage.make_private('build/ssl.py')
         os.chmod('build/ssl.py', stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP |
                  stat.S_IROTH)
         log.detail("Copying build files into payload directory")
-        shutil.copy('build/_ssl.so', payload_root_dir)
-        shutil.copy('build/ssl.py', payload_root_dir)
-        shutil.copy('build/libtlscrypto.dylib', payload_lib_dir)
-        shutil.copy('build/libtlsssl.dylib', payload_lib_dir)
+        # Nothing modifies the build files after this so hardlinks are safe
+        stage.stage_file('build/_ssl.so', payload_root_dir)
+        stage.stage_file('build/ssl.py', payload_root_dir)
+        stage.stage_file('build/libtlscrypto.dylib', payload_lib_dir)
+        stage.stage_file('build/libtlsssl.dylib', payload_lib_dir)
 
         pth_fname = CONFIG['pth_fname']
         # if the pth_fname key is set write the .pth file
@@ -325,6 +320,7 @@ sys.path[p:p]=new; sys.__egginsert = p+len(new)""".format(
                          version=version,
                          identifier="{}.tlsssl".format(CONFIG['pkgid']),
                          output='tlsssl-{}.pkg'.format(version),
+                         verify=args.verify,
                          )
         if rc == 0:
             log.info("tlsssl packaged properly")
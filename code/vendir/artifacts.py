@@ -0,0 +1,297 @@
+"""
+Functions for sharing prebuilt component payloads between build hosts.
+
+Most builds produce a payload that an identical config already produced on
+another host. An artifact store keeps each finished payload under the
+component name and a key, a sha256 digest of every input of the build
+(versions, distribution hashes, configure flags, base_install_path,
+requirements) plus the platform. A setup script computes the key before
+compiling, pulls the payload when the store has it and publishes its own
+payload after a successful build.
+
+artifact_store in config.ini selects the store. A plain path or a file://
+URL is a LocalStore, which also works for a shared NFS mount. Leave it
+blank to disable the store.
+
+Layout of a LocalStore:
+
+    <store>/<component>/<key[:2]>/<key>/payload/...   the payload tree
+    <store>/<component>/<key[:2]>/<key>/meta.json     inputs, host and time
+
+A publish builds the artifact in a temporary directory next to its final
+path and renames it into place, so readers only ever see complete
+artifacts. When two hosts publish the same key at once the first rename
+wins and the other copy is discarded. Published artifacts are never
+modified so any number of readers can pull at the same time.
+
+pull() and publish() use the configured store and only log a warning when
+it can not be reached, since the store is an optimization and the build can
+always fall back to compiling.
+
+Usage:
+    key = artifacts.key('openssl', inputs)
+    if not artifacts.pull('openssl', key, payload_dir):
+        ...                                         build from source
+        artifacts.publish('openssl', key, payload_dir, {'inputs': inputs})
+    artifacts.publish('openssl', key, payload_dir, exclude=['cert.pem'])
+    artifacts.LocalStore('/Volumes/builds/artifacts').get('openssl', key)
+"""
+
+import errno
+import json
+import os
+import platform
+import shutil
+import socket
+import tempfile
+import time
+import urlparse
+
+from vendir import config
+from vendir import fingerprint
+from vendir import log
+from vendir import stage
+from vendir import trace
+
+CONFIG = config.ConfigSectionMap()
+
+META_FILE = 'meta.json'
+PAYLOAD_DIR = 'payload'
+
+
+def key(component, *inputs):
+    """
+    Return the artifact key of a component build.
+
+    The platform and architecture are part of the key so a payload is
+    only shared between hosts that can run it.
+    """
+    return fingerprint.digest(component, platform.system(),
+                              platform.machine(), inputs)
+
+
+def _remove(path):
+    """Remove a file or directory tree if it exists."""
+    if os.path.islink(path) or os.path.isfile(path):
+        os.remove(path)
+    elif os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def _excluded(paths):
+    """Return a stage.stage_tree() exclude function for paths or None."""
+    if not paths:
+        return None
+    paths = set(os.path.normpath(path.strip('/')) for path in paths)
+    return lambda rel: rel in paths
+
+
+class LocalStore(object):
+    """An artifact store in a local directory or on a network mount."""
+
+    def __init__(self, path):
+        """
+        Use the store at path. It is created on the first publish.
+
+        Args:
+          path: the store directory
+        """
+        self.path = os.path.abspath(path)
+
+    def __repr__(self):
+        """Return the store with its path."""
+        return "LocalStore('{}')".format(self.path)
+
+    def path_for(self, component, artifact_key):
+        """Return the directory the artifact is stored in."""
+        return os.path.join(self.path, component, artifact_key[:2],
+                            artifact_key)
+
+    def get(self, component, artifact_key):
+        """
+        Return the metadata of a published artifact or None.
+
+        An artifact without readable metadata is treated as missing.
+        """
+        path = self.path_for(component, artifact_key)
+        try:
+            with open(os.path.join(path, META_FILE)) as f:
+                meta = json.load(f)
+        except (IOError, ValueError):
+            log.debug("No '{}' artifact for '{}'".format(component,
+                                                         artifact_key))
+            return None
+        if not os.path.isdir(os.path.join(path, PAYLOAD_DIR)):
+            return None
+        return meta
+
+    def pull(self, component, artifact_key, dest):
+        """
+        Replace dest with the payload of a published artifact.
+
+        The payload is staged next to dest and renamed into place so dest
+        is never left half written. Files are reflinked when the store is
+        on the same filesystem and copied otherwise, never hardlinked, so
+        changes to dest can not reach the store.
+
+        Returns:
+          True when the artifact was pulled, False when it is not stored
+
+        """
+        meta = self.get(component, artifact_key)
+        if meta is None:
+            return False
+        source = os.path.join(self.path_for(component, artifact_key),
+                              PAYLOAD_DIR)
+        parent = os.path.dirname(os.path.abspath(dest))
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        staging = tempfile.mkdtemp(dir=parent, prefix='.tmp-')
+        started = time.time()
+        try:
+            with trace.span('artifact pull'):
+                stage.stage_tree(source, staging, mutable=True)
+            _remove(dest)
+            os.rename(staging, dest)
+        except (IOError, OSError):
+            _remove(staging)
+            raise
+        log.info("Pulled the '{}' payload built on {} at {} in "
+                 "{:.1f}s".format(component, meta.get('host', 'unknown'),
+                                  meta.get('created', 'unknown'),
+                                  time.time() - started))
+        return True
+
+    def publish(self, component, artifact_key, source, meta=None,
+                exclude=None):
+        """
+        Store the payload in source under artifact_key.
+
+        Args:
+          component: the component name, like 'openssl' or 'python2'
+          artifact_key: the key() of the inputs that built source
+          source: the payload directory
+          meta: extra JSON serializable metadata, like the build inputs
+          exclude: paths relative to source that are not stored, like
+              files written for this host only
+
+        Returns:
+          The artifact directory
+
+        """
+        path = self.path_for(component, artifact_key)
+        if self.get(component, artifact_key) is not None:
+            log.detail("The '{}' artifact '{}' is already published".format(
+                       component, artifact_key))
+            return path
+        parent = os.path.dirname(path)
+        if not os.path.isdir(parent):
+            try:
+                os.makedirs(parent)
+            except OSError as err:
+                # Another host may have created it in the meantime
+                if err.errno != errno.EEXIST:
+                    raise
+        staging = tempfile.mkdtemp(dir=parent, prefix='.tmp-')
+        try:
+            with trace.span('artifact publish'):
+                stage.stage_tree(source, os.path.join(staging, PAYLOAD_DIR),
+                                 mutable=True,
+                                 exclude=_excluded(exclude))
+            info = dict(meta or {})
+            info.update({'component': component,
+                         'key': artifact_key,
+                         'host': socket.gethostname(),
+                         'created': time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                                  time.gmtime())})
+            with open(os.path.join(staging, META_FILE), 'w') as f:
+                json.dump(info, f, indent=2, sort_keys=True)
+            os.chmod(staging, 0o755)
+            os.rename(staging, path)
+        except OSError as err:
+            _remove(staging)
+            # A concurrent publish of the same key won the rename
+            if err.errno in (errno.EEXIST, errno.ENOTEMPTY) and \
+                    self.get(component, artifact_key) is not None:
+                log.detail("The '{}' artifact '{}' was published by another "
+                           "build".format(component, artifact_key))
+                return path
+            raise
+        except (IOError, ValueError):
+            _remove(staging)
+            raise
+        log.info("Published the '{}' payload to '{}'".format(component, path))
+        return path
+
+
+# Store classes by URL scheme. A plain path is a local store.
+BACKENDS = {
+    '': LocalStore,
+    'file': LocalStore,
+}
+
+
+def store(location=None):
+    """
+    Return the artifact store from artifact_store in config.ini.
+
+    Returns:
+      The store or None when it is disabled or the scheme is unsupported
+
+    """
+    location = location if location is not None else \
+        CONFIG.get('artifact_store', '')
+    if not location:
+        return None
+    url = urlparse.urlparse(location)
+    backend = BACKENDS.get(url.scheme)
+    if backend is None:
+        log.warn("Unsupported artifact store '{}'. Building from "
+                 "source.".format(location))
+        return None
+    return backend(url.path if url.scheme else location)
+
+
+def pull(component, artifact_key, dest):
+    """
+    Pull a prebuilt payload from the configured store into dest.
+
+    Returns:
+      True when dest now holds the payload, False to build from source
+
+    """
+    artifact_store = store()
+    if artifact_store is None:
+        return False
+    try:
+        return artifact_store.pull(component, artifact_key, dest)
+    except (IOError, OSError) as err:
+        log.warn("Unable to pull the '{}' payload from {}: {}".format(
+                 component, artifact_store, err))
+        return False
+
+
+def publish(component, artifact_key, source, meta=None, exclude=None):
+    """
+    Publish a finished payload to the configured store.
+
+    Paths in exclude, relative to source, are left out of the artifact.
+
+    Returns:
+      The artifact path or None when the store is disabled or failed
+
+    """
+    artifact_store = store()
+    if artifact_store is None:
+        return None
+    try:
+        return artifact_store.publish(component, artifact_key, source, meta,
+                                      exclude)
+    except (IOError, OSError) as err:
+        log.warn("Unable to publish the '{}' payload to {}: {}".format(
+                 component, artifact_store, err))
+        return None
+
+
+if __name__ == '__main__':
+    print 'This is a library of support tools'
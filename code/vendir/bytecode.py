@@ -0,0 +1,207 @@
+"""
+Functions for byte-compiling a Python payload ahead of time.
+
+The payload only has the bytecode make install happened to write and none
+for the requirements pip installed. On a managed Mac the first import of
+every module then tries to write bytecode into root owned directories, and
+when it can not, every launch compiles again. compile_tree() compiles
+every source file below a directory with the payload's own interpreter,
+for each configured optimization level, split over a pool of compileall
+processes.
+
+The bytecode is deterministic. Hash randomization is turned off while
+compiling. With pkg_deterministic set, the source mtimes are first clamped
+to SOURCE_DATE_EPOCH, the same as the package will record, so the
+timestamps in the bytecode match the installed sources. Interpreters that
+support hash based bytecode (Python 3.7+) use checked hashes instead of
+timestamps.
+
+Usage:
+    stats = bytecode.compile_tree(python, lib_dir, levels=[0, 1])
+    stats['compiled'], stats['failed'], stats['seconds']
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from vendir import config
+from vendir import jobs
+from vendir import log
+from vendir import package
+from vendir import runner
+from vendir import trace
+
+CONFIG = config.ConfigSectionMap()
+
+# Prints the bytecode cache tag (empty on Python 2) and version
+INFO_SCRIPT = ("import json, sys; "
+               "print(json.dumps({'cache_tag': getattr(getattr("
+               "sys, 'implementation', None), 'cache_tag', None), "
+               "'version': list(sys.version_info[:2])}))")
+
+# Interpreter flags of each optimization level
+LEVEL_FLAGS = {0: [], 1: ['-O'], 2: ['-OO']}
+
+
+def levels():
+    """Return the optimization levels from python_bytecode_levels."""
+    value = CONFIG.get('python_bytecode_levels', '')
+    return sorted(set(int(level) for level in value.split(',')
+                      if level.strip()))
+
+
+def epoch():
+    """Return the mtime sources are clamped to or None to leave them."""
+    if package.deterministic():
+        return package.source_date_epoch()
+    return None
+
+
+def interpreter(python):
+    """Return the cache tag and (major, minor) version of an interpreter."""
+    out = runner.Popen([python, '-c', INFO_SCRIPT])
+    if out[2] != 0:
+        raise OSError("Unable to run '{}': {}".format(python, out[1]))
+    info = json.loads(out[0].strip().splitlines()[-1])
+    return info['cache_tag'], tuple(info['version'])
+
+
+def sources(root):
+    """Return every Python source file below root, sorted."""
+    found = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [name for name in dirnames if name != '__pycache__']
+        for name in filenames:
+            if name.endswith('.py'):
+                found.append(os.path.join(dirpath, name))
+    return sorted(found)
+
+
+def interpreter_levels(levels, cache_tag):
+    """
+    Return the levels that write distinct bytecode files.
+
+    Python 2 writes the .pyo of -O and -OO to the same path, so two
+    compileall processes would write the same files at once. Only the
+    highest of the two is kept.
+    """
+    levels = sorted(set(levels))
+    if not cache_tag and 1 in levels and 2 in levels:
+        log.detail("Python 2 writes -O and -OO bytecode to the same .pyo "
+                   "files. Only compiling for -OO.")
+        levels.remove(1)
+    return levels
+
+
+def bytecode_path(source, level, cache_tag):
+    """Return where the bytecode of source is written for a level."""
+    if not cache_tag:
+        # Python 2 writes .pyc, and .pyo for both -O and -OO
+        return source + ('c' if level == 0 else 'o')
+    head, tail = os.path.split(source)
+    suffix = '.opt-{}'.format(level) if level else ''
+    return os.path.join(head, '__pycache__', '{}.{}{}.pyc'.format(
+                        os.path.splitext(tail)[0], cache_tag, suffix))
+
+
+def clamp_mtimes(files, mtime):
+    """Set the mtime of every file newer than mtime to mtime."""
+    for path in files:
+        if os.lstat(path).st_mtime > mtime:
+            os.utime(path, (mtime, mtime))
+
+
+def _chunks(files, count):
+    """Split files into count lists of about the same total size."""
+    chunks = [[] for _ in range(count)]
+    totals = [0] * count
+    for path in sorted(files, key=os.path.getsize, reverse=True):
+        index = totals.index(min(totals))
+        chunks[index].append(path)
+        totals[index] += os.path.getsize(path)
+    return [chunk for chunk in chunks if chunk]
+
+
+def compile_tree(python, root, levels=(0,), workers=None):
+    """
+    Byte-compile every source file below root with python.
+
+    Args:
+      python: the interpreter the payload runs on
+      root: the directory to compile, like lib/python2.7
+      levels: the optimization levels to write bytecode for
+      workers: compileall processes run at once. Defaults to the make job
+          count.
+
+    Returns:
+      A dict with the number of 'sources', bytecode files 'compiled' and
+      'failed' (usually test files with deliberate syntax errors), the
+      'workers' used and the 'seconds' it took
+
+    """
+    started = time.time()
+    cache_tag, version = interpreter(python)
+    levels = interpreter_levels(levels, cache_tag)
+    files = sources(root)
+    stats = {'sources': len(files), 'compiled': 0, 'failed': 0,
+             'workers': 0, 'seconds': 0.0}
+    if not files or not levels:
+        return stats
+    mtime = epoch()
+    if mtime is not None:
+        clamp_mtimes(files, mtime)
+    if workers is None:
+        workers = jobs.make_jobs()
+    chunks = _chunks(files, max(1, min(workers, len(files))))
+    stats['workers'] = len(chunks)
+    options = ['-q', '-f']
+    if version >= (3, 7):
+        options += ['--invalidation-mode', 'checked-hash']
+    env = dict(os.environ)
+    env['PYTHONHASHSEED'] = '0'
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    lists = tempfile.mkdtemp(prefix='bytecode-')
+    try:
+        cmds = []
+        for index, chunk in enumerate(chunks):
+            list_file = os.path.join(lists, '{}.txt'.format(index))
+            with open(list_file, 'w') as f:
+                f.write('\n'.join(chunk) + '\n')
+            for level in levels:
+                cmds.append([python] + LEVEL_FLAGS[level] +
+                            ['-m', 'compileall'] + options +
+                            ['-i', list_file])
+        with trace.span('bytecode', files=len(files), levels=list(levels)):
+            results = runner.run_many(cmds, limit=len(chunks), env=env)
+    finally:
+        shutil.rmtree(lists, ignore_errors=True)
+    for result in results:
+        if not result.ok:
+            log.debug("compileall reported errors: {}".format(
+                      result.output))
+    for level in levels:
+        for source in files:
+            if os.path.isfile(bytecode_path(source, level, cache_tag)):
+                stats['compiled'] += 1
+            else:
+                stats['failed'] += 1
+    stats['seconds'] = time.time() - started
+    return stats
+
+
+def report(stats):
+    """Log the result of compile_tree()."""
+    log.info("Byte-compiled {} source files into {} bytecode files with {} "
+             "workers in {:.1f}s".format(stats['sources'], stats['compiled'],
+                                         stats['workers'], stats['seconds']))
+    if stats['failed']:
+        log.detail("{} bytecode files could not be written. Usually these "
+                   "are test files with deliberate syntax errors.".format(
+                       stats['failed']))
+
+
+if __name__ == '__main__':
+    print 'This is a library of support tools'
@@ -0,0 +1,192 @@
+"""
+Functions for a local download cache.
+
+Distribution tarballs are stored by their sha256 hash. Any setup script that
+knows the expected hash from config.ini can check the cache before going to
+the network. The cache is trimmed to a size cap, least recently used first.
+
+Usage:
+    path = cache.get(sha256)             None when not cached
+    path = cache.put(filename, sha256)   move a verified file into the cache
+    cache.evict()                        trim the cache to its size cap
+"""
+
+import os
+import shutil
+import tempfile
+
+from vendir import config
+from vendir import hash_helper
+from vendir import log
+
+CONFIG = config.ConfigSectionMap()
+
+
+def cache_dir():
+    """Return the cache directory or None when the cache is disabled."""
+    path = CONFIG.get('download_cache_dir', '')
+    if not path:
+        return None
+    return os.path.abspath(path)
+
+
+def max_bytes():
+    """Return the cache size cap in bytes or None for no cap."""
+    size = CONFIG.get('download_cache_size_mb', '')
+    if not size:
+        return None
+    return int(size) * 1024 * 1024
+
+
+def path_for(sha256):
+    """Return the path a file with the given sha256 hash is cached at."""
+    sha256 = sha256.lower()
+    return os.path.join(cache_dir(), sha256[:2], sha256)
+
+
+def get(sha256, verify=True):
+    """
+    Return the path of a cached file matching sha256.
+
+    The cached copy is verified before it is returned so a corrupt entry is
+    treated as a miss and removed. Callers that hash the file themselves while
+    reading it can pass verify=False and call remove() on a mismatch. A hit
+    refreshes the modification time which is what the LRU eviction sorts on.
+
+    Returns:
+      The cached file path or None
+
+    """
+    if not cache_dir() or not sha256:
+        return None
+    path = path_for(sha256)
+    if not os.path.isfile(path):
+        log.debug("Cache miss for '{}'".format(sha256))
+        return None
+    if verify and hash_helper.getsha256hash(path) != sha256.lower():
+        log.warn("Cached file '{}' is corrupt. Removing it.".format(path))
+        _remove(path)
+        return None
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+    log.debug("Cache hit for '{}'".format(sha256))
+    return path
+
+
+def temp_file():
+    """
+    Return an open (fd, path) pair for a new file inside the cache.
+
+    Writing a download here lets put() rename it into place without copying.
+    Returns (None, None) when the cache is disabled or not writable.
+    """
+    if not cache_dir():
+        return (None, None)
+    try:
+        if not os.path.isdir(cache_dir()):
+            os.makedirs(cache_dir())
+        return tempfile.mkstemp(dir=cache_dir(), prefix='.tmp-')
+    except (IOError, OSError) as err:
+        log.warn("Unable to write to the download cache: {}".format(err))
+        return (None, None)
+
+
+def remove(sha256):
+    """Remove the cache entry for sha256 if there is one."""
+    if not cache_dir() or not sha256:
+        return False
+    return _remove(path_for(sha256))
+
+
+def put(filename, sha256):
+    """
+    Move a verified file into the cache.
+
+    The file is first moved to a temporary name inside the cache and then
+    renamed into place so readers never see a partial entry. The caller is
+    responsible for verifying the hash before calling this function.
+
+    Returns:
+      The path the file can now be read from. This is the original filename
+      when the cache is disabled or the move failed.
+
+    """
+    if not cache_dir() or not sha256:
+        return filename
+    path = path_for(sha256)
+    parent = os.path.dirname(path)
+    try:
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        fd, temp_path = tempfile.mkstemp(dir=parent, prefix='.tmp-')
+        os.close(fd)
+        shutil.move(filename, temp_path)
+        os.chmod(temp_path, 0o644)
+        os.rename(temp_path, path)
+    except (IOError, OSError) as err:
+        log.warn("Unable to add '{}' to the download cache: {}".format(
+                 filename, err))
+        return filename if os.path.isfile(filename) else None
+    log.detail("Added '{}' to the download cache".format(sha256))
+    # Never evict the entry just added, even when it is over the cap alone
+    evict(keep=path)
+    return path
+
+
+def evict(limit=None, keep=None):
+    """
+    Trim the cache to `limit` bytes by removing the least recently used files.
+
+    Args:
+      limit: size cap in bytes. Defaults to download_cache_size_mb.
+      keep: a cached file path that is never removed
+
+    Returns:
+      The number of bytes removed
+
+    """
+    if not cache_dir() or not os.path.isdir(cache_dir()):
+        return 0
+    if limit is None:
+        limit = max_bytes()
+    if limit is None:
+        return 0
+    entries = []
+    total = 0
+    for dirpath, _, filenames in os.walk(cache_dir()):
+        for name in filenames:
+            if name.startswith('.tmp-'):
+                continue
+            path = os.path.join(dirpath, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+    removed = 0
+    for _, size, path in sorted(entries):
+        if total <= limit:
+            break
+        if path == keep:
+            continue
+        log.detail("Evicting '{}' from the download cache".format(path))
+        if _remove(path):
+            total -= size
+            removed += size
+    return removed
+
+
+def _remove(path):
+    """Remove a cache entry and ignore it if it is already gone."""
+    try:
+        os.remove(path)
+    except OSError:
+        return False
+    return True
+
+
+if __name__ == '__main__':
+    print 'This is a library of support tools'
@@ -0,0 +1,146 @@
+"""
+Functions for building with an opt-in compiler cache (ccache).
+
+When compiler_cache in config.ini points at a ccache binary, activate()
+puts a directory of cc/gcc/clang symlinks to ccache at the front of PATH.
+Every compiler call made by configure, make or the setup scripts themselves
+then goes through the cache while the configured compiler stays plain `cc`,
+so nothing ccache specific is baked into the installed Python's sysconfig.
+
+ccache falls back to hashing the preprocessed source when the command line
+changes, so a different base_install_path in -I flags still hits the cache
+as long as the preprocessed output is the same.
+
+Usage:
+    before = ccache.activate(build_dir)
+    ...
+    ccache.report(before)
+"""
+
+import os
+import re
+import subprocess
+
+from vendir import config
+from vendir import log
+
+CONFIG = config.ConfigSectionMap()
+
+# Compiler names that are redirected through ccache
+COMPILERS = ['cc', 'gcc', 'clang', 'c++', 'g++', 'clang++']
+
+# `ccache --print-stats` keys (ccache 4) and `ccache -s` labels (ccache 3)
+STATS = {
+    'hits': (['direct_cache_hit', 'preprocessed_cache_hit'],
+             ['cache hit (direct)', 'cache hit (preprocessed)']),
+    'misses': (['cache_miss'], ['cache miss']),
+}
+
+
+def ccache_path():
+    """Return the ccache binary or None when the compiler cache is off."""
+    path = CONFIG.get('compiler_cache', '')
+    if not path:
+        return None
+    if not os.access(path, os.X_OK):
+        log.warn("compiler_cache '{}' is not executable. Building without "
+                 "it.".format(path))
+        return None
+    return path
+
+
+def enabled():
+    """Return True when the compiler cache is configured."""
+    return ccache_path() is not None
+
+
+def _masquerade_dir():
+    """Create and return the directory of compiler symlinks to ccache."""
+    path = os.path.join(CONFIG['compiler_cache_dir'], 'bin')
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    for name in COMPILERS:
+        link = os.path.join(path, name)
+        if os.path.islink(link) and os.readlink(link) == ccache_path():
+            continue
+        if os.path.lexists(link):
+            os.remove(link)
+        os.symlink(ccache_path(), link)
+    return path
+
+
+def activate(base_dir=None):
+    """
+    Route compiler calls from this process and its children through ccache.
+
+    Args:
+      base_dir: absolute paths below this directory are hashed as relative
+          paths so the cache is shared between build directories.
+
+    Returns:
+      The statistics before the build, for report(). None when disabled.
+
+    """
+    if not enabled():
+        return None
+    bin_dir = _masquerade_dir()
+    path = os.environ.get('PATH', '').split(os.pathsep)
+    if bin_dir not in path:
+        os.environ['PATH'] = os.pathsep.join([bin_dir] + path)
+    os.environ['CCACHE_DIR'] = CONFIG['compiler_cache_dir']
+    if CONFIG.get('compiler_cache_size'):
+        os.environ['CCACHE_MAXSIZE'] = CONFIG['compiler_cache_size']
+    # Do not hash the working directory so different build dirs share hits
+    os.environ['CCACHE_NOHASHDIR'] = '1'
+    if base_dir:
+        os.environ['CCACHE_BASEDIR'] = base_dir
+    log.detail("Compiling through ccache at '{}'".format(ccache_path()))
+    return stats()
+
+
+def stats():
+    """Return a dict with the ccache hit and miss counters."""
+    counters = dict((key, 0) for key in STATS)
+    proc = subprocess.Popen([ccache_path(), '--print-stats'],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output = proc.communicate()[0]
+    if proc.returncode == 0:
+        values = dict(line.split('\t', 1) for line in output.splitlines()
+                      if '\t' in line)
+        for key, (names, _) in STATS.items():
+            counters[key] = sum(int(values.get(name, 0)) for name in names)
+        return counters
+    # ccache 3 only has the human readable summary
+    proc = subprocess.Popen([ccache_path(), '-s'],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output = proc.communicate()[0]
+    for key, (_, labels) in STATS.items():
+        for label in labels:
+            match = re.search(r'^{}\s+(\d+)'.format(re.escape(label)),
+                              output, re.MULTILINE)
+            if match:
+                counters[key] += int(match.group(1))
+    return counters
+
+
+def report(before):
+    """
+    Log the cache hits and misses since activate().
+
+    The counters are shared by every build using the same cache so
+    components built at the same time are counted together.
+    """
+    if before is None or not enabled():
+        return None
+    after = stats()
+    hits = after['hits'] - before['hits']
+    misses = after['misses'] - before['misses']
+    total = hits + misses
+    rate = 100.0 * hits / total if total else 0.0
+    log.info("Compiler cache: {} hits, {} misses ({:.1f}% hit rate)".format(
+             hits, misses, rate))
+    return {'hits': hits, 'misses': misses}
+
+
+if __name__ == '__main__':
+    print 'This is a library of support tools'
@@ -0,0 +1,290 @@
+"""
+Functions for writing the CA certificates of the vendored OpenSSL.
+
+OpenSSL loads a CA file like cert.pem completely when a TLS context is
+created, so every short lived tool parses every root certificate on start.
+A hashed CA directory is only read on demand: OpenSSL looks up the issuer
+of a certificate as `<subject hash>.<n>` in it. write_hashed_dir() builds
+that directory from a PEM bundle the way c_rehash does, in process, with
+one PEM file per certificate and a `<hash>.<n>` symlink to it.
+
+The subject hash is the one of `openssl x509 -subject_hash` in OpenSSL
+1.0.0 and later: the first four bytes, little endian, of the sha1 digest of
+the canonical encoding of the subject name. String values are converted to
+lower case UTF-8 with the whitespace collapsed.
+
+The directory is only written again when the bundle changed. A marker with
+the sha256 digest of the bundle is kept in it.
+
+cert_source in config.ini selects where the certificates come from:
+`keychain` exports the macOS System Root keychain, a path or file:// URL
+reads a PEM bundle, like /etc/ssl/certs/ca-certificates.crt on Linux.
+
+Usage:
+    pem = certs.bundle()
+    certs.write_hashed_dir(pem, '/Library/vendored/openssl/certs')
+    certs.subject_hash(der)                         '5ad8a5d6'
+"""
+
+import base64
+import hashlib
+import os
+import re
+import shutil
+import struct
+import tempfile
+import urlparse
+
+from vendir import config
+from vendir import log
+from vendir import runner
+from vendir import trace
+
+CONFIG = config.ConfigSectionMap()
+
+KEYCHAIN = '/System/Library/Keychains/SystemRootCertificates.keychain'
+MARKER = '.bundle.sha256'
+PEM_RE = re.compile(r'-----BEGIN CERTIFICATE-----(.+?)'
+                    r'-----END CERTIFICATE-----', re.DOTALL)
+
+# DER tags
+SEQUENCE = 0x30
+SET = 0x31
+UTF8STRING = 0x0c
+VERSION = 0xa0
+# String types OpenSSL canonicalizes, with the codec of their contents
+STRING_CODECS = {
+    0x0c: 'utf-8',          # UTF8String
+    0x13: 'latin-1',        # PrintableString
+    0x14: 'latin-1',        # T61String
+    0x16: 'latin-1',        # IA5String
+    0x1a: 'latin-1',        # VisibleString
+    0x1c: 'utf-32-be',      # UniversalString
+    0x1e: 'utf-16-be',      # BMPString
+}
+# isspace() of the C locale
+WHITESPACE = ' \t\n\v\f\r'
+
+
+def _keychain():
+    """Return the macOS System Root certificates as PEM."""
+    cmd = ['/usr/bin/security', 'find-certificate', '-a', '-p', KEYCHAIN]
+    out = runner.Popen(cmd)
+    if out[2] != 0:
+        raise OSError("Unable to export '{}': {}".format(KEYCHAIN, out[1]))
+    return out[0]
+
+
+def _file(path):
+    """Return the PEM bundle at path."""
+    with open(path) as f:
+        return f.read()
+
+
+# cert_source values that are not a path
+SOURCES = {
+    'keychain': _keychain,
+}
+
+
+def bundle(source=None):
+    """
+    Return the CA certificates of cert_source as a PEM bundle.
+
+    Raises:
+      IOError, OSError: the source could not be read
+
+    """
+    source = source or CONFIG.get('cert_source') or 'keychain'
+    if source in SOURCES:
+        return SOURCES[source]()
+    url = urlparse.urlparse(source)
+    return _file(url.path if url.scheme == 'file' else source)
+
+
+def certificates(pem):
+    """Return the DER encoding of every certificate in a PEM bundle."""
+    ders = []
+    for match in PEM_RE.finditer(pem):
+        try:
+            ders.append(base64.b64decode(''.join(match.group(1).split())))
+        except TypeError:
+            log.warn("Skipping a certificate that is not base64")
+    return ders
+
+
+def to_pem(der):
+    """Return a DER certificate as PEM."""
+    data = base64.b64encode(der)
+    lines = [data[i:i + 64] for i in range(0, len(data), 64)]
+    return ('-----BEGIN CERTIFICATE-----\n' + '\n'.join(lines) +
+            '\n-----END CERTIFICATE-----\n')
+
+
+def _read(data, offset):
+    """
+    Read the DER element at offset.
+
+    Returns:
+      (tag, contents, offset of the next element)
+
+    """
+    if offset + 2 > len(data):
+        raise ValueError('Truncated DER element')
+    tag = ord(data[offset])
+    length = ord(data[offset + 1])
+    offset += 2
+    if length & 0x80:
+        count = length & 0x7f
+        if not count or offset + count > len(data):
+            raise ValueError('Invalid DER length')
+        length = int(data[offset:offset + count].encode('hex'), 16)
+        offset += count
+    if offset + length > len(data):
+        raise ValueError('Truncated DER element')
+    return tag, data[offset:offset + length], offset + length
+
+
+def _encode(tag, contents):
+    """Return the DER element of tag with contents."""
+    length = len(contents)
+    if length < 0x80:
+        return chr(tag) + chr(length) + contents
+    size = '{:x}'.format(length)
+    size = ('0' * (len(size) % 2) + size).decode('hex')
+    return chr(tag) + chr(0x80 | len(size)) + size + contents
+
+
+def subject(der):
+    """Return the contents of the subject Name of a DER certificate."""
+    _, cert, _ = _read(der, 0)
+    _, tbs, _ = _read(cert, 0)
+    tag, _, offset = _read(tbs, 0)
+    if tag != VERSION:
+        offset = 0
+    # serialNumber, signature, issuer and validity come first
+    for _ in range(4):
+        _, _, offset = _read(tbs, offset)
+    tag, name, _ = _read(tbs, offset)
+    if tag != SEQUENCE:
+        raise ValueError('The subject is not a Name')
+    return name
+
+
+def _canonical(text):
+    """Lower case ASCII and collapse whitespace like asn1_string_canon()."""
+    out = []
+    space = False
+    for char in text.strip(WHITESPACE):
+        if ord(char) & 0x80:
+            out.append(char)
+            space = False
+        elif char in WHITESPACE:
+            if not space:
+                out.append(' ')
+            space = True
+        else:
+            out.append(char.lower())
+            space = False
+    return ''.join(out)
+
+
+def canonical_name(name):
+    """Return the canonical encoding of the contents of a Name."""
+    encoded = []
+    offset = 0
+    while offset < len(name):
+        _, rdn, offset = _read(name, offset)
+        entries = []
+        rdn_offset = 0
+        while rdn_offset < len(rdn):
+            _, ava, rdn_offset = _read(rdn, rdn_offset)
+            _, _, value_offset = _read(ava, 0)
+            tag, value, _ = _read(ava, value_offset)
+            if tag in STRING_CODECS:
+                text = value.decode(STRING_CODECS[tag]).encode('utf-8')
+                value = _encode(UTF8STRING, _canonical(text))
+            else:
+                value = ava[value_offset:]
+            entries.append(_encode(SEQUENCE, ava[:value_offset] + value))
+        # DER sorts the members of a SET OF by their encoding
+        encoded.append(_encode(SET, ''.join(sorted(entries))))
+    return ''.join(encoded)
+
+
+def subject_hash(der):
+    """
+    Return the OpenSSL subject hash of a DER certificate.
+
+    Raises:
+      ValueError: the certificate could not be parsed
+
+    """
+    digest = hashlib.sha1(canonical_name(subject(der))).digest()
+    return '{:08x}'.format(struct.unpack('<I', digest[:4])[0])
+
+
+def write_hashed_dir(pem, dest):
+    """
+    Write the certificates of a PEM bundle into a c_rehash style directory.
+
+    Certificates that are in the bundle more than once are only written
+    once. Certificates with the same subject hash get the next free
+    `<hash>.<n>`. dest is replaced as a whole so a reader never sees it
+    half written.
+
+    Returns:
+      The number of certificates in dest or None when it was up to date
+
+    """
+    digest = hashlib.sha256(pem).hexdigest()
+    try:
+        with open(os.path.join(dest, MARKER)) as f:
+            if f.read().strip() == digest:
+                log.detail("The hashed certificates in '{}' are up to "
+                           "date".format(dest))
+                return None
+    except IOError:
+        pass
+    parent = os.path.dirname(os.path.abspath(dest))
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    staging = tempfile.mkdtemp(dir=parent, prefix='.tmp-')
+    try:
+        written = set()
+        counts = {}
+        with trace.span('hashed certs'):
+            for der in certificates(pem):
+                fingerprint = hashlib.sha1(der).hexdigest()
+                if fingerprint in written:
+                    continue
+                try:
+                    name_hash = subject_hash(der)
+                except (ValueError, UnicodeError) as err:
+                    log.warn("Skipping a certificate that could not be "
+                             "parsed: {}".format(err))
+                    continue
+                written.add(fingerprint)
+                filename = fingerprint + '.pem'
+                with open(os.path.join(staging, filename), 'w') as f:
+                    f.write(to_pem(der))
+                index = counts.get(name_hash, 0)
+                counts[name_hash] = index + 1
+                os.symlink(filename, os.path.join(
+                    staging, '{}.{}'.format(name_hash, index)))
+        with open(os.path.join(staging, MARKER), 'w') as f:
+            f.write(digest + '\n')
+        os.chmod(staging, 0o755)
+        if os.path.isdir(dest):
+            shutil.rmtree(dest)
+        os.rename(staging, dest)
+    finally:
+        if os.path.isdir(staging):
+            shutil.rmtree(staging, ignore_errors=True)
+    log.info("Wrote {} hashed certificates to '{}'".format(len(written),
+                                                           dest))
+    return len(written)
+
+
+if __name__ == '__main__':
+    print 'This is a library of support tools'
@@ -0,0 +1,207 @@
+"""
+Functions for sharing identical files between component payloads.
+
+The OpenSSL, Python 2, Python 3 and tlsssl payloads each carry their own
+copy of files that are byte for byte identical, like license texts,
+headers, certificate bundles and pure Python requirements installed into
+both Pythons. find() groups the files of every payload by the sha256
+digest, size and mode already recorded in the package manifests (see
+vendir.manifest), so nothing is hashed again, and report() logs how many
+bytes the copies take.
+
+With the tar backend, combine() writes every payload into one archive
+where the first copy of each group is stored and every later copy is a
+hardlink to it. Both the archive and the installed footprint shrink, since
+`tar -x` recreates the hardlinks. A native pkgbuild package can not link
+to files of another package, so for pkgbuild the savings are only
+reported.
+
+A Python source file is only linked to one with the same mtime unless
+pkg_deterministic clamps them all, since bytecode is checked against the
+mtime of its source.
+
+Usage:
+    dedup.run(['openssl/openssl-1.0.2o.pkg.manifest.json', ...],
+              'build/vendored.pkg')                 vendored.tar.gz for tar
+    groups = dedup.find(dedup.load(manifest_paths))
+"""
+
+import os
+
+from vendir import fingerprint
+from vendir import log
+from vendir import manifest
+from vendir import package
+from vendir import trace
+
+# Smaller files are not worth a group
+MIN_SIZE = 1
+
+
+def load(manifest_paths):
+    """
+    Return the payloads described by package manifests.
+
+    Manifests that are missing, or were written before they recorded the
+    payload root, are skipped with a warning.
+
+    Returns:
+      A list of dicts with the package 'name', payload 'root',
+      'install_location' and manifest 'files'
+
+    """
+    payloads = []
+    for path in manifest_paths:
+        data = manifest.load(path)
+        if data is None or not os.path.isdir(data.get('root') or ''):
+            log.warn("No payload found for '{}'. Package it again to share "
+                     "its files.".format(path))
+            continue
+        payloads.append({
+            'name': os.path.basename(path)[:-len(manifest.SUFFIX)],
+            'root': data['root'],
+            'install_location': data['meta'].get('install_location', '/'),
+            'files': data['files'],
+        })
+    return payloads
+
+
+def _key(root, rel, entry, epoch):
+    """Return the content key of a manifest file entry."""
+    key = [entry['sha256'], entry['size'], entry['mode']]
+    if epoch is None and rel.endswith('.py'):
+        key.append(int(os.lstat(os.path.join(root, rel)).st_mtime))
+    return ':'.join(str(part) for part in key)
+
+
+def find(payloads, epoch=None):
+    """
+    Group the identical files of payloads.
+
+    Args:
+      epoch: the SOURCE_DATE_EPOCH of deterministic packages or None
+
+    Returns:
+      A list of groups with more than one file, largest savings first.
+      Each group is a dict with the content 'key', the file 'size' and
+      the absolute 'paths' and install 'locations' of the files.
+
+    """
+    groups = {}
+    for payload in payloads:
+        root = payload['root']
+        for rel, entry in sorted(payload['files'].items()):
+            if entry.get('type') != 'file' or 'sha256' not in entry or \
+                    entry.get('size', 0) < MIN_SIZE:
+                continue
+            key = _key(root, rel, entry, epoch)
+            group = groups.setdefault(key, {'key': key,
+                                            'size': entry['size'],
+                                            'paths': [], 'locations': []})
+            group['paths'].append(os.path.join(root, rel))
+            group['locations'].append(os.path.join(
+                payload['install_location'], rel))
+    shared = [found for found in groups.values() if len(found['paths']) > 1]
+    return sorted(shared, key=lambda found: (
+        -found['size'] * (len(found['paths']) - 1), found['key']))
+
+
+def shareable(groups):
+    """Return the bytes taken by every copy but the first of each group."""
+    return sum(group['size'] * (len(group['paths']) - 1) for group in groups)
+
+
+def links(groups):
+    """Return the path -> content key dict package.write_combined_tar uses."""
+    return dict((path, group['key']) for group in groups
+                for path in group['paths'])
+
+
+def report(groups, payloads, top=10):
+    """Log how many bytes identical files take and the largest groups."""
+    total = sum(entry.get('size', 0) for payload in payloads
+                for entry in payload['files'].values()
+                if entry.get('type') == 'file')
+    saved = shareable(groups)
+    log.info("{} payloads: {} files in {} groups are identical. {:.2f} MB "
+             "of {:.2f} MB could be shared ({:.1f}%)".format(
+                 len(payloads), sum(len(group['paths']) for group in groups),
+                 len(groups), saved / 2.0**20, total / 2.0**20,
+                 100.0 * saved / total if total else 0.0))
+    for group in groups[:top]:
+        log.detail("  {:.1f} KB x {}: {}".format(
+                   group['size'] / 2.0**10, len(group['paths']),
+                   ', '.join(group['locations'])))
+
+
+def combine(payloads, groups, output, epoch=None):
+    """
+    Write every payload into one compressed tar archive at output.
+
+    The archive is not written again when it exists and the payloads are
+    the same as last time.
+
+    Returns:
+      0 on success, otherwise an exit code
+
+    """
+    state_path = manifest.path_for(output)
+    meta = {'payloads': [fingerprint.digest(payload['install_location'],
+                                            payload['files'])
+                         for payload in payloads],
+            'epoch': epoch, 'compression': package.compression()}
+    previous = manifest.load(state_path)
+    if os.path.isfile(output) and previous and previous.get('meta') == meta:
+        log.info("Payloads of '{}' are unchanged. Skipping it.".format(
+                 output))
+        return 0
+    parent = os.path.dirname(os.path.abspath(output))
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    with trace.span('combine', output=output):
+        rc = package.compress(output, lambda fileobj: (
+            package.write_combined_tar(
+                [(payload['root'], payload['install_location'])
+                 for payload in payloads],
+                fileobj, epoch=epoch, links=links(groups))),
+            reproducible=epoch is not None)
+    if rc == 0:
+        manifest.write(state_path, {'meta': meta, 'files': {}})
+        log.info("Wrote the combined archive '{}' with {} hardlinked "
+                 "files".format(output, sum(len(group['paths']) - 1
+                                            for group in groups)))
+    elif os.path.isfile(state_path):
+        os.remove(state_path)
+    return rc
+
+
+def run(manifest_paths, output):
+    """
+    Report the files the packages share and combine them for tar.
+
+    Args:
+      manifest_paths: the manifests of the component packages, in the
+          order their payloads are written to the combined archive
+      output: the combined package path. Its extension is changed by
+          package.output_path().
+
+    Returns:
+      0 on success, otherwise an exit code
+
+    """
+    payloads = load(manifest_paths)
+    if not payloads:
+        return 0
+    epoch = package.source_date_epoch() if package.deterministic() else None
+    with trace.span('dedup', payloads=len(payloads)):
+        groups = find(payloads, epoch)
+    report(groups, payloads)
+    if package.backend_name() != 'tar':
+        log.detail("{} packages can not share files. Use the tar backend "
+                   "for a combined archive.".format(package.backend_name()))
+        return 0
+    return combine(payloads, groups, package.output_path(output), epoch)
+
+
+if __name__ == '__main__':
+    print 'This is a library of support tools'
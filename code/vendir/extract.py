@@ -0,0 +1,487 @@
+"""
+Functions for extracting a tar archive in process with member filters.
+
+Extracting with tar unpacks every member, including trees a build never
+reads like CPython's Doc/ and Lib/test or OpenSSL's test/. extract() reads
+the archive with tarfile instead:
+
+* Members lose their first strip_components path components, like
+  `tar --strip-components`. Members with nothing left are skipped.
+* A member is extracted when it, or a directory above it, matches an
+  include pattern (every member when there are none) and none of them
+  match an exclude pattern. Patterns are shell patterns on the stripped
+  path, so `Lib/test` leaves out everything below it.
+* Absolute paths, `..` components and links pointing outside the
+  destination, directly or through a chain of symlinks, raise
+  ExtractError. Symlinks are only created after every file is written, so
+  no file can be written through one.
+* Small files are read into memory and written, chmodded and timestamped
+  by a pool of writer threads while the next members are read. Large files
+  are copied in 1 MB blocks. The amount of data read ahead of the writers
+  is bounded.
+
+The archive is decompressed by an external process, so decompression runs
+on another core next to the extraction: pigz or gzip, bzip2, xz, or
+bsdtar (the macOS tar) for xz when there is no xz. tarfile decompresses
+gz and bz2 itself when no tool is found.
+
+The members each component leaves out are set by <component>_extract_exclude
+in config.ini.
+
+Usage:
+    with open('Python-2.7.14.tar.xz', 'rb') as f:
+        stats = extract.extract(f, 'Python-2.7.14.tar.xz', dest,
+                                strip_components=1,
+                                exclude=['Doc', 'Lib/test'])
+    stats['files'], stats['bytes'], stats['skipped']
+    extract.excludes('python')                      ['Doc', 'Lib/test']
+"""
+
+from distutils.spawn import find_executable
+import fnmatch
+import os
+import posixpath
+import Queue
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+
+from vendir import config
+from vendir import log
+from vendir import runner
+
+CONFIG = config.ConfigSectionMap()
+
+# Size of each read and write
+BUFFER_SIZE = 2**20
+# Members up to this size are written by the writer pool
+SMALL_FILE = 2**22
+# Most bytes read ahead of the writer pool
+MAX_PENDING = 2**26
+# Most symlinks followed when resolving a path, like SYMLOOP_MAX
+MAX_LINK_DEPTH = 40
+# Writer threads. File creation is bound by metadata operations, not by
+# the CPU, so this is not tied to the CPU count.
+WORKERS = 8
+
+# Decompressors tried in order for each archive extension
+DECOMPRESSORS = {
+    '.gz': [['pigz', '-d', '-c'], ['gzip', '-d', '-c']],
+    '.tgz': [['pigz', '-d', '-c'], ['gzip', '-d', '-c']],
+    '.bz2': [['bzip2', '-d', '-c']],
+    '.xz': [['xz', '-d', '-c'], ['bsdtar', '-c', '-f', '-', '@-']],
+}
+# tarfile stream modes used when no decompressor is found
+STREAM_MODES = {
+    '.gz': 'r|gz',
+    '.tgz': 'r|gz',
+    '.bz2': 'r|bz2',
+}
+
+
+class ExtractError(Exception):
+    """Raised when an archive could not be extracted."""
+
+
+def excludes(component):
+    """Return the patterns of <component>_extract_exclude in config.ini."""
+    value = CONFIG.get('{}_extract_exclude'.format(component), '')
+    return value.replace(',', ' ').split()
+
+
+def _extension(name):
+    """Return the compression extension of an archive name or ''."""
+    for ext in DECOMPRESSORS:
+        if name.endswith(ext):
+            return ext
+    return ''
+
+
+def decompressor_cmd(name):
+    """Return the decompressor command for an archive name or None."""
+    for cmd in DECOMPRESSORS.get(_extension(name), []):
+        path = find_executable(cmd[0])
+        if path:
+            return [path] + cmd[1:]
+    return None
+
+
+def member_path(name, strip_components=0):
+    """
+    Return the path a member is extracted to, relative to the destination.
+
+    Returns:
+      The path or None when stripping leaves nothing
+
+    Raises:
+      ExtractError: the member is outside the destination
+
+    """
+    if name.startswith('/'):
+        raise ExtractError("Refusing the absolute member '{}'".format(name))
+    parts = [part for part in name.split('/') if part and part != '.']
+    if '..' in parts:
+        raise ExtractError("Refusing the member '{}' with '..'".format(name))
+    if len(parts) <= strip_components:
+        return None
+    return '/'.join(parts[strip_components:])
+
+
+def matches(path, patterns):
+    """Return True when path or a directory above it matches a pattern."""
+    parts = path.split('/')
+    for index in range(1, len(parts) + 1):
+        prefix = '/'.join(parts[:index])
+        if any(fnmatch.fnmatchcase(prefix, pattern) for pattern in patterns):
+            return True
+    return False
+
+
+def selected(path, include=None, exclude=None):
+    """Return True when path passes the include and exclude patterns."""
+    if include and not matches(path, include):
+        return False
+    return not (exclude and matches(path, exclude))
+
+
+def _write_file(path, data, mode, mtime):
+    """Write a file and set its mode and mtime."""
+    with open(path, 'wb', BUFFER_SIZE) as f:
+        f.write(data)
+    os.chmod(path, mode)
+    os.utime(path, (mtime, mtime))
+
+
+class Writers(object):
+    """A pool of threads writing small files."""
+
+    def __init__(self, workers=WORKERS, max_pending=MAX_PENDING):
+        """Start workers threads with at most max_pending bytes queued."""
+        self.max_pending = max_pending
+        self.pending = 0
+        self.errors = []
+        self._cond = threading.Condition()
+        self._queue = Queue.Queue()
+        self._threads = [threading.Thread(target=self._run)
+                         for _ in range(workers)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def _run(self):
+        while 1:
+            item = self._queue.get()
+            if item is None:
+                return
+            try:
+                _write_file(*item)
+            except (IOError, OSError) as err:
+                with self._cond:
+                    self.errors.append(err)
+            finally:
+                with self._cond:
+                    self.pending -= len(item[1])
+                    self._cond.notify_all()
+
+    def put(self, path, data, mode, mtime):
+        """Queue a file, waiting while too much data is queued."""
+        with self._cond:
+            while self.pending and \
+                    self.pending + len(data) > self.max_pending:
+                self._cond.wait()
+            self.pending += len(data)
+        self._queue.put((path, data, mode, mtime))
+
+    def close(self):
+        """
+        Wait for every queued file.
+
+        Raises:
+          ExtractError: a file could not be written
+
+        """
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        if self.errors:
+            raise ExtractError("Unable to write a file: {}".format(
+                               self.errors[0]))
+
+
+def _safe_link(path, target):
+    """Raise ExtractError when a symlink at path leaves the destination."""
+    resolved = posixpath.normpath(posixpath.join(posixpath.dirname(path),
+                                                 target))
+    if posixpath.isabs(target) or resolved == '..' or \
+            resolved.startswith('../'):
+        raise ExtractError("Refusing the symlink '{}' to '{}'".format(
+                           path, target))
+
+
+def resolve(path, links, depth=0):
+    """
+    Resolve a relative path through the symlinks of an archive.
+
+    Args:
+      path: a path relative to the destination
+      links: a dict of symlink path -> target, relative to the destination
+      depth: the symlinks already followed
+
+    Returns:
+      The resolved path relative to the destination, '' for the
+      destination itself
+
+    Raises:
+      ExtractError: the path leaves the destination or loops
+
+    """
+    if depth > MAX_LINK_DEPTH:
+        raise ExtractError("Too many levels of symlinks in '{}'".format(
+                           path))
+    parts = []
+    for part in path.split('/'):
+        if part in ('', '.'):
+            continue
+        if part == '..':
+            if not parts:
+                raise ExtractError("The path '{}' leaves the "
+                                   "destination".format(path))
+            parts.pop()
+            continue
+        parts.append(part)
+        current = '/'.join(parts)
+        if current in links:
+            target = posixpath.join(posixpath.dirname(current),
+                                    links[current])
+            current = resolve(target, links, depth + 1)
+            parts = current.split('/') if current else []
+    return '/'.join(parts)
+
+
+def check_symlinks(links):
+    """
+    Raise ExtractError when a symlink leaves the destination.
+
+    Every target is resolved through the other symlinks, so a chain of
+    links that each stay inside the destination is caught as well.
+    """
+    for path, target in sorted(links.items()):
+        try:
+            resolve(posixpath.join(posixpath.dirname(path), target), links)
+        except ExtractError as err:
+            raise ExtractError("Refusing the symlink '{}' to '{}': "
+                               "{}".format(path, target, err))
+
+
+def extract_tar(archive, dest, strip_components=0, include=None,
+                exclude=None, workers=WORKERS):
+    """
+    Extract an open tarfile stream into dest.
+
+    Returns:
+      A dict with the number of 'files', 'dirs' and 'links' written, the
+      'bytes' of the files and the members 'skipped' by the filters
+
+    """
+    stats = {'files': 0, 'dirs': 0, 'links': 0, 'bytes': 0, 'skipped': 0}
+    created = set([''])
+    dirs = []
+    hardlinks = []
+    symlinks = []
+    linked = set()
+    writers = Writers(workers)
+
+    def links_below(rel):
+        parts = rel.split('/')
+        return linked and any('/'.join(parts[:index]) in linked
+                              for index in range(1, len(parts)))
+
+    def makedirs(rel):
+        if rel not in created:
+            path = os.path.join(dest, rel)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            created.add(rel)
+
+    try:
+        for member in archive:
+            rel = member_path(member.name, strip_components)
+            if rel is None:
+                continue
+            if not selected(rel, include, exclude):
+                stats['skipped'] += 1
+                continue
+            if links_below(rel):
+                raise ExtractError("Refusing the member '{}' below a "
+                                   "symlink".format(rel))
+            path = os.path.join(dest, rel)
+            mode = member.mode & 0o777
+            if member.isdir():
+                makedirs(rel)
+                dirs.append((path, mode, member.mtime))
+                stats['dirs'] += 1
+                continue
+            makedirs(posixpath.dirname(rel))
+            if member.issym():
+                _safe_link(rel, member.linkname)
+                symlinks.append((member.linkname, path))
+                linked.add(rel)
+            elif member.islnk():
+                target = member_path(member.linkname, strip_components)
+                if target is None:
+                    raise ExtractError("Refusing the hardlink '{}' to "
+                                       "'{}'".format(rel, member.linkname))
+                hardlinks.append((os.path.join(dest, target), path))
+            elif member.isreg():
+                source = archive.extractfile(member)
+                if member.size <= SMALL_FILE:
+                    writers.put(path, source.read(), mode, member.mtime)
+                else:
+                    with open(path, 'wb', BUFFER_SIZE) as f:
+                        shutil.copyfileobj(source, f, BUFFER_SIZE)
+                    os.chmod(path, mode)
+                    os.utime(path, (member.mtime, member.mtime))
+                stats['files'] += 1
+                stats['bytes'] += member.size
+            else:
+                log.debug("Skipping the special file '{}'".format(rel))
+                stats['skipped'] += 1
+    except Exception:
+        error = sys.exc_info()
+        try:
+            writers.close()
+        except Exception as err:
+            log.debug("Unable to finish writing after an error: "
+                      "{}".format(err))
+        raise error[0], error[1], error[2]
+    writers.close()
+    check_symlinks(dict((os.path.relpath(path, dest), target)
+                        for target, path in symlinks))
+    for target, path in hardlinks:
+        if not os.path.isfile(target):
+            log.debug("Skipping the hardlink '{}' to a file that was not "
+                      "extracted".format(path))
+            continue
+        if os.path.lexists(path):
+            os.remove(path)
+        os.link(target, path)
+        stats['links'] += 1
+    for target, path in symlinks:
+        if os.path.lexists(path):
+            os.remove(path)
+        os.symlink(target, path)
+        stats['links'] += 1
+    # Last so a read-only directory does not block its children
+    for path, mode, mtime in reversed(dirs):
+        os.chmod(path, mode)
+        os.utime(path, (mtime, mtime))
+    return stats
+
+
+def _feed(source, sink):
+    """Copy source into sink until either ends."""
+    try:
+        while 1:
+            chunk = source.read(BUFFER_SIZE)
+            if not chunk:
+                break
+            sink.write(chunk)
+    except (IOError, OSError):
+        # The decompressor exited early. extract() reports why.
+        pass
+    finally:
+        try:
+            sink.close()
+        except (IOError, OSError):
+            pass
+
+
+def extract(source, name, dest, strip_components=0, include=None,
+            exclude=None, workers=WORKERS):
+    """
+    Extract a tar archive read from source into dest.
+
+    Reading stops at the end of the archive, so a caller that hashes
+    source should read the rest of it afterwards.
+
+    Args:
+      source: a file object the archive is read from
+      name: the archive file name or url, for its compression extension
+      dest: the directory to extract into. It is created if needed.
+      strip_components: leading path components to strip from members
+      include: patterns of the members to extract. Defaults to all.
+      exclude: patterns of the members to leave out
+      workers: the number of writer threads
+
+    Returns:
+      The stats of extract_tar() plus the 'seconds' it took
+
+    Raises:
+      ExtractError: the archive could not be read or extracted
+
+    """
+    started = time.time()
+    if not os.path.isdir(dest):
+        os.makedirs(dest)
+    ext = _extension(name)
+    cmd = decompressor_cmd(name)
+    if ext and cmd is None and ext not in STREAM_MODES:
+        raise ExtractError("No decompressor for '{}' found. Install one of: "
+                           "{}".format(ext, ', '.join(
+                               c[0] for c in DECOMPRESSORS[ext])))
+    proc = feeder = None
+    errors = tempfile.TemporaryFile()
+    try:
+        if cmd:
+            proc, spawned = runner.start(cmd, bufsize=BUFFER_SIZE,
+                                         stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE,
+                                         stderr=errors)
+            feeder = threading.Thread(target=_feed,
+                                      args=(source, proc.stdin))
+            feeder.daemon = True
+            feeder.start()
+            stream, mode = proc.stdout, 'r|'
+        else:
+            stream, mode = source, STREAM_MODES.get(ext, 'r|')
+        try:
+            archive = tarfile.open(fileobj=stream, mode=mode,
+                                   bufsize=BUFFER_SIZE)
+            try:
+                stats = extract_tar(archive, dest, strip_components,
+                                    include, exclude, workers)
+            finally:
+                archive.close()
+        except (tarfile.TarError, EOFError, IOError, OSError) as err:
+            raise ExtractError(str(err))
+        if proc:
+            # Read the padding after the end of the archive
+            while proc.stdout.read(BUFFER_SIZE):
+                pass
+            if runner.wait(proc, spawned) != 0:
+                errors.seek(0)
+                raise ExtractError("'{}' failed: {}".format(
+                                   cmd[0], errors.read().strip()))
+    finally:
+        # Not reaped yet after an error. poll() would reap it without
+        # recording its usage.
+        if proc and proc.returncode is None:
+            proc.kill()
+            runner.wait(proc, spawned)
+        if feeder:
+            feeder.join()
+        errors.close()
+    stats['seconds'] = time.time() - started
+    log.detail("Extracted {} files ({:.1f} MB) in {:.1f}s. {} members were "
+               "left out.".format(stats['files'], stats['bytes'] / 2.0**20,
+                                  stats['seconds'], stats['skipped']))
+    return stats
+
+
+if __name__ == '__main__':
+    print 'This is a library of support tools'
@@ -0,0 +1,405 @@
+"""
+Functions for downloading and extracting a distribution in a single pass.
+
+The download is streamed from curl, hashed as the bytes arrive and fed
+straight into vendir.extract, which can strip components and leave out
+members the build never reads. Extraction happens in a staging directory
+next to the destination and is only moved into place once the sha256 hash
+matches the one from config.ini. When the download cache is enabled the
+same stream is also written into the cache so the next build can skip the
+network.
+
+Individual source files are fetched with fetch_files() which downloads a
+list of (url, sha256, dest) entries concurrently over pooled keep-alive
+connections. Every file is verified while it streams and only renamed into
+place once its hash matches. Failed downloads are retried with backoff.
+
+Usage:
+    fetch.fetch_and_extract(url, sha256, dest)
+    fetch.fetch_and_extract(url, sha256, dest, exclude=['Doc', 'Lib/test'])
+    fetch.fetch_files([(url, sha256, dest), ...])
+"""
+
+import hashlib
+import httplib
+import os
+import shutil
+import socket
+import subprocess
+import tarfile
+import tempfile
+import threading
+import time
+import urlparse
+from multiprocessing.pool import ThreadPool
+
+from vendir import cache
+from vendir import extract
+from vendir import hash_helper
+from vendir import log
+from vendir import runner
+from vendir import trace
+
+# Size of each read from the download stream
+CHUNK_SIZE = 2**16
+
+# HTTP status codes that are followed to the Location header
+REDIRECTS = (301, 302, 303, 307, 308)
+
+
+class FetchError(Exception):
+    """Raised when a distribution could not be downloaded or extracted."""
+
+
+def curl_cmd(url):
+    """Return the curl command that writes url to stdout."""
+    return ['/usr/bin/curl', '--show-error', '--no-buffer',
+            '--fail', '--progress-bar',
+            '--speed-time', '30',
+            '--location',
+            '--url', url,
+            '--output', '-']
+
+
+class _HashingReader(object):
+    """A file object that hashes, and optionally tees, what is read."""
+
+    def __init__(self, source, cache_fd=None):
+        self.source = source
+        self.cache_fd = cache_fd
+        self.digest = hashlib.sha256()
+        self.total = 0
+
+    def read(self, size=CHUNK_SIZE):
+        chunk = self.source.read(size)
+        self.digest.update(chunk)
+        self.total += len(chunk)
+        if chunk and self.cache_fd is not None:
+            os.write(self.cache_fd, chunk)
+        return chunk
+
+    def drain(self):
+        """Read the rest of the source."""
+        while self.read(CHUNK_SIZE):
+            pass
+
+
+def _stream(source, url, staging, strip_components, cache_fd=None,
+            include=None, exclude=None):
+    """
+    Extract source into staging while hashing it.
+
+    Args:
+      source: file object to read the distribution from
+      url: the distribution url, used to pick the decompressor
+      staging: directory to extract into
+      strip_components: leading path components to strip from members
+      cache_fd: optional file descriptor to tee the stream into
+      include: patterns of the members to extract, see vendir.extract
+      exclude: patterns of the members to leave out
+
+    Returns:
+      A tuple of (sha256 hex digest, bytes read)
+
+    """
+    reader = _HashingReader(source, cache_fd)
+    error = None
+    try:
+        extract.extract(reader, url, staging, strip_components, include,
+                        exclude)
+    except extract.ExtractError as err:
+        error = err
+    # Keep hashing after the end of the archive, or after a failed
+    # extraction, so the whole download is hashed and cached
+    reader.drain()
+    if error:
+        raise FetchError("Extraction has failed: {}".format(error))
+    return (reader.digest.hexdigest(), reader.total)
+
+
+def _commit(staging, dest):
+    """Replace dest with the verified staging directory."""
+    if os.path.isdir(dest):
+        shutil.rmtree(dest, ignore_errors=True)
+    os.rename(staging, dest)
+
+
+def _from_cache(url, sha256, dest, strip_components, include=None,
+                exclude=None):
+    """
+    Extract a cached distribution into dest.
+
+    Returns:
+      True when the cached copy was extracted, False on a miss or a
+      corrupt cache entry.
+
+    """
+    path = cache.get(sha256, verify=False)
+    if not path:
+        return False
+    log.info("Using cached download: {}".format(path))
+    staging = tempfile.mkdtemp(dir=os.path.dirname(dest), prefix='.fetch-')
+    try:
+        try:
+            with open(path, 'rb') as source:
+                with trace.span('extract', url=url, cached=True):
+                    digest, _ = _stream(source, url, staging,
+                                        strip_components, include=include,
+                                        exclude=exclude)
+        except (FetchError, tarfile.TarError) as err:
+            log.warn("Cached file '{}' is corrupt ({}). Removing "
+                     "it.".format(path, err))
+            cache.remove(sha256)
+            return False
+        if digest != sha256:
+            log.warn("Cached file '{}' is corrupt. Removing it.".format(path))
+            cache.remove(sha256)
+            return False
+        _commit(staging, dest)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+    return True
+
+
+def fetch_and_extract(url, sha256, dest, strip_components=1, include=None,
+                      exclude=None):
+    """
+    Download url and extract it into dest in a single pass.
+
+    The extracted tree only replaces dest when the download matches sha256.
+    Any existing dest directory is left untouched on failure.
+
+    Args:
+      url: the distribution url
+      sha256: the expected sha256 hash of the download
+      dest: directory the distribution is extracted into
+      strip_components: leading path components to strip from members
+      include: patterns of the members to extract. Defaults to all.
+      exclude: patterns of the members the build never reads
+
+    Raises:
+      FetchError: the download, hash verification or extraction failed
+
+    """
+    sha256 = sha256.lower()
+    dest = os.path.abspath(dest)
+    parent = os.path.dirname(dest)
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    if _from_cache(url, sha256, dest, strip_components, include, exclude):
+        return
+
+    log.info("Downloading: {}".format(url))
+    staging = tempfile.mkdtemp(dir=parent, prefix='.fetch-')
+    cache_fd, cache_path = cache.temp_file()
+    # curl's progress bar is written to stderr so leave it attached
+    proc, started = runner.start(curl_cmd(url), bufsize=-1,
+                                 stdout=subprocess.PIPE)
+    try:
+        stream_error = None
+        # The download is hashed and extracted while it streams so the
+        # three steps share one span
+        with trace.span('download', url=url):
+            try:
+                digest, total = _stream(proc.stdout, url, staging,
+                                        strip_components, cache_fd,
+                                        include, exclude)
+            except FetchError as err:
+                stream_error = err
+            finally:
+                proc.stdout.close()
+                rc = runner.wait(proc, started)
+                if cache_fd is not None:
+                    os.close(cache_fd)
+        # A failed download also breaks extraction so report it first
+        if rc != 0:
+            raise FetchError("Download failed with exit code: "
+                             "'{}'".format(rc))
+        if stream_error:
+            raise stream_error
+        log.debug("Downloaded {} bytes".format(total))
+        if digest != sha256:
+            raise FetchError("Hash verification has failed. Download hash "
+                             "of '{}' does not match config hash "
+                             "'{}'".format(digest, sha256))
+        log.detail("Hash verification successful")
+        _commit(staging, dest)
+        if cache_path:
+            cache.put(cache_path, sha256)
+            cache_path = None
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+        if cache_path and os.path.isfile(cache_path):
+            os.remove(cache_path)
+
+
+class ConnectionPool(object):
+    """Keep-alive HTTP and HTTPS connections shared between threads."""
+
+    def __init__(self, timeout=60):
+        """Create an empty pool whose connections use timeout seconds."""
+        self.timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def get(self, scheme, netloc):
+        """Return an idle connection to netloc or open a new one."""
+        key = (scheme, netloc)
+        with self._lock:
+            if self._idle.get(key):
+                return self._idle[key].pop()
+        if scheme == 'https':
+            return httplib.HTTPSConnection(netloc, timeout=self.timeout)
+        if scheme == 'http':
+            return httplib.HTTPConnection(netloc, timeout=self.timeout)
+        raise FetchError("Unsupported url scheme '{}'".format(scheme))
+
+    def put(self, scheme, netloc, conn):
+        """Return a connection whose last response was fully read."""
+        with self._lock:
+            self._idle.setdefault((scheme, netloc), []).append(conn)
+
+    def close(self):
+        """Close every idle connection."""
+        with self._lock:
+            for conns in self._idle.values():
+                for conn in conns:
+                    conn.close()
+            self._idle = {}
+
+
+def _download(pool, url, sha256, dest, redirects=5):
+    """
+    Download url to dest over a pooled connection.
+
+    The body is hashed while it is written to a temporary file next to dest
+    which is only renamed over dest when the hash matches.
+    """
+    parts = urlparse.urlsplit(url)
+    path = parts.path or '/'
+    if parts.query:
+        path = '{}?{}'.format(path, parts.query)
+    conn = pool.get(parts.scheme, parts.netloc)
+    try:
+        conn.request('GET', path, headers={'Connection': 'keep-alive',
+                                           'User-Agent': 'vendored'})
+        resp = conn.getresponse()
+        if resp.status in REDIRECTS and redirects:
+            location = urlparse.urljoin(url, resp.getheader('location'))
+            resp.read()
+            pool.put(parts.scheme, parts.netloc, conn)
+            return _download(pool, location, sha256, dest, redirects - 1)
+        if resp.status != 200:
+            resp.read()
+            pool.put(parts.scheme, parts.netloc, conn)
+            raise FetchError("HTTP {} {}".format(resp.status, resp.reason))
+        digest = hashlib.sha256()
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(dest),
+                                         prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                while 1:
+                    chunk = resp.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    f.write(chunk)
+            # The response is fully read so the connection can be reused
+            pool.put(parts.scheme, parts.netloc, conn)
+            if digest.hexdigest() != sha256:
+                raise FetchError("Hash verification has failed. Download "
+                                 "hash of '{}' does not match config hash "
+                                 "'{}'".format(digest.hexdigest(), sha256))
+            os.chmod(temp_path, 0o644)
+            os.rename(temp_path, dest)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+    except (httplib.HTTPException, socket.error):
+        # The connection is in an unknown state so do not reuse it
+        conn.close()
+        raise
+
+
+def fetch_file(pool, url, sha256, dest, retries=3, backoff=1.0):
+    """
+    Download a single file through pool, retrying with backoff.
+
+    A dest that already matches sha256 is left alone.
+
+    Raises:
+      FetchError: every attempt failed
+
+    """
+    sha256 = sha256.lower()
+    if os.path.isfile(dest):
+        with trace.span('hash', path=dest):
+            current = hash_helper.getcachedsha256hash(dest)
+        if current == sha256:
+            log.debug("'{}' is up to date".format(dest))
+            return
+    for attempt in range(retries + 1):
+        try:
+            log.info("Downloading '{}'...".format(os.path.basename(dest)))
+            log.debug("Download url: {}".format(url))
+            with trace.span('download', url=url, attempt=attempt):
+                _download(pool, url, sha256, dest)
+            log.debug("The download file '{}' matches our expected hash of "
+                      "'{}'".format(dest, sha256))
+            return
+        except (FetchError, httplib.HTTPException, socket.error,
+                IOError, OSError) as err:
+            if attempt == retries:
+                raise FetchError("Unable to download '{}' due to "
+                                 "{}".format(url, err))
+            delay = backoff * 2 ** attempt
+            log.warn("Download of '{}' failed ({}). Retrying in "
+                     "{}s".format(url, err, delay))
+            time.sleep(delay)
+
+
+def fetch_files(entries, workers=4, retries=3, backoff=1.0):
+    """
+    Download many files concurrently.
+
+    Args:
+      entries: a list of (url, sha256, dest) tuples
+      workers: the number of downloads running at the same time
+      retries: how many times a failed download is retried
+      backoff: seconds to wait before the first retry. Doubles each time.
+
+    Raises:
+      FetchError: one or more files could not be downloaded. Every other
+          entry is still downloaded first.
+
+    """
+    entries = list(entries)
+    if not entries:
+        return
+    for _, _, dest in entries:
+        parent = os.path.dirname(os.path.abspath(dest))
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+    pool = ConnectionPool()
+
+    def work(entry):
+        url, sha256, dest = entry
+        try:
+            fetch_file(pool, url, sha256, dest, retries, backoff)
+        except FetchError as err:
+            return err
+        return None
+
+    threads = ThreadPool(max(1, min(workers, len(entries))))
+    try:
+        errors = [err for err in threads.map(work, entries) if err]
+    finally:
+        threads.close()
+        threads.join()
+        pool.close()
+    if errors:
+        raise FetchError('; '.join(str(err) for err in errors))
+
+
+if __name__ == '__main__':
+    print 'This is a library of support tools'
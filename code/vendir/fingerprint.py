@@ -0,0 +1,132 @@
+"""
+Functions for skipping build phases whose inputs have not changed.
+
+A component build is split into ordered phases such as extract, configure,
+make, install and pip. Each phase fingerprint is a sha256 hash of the phase
+inputs and the fingerprint of the phase before it, so changing an early
+input (like openssl_version) re-runs every phase after it as well. The
+fingerprints of completed phases are kept in a JSON state file next to the
+build directory.
+
+Usage:
+    phases = fingerprint.Phases('/tmp/build-openssl.fingerprint.json')
+    phases.add('extract', [url, sha256], outputs=['/tmp/build-openssl'])
+    phases.add('configure', configure_cmd)
+    if phases.needed('extract'):
+        phases.start('extract')
+        ...
+        phases.done('extract')
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+
+from vendir import hash_helper
+from vendir import log
+
+
+def digest(*inputs):
+    """Return a sha256 hex digest for a list of JSON serializable inputs."""
+    data = json.dumps(inputs, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(data.encode('UTF-8')).hexdigest()
+
+
+def file_hashes(*filenames):
+    """Return a dict of filename -> sha256 hash for use as a phase input."""
+    hashes = {}
+    for filename in filenames:
+        if os.path.isfile(filename):
+            hashes[filename] = hash_helper.getcachedsha256hash(filename)
+        else:
+            hashes[filename] = None
+    return hashes
+
+
+class Phases(object):
+    """The ordered build phases of a single component."""
+
+    def __init__(self, state_file, force=False):
+        """
+        Load previously completed phases from state_file.
+
+        Args:
+          state_file: path of the JSON file the fingerprints are stored in
+          force: when True every phase is reported as needed
+        """
+        self.state_file = state_file
+        self.force = force
+        self.order = []
+        self.fingerprints = {}
+        self.outputs = {}
+        self.completed = {}
+        try:
+            with open(state_file) as f:
+                self.completed = json.load(f)
+        except (IOError, ValueError):
+            self.completed = {}
+
+    def add(self, name, inputs=None, outputs=None):
+        """
+        Add the next phase.
+
+        Args:
+          name: the phase name
+          inputs: JSON serializable inputs. Any change re-runs the phase.
+          outputs: paths that must exist for the phase to be skipped
+
+        Returns:
+          The fingerprint of the phase
+
+        """
+        previous = self.fingerprints[self.order[-1]] if self.order else None
+        self.order.append(name)
+        self.fingerprints[name] = digest(previous, name, inputs)
+        self.outputs[name] = outputs or []
+        return self.fingerprints[name]
+
+    def needed(self, name):
+        """Return True when the phase has to run."""
+        if self.force:
+            return True
+        if self.completed.get(name) != self.fingerprints[name]:
+            log.debug("Phase '{}' inputs changed".format(name))
+            return True
+        for path in self.outputs[name]:
+            if not os.path.exists(path):
+                log.debug("Phase '{}' output '{}' is missing".format(
+                          name, path))
+                return True
+        log.detail("Phase '{}' is up to date. Skipping.".format(name))
+        return False
+
+    def start(self, name):
+        """
+        Forget the phase and every phase after it.
+
+        Call this before running a phase so an interrupted build is never
+        mistaken for a completed one.
+        """
+        for phase in self.order[self.order.index(name):]:
+            self.completed.pop(phase, None)
+        self._save()
+
+    def done(self, name):
+        """Record the phase as completed with its current fingerprint."""
+        self.completed[name] = self.fingerprints[name]
+        self._save()
+
+    def _save(self):
+        """Atomically write the state file."""
+        parent = os.path.dirname(os.path.abspath(self.state_file))
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        fd, temp_path = tempfile.mkstemp(dir=parent, prefix='.tmp-')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.completed, f, indent=2, sort_keys=True)
+        os.rename(temp_path, self.state_file)
+
+
+if __name__ == '__main__':
+    print 'This is a library of support tools'
@@ -1,11 +1,84 @@
 """
 Functions for hashing a file.
 
-This has been completely lifted from Munki3.munkilib.munkihash
+This has been completely lifted from Munki3.munkilib.munkihash and extended
+to compute several digests in a single read pass, reusing one buffer, and
+to hash many files at once in a thread pool. hashlib releases the GIL while
+it hashes large blocks so the threads hash in parallel.
+
+Digests can also be looked up in an on-disk cache (hash_cache_path in
+config.ini) keyed by the path, device, inode, size and modification time of
+the file. Any change to those re-hashes the file. The cache is a sqlite
+database so concurrent build processes can share it safely.
+
+Usage:
+    getsha256hash('file')                       'e3b0c442...'
+    gethashes('file', ['sha256', 'md5'])        {'sha256': ..., 'md5': ...}
+    hash_files(['a', 'b'], ['sha256'])          {'a': {'sha256': ...}, ...}
+    getcachedsha256hash('file')                 cached until the file changes
 """
 
+import errno
 import hashlib
+import io
+import mmap
+import multiprocessing
 import os
+import sqlite3
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+from vendir import config
+from vendir import log
+from vendir import trace
+
+CONFIG = config.ConfigSectionMap()
+
+# Default size of each read. Large blocks keep the number of reads (and GIL
+# round trips) low without holding much memory per file.
+BLOCK_SIZE = 2**20
+
+# Files modified this recently are not cached. A file changed again within
+# the same timestamp tick would otherwise keep a stale digest.
+RACY_SECONDS = 2
+
+_db = None
+_db_lock = threading.Lock()
+
+
+def _check_file(filename):
+    """Raise IOError when filename is not a regular file."""
+    if not os.path.isfile(filename):
+        raise IOError(errno.ENOENT, 'Not a file', filename)
+
+
+def _update(filename, hash_functions, block_size=BLOCK_SIZE, use_mmap=False):
+    """Feed the contents of filename to every hash function in one pass."""
+    _check_file(filename)
+    with io.open(filename, 'rb', buffering=0) as f:
+        if use_mmap:
+            size = os.fstat(f.fileno()).st_size
+            # mmap can not map an empty file
+            if size:
+                view = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    for offset in range(0, size, block_size):
+                        block = buffer(view, offset, block_size)
+                        for hash_function in hash_functions:
+                            hash_function.update(block)
+                finally:
+                    view.close()
+            return
+        buf = bytearray(block_size)
+        view = memoryview(buf)
+        while 1:
+            count = f.readinto(buf)
+            if not count:
+                break
+            block = view[:count]
+            for hash_function in hash_functions:
+                hash_function.update(block)
 
 
 def gethash(filename, hash_function):
@@ -20,25 +93,217 @@ def gethash(filename, hash_function):
     Returns:
       The hashvalue of the given file as hex string.
 
+    Raises:
+      IOError: filename is not a file or could not be read.
+
     """
-    if not os.path.isfile(filename):
-        return 'NOT A FILE'
-
-    f = open(filename, 'rb')
-    while 1:
-        chunk = f.read(2**16)
-        if not chunk:
-            break
-        hash_function.update(chunk)
-    f.close()
+    _update(filename, [hash_function])
     return hash_function.hexdigest()
 
 
+def gethashes(filename, algorithms=('sha256',), block_size=BLOCK_SIZE,
+              use_mmap=False):
+    """
+    Calculate several hash values of a file in a single read pass.
+
+    Args:
+      filename: The file name to calculate the hash values of.
+      algorithms: hashlib algorithm names, e.g. ['sha256', 'sha1', 'md5'].
+      block_size: The number of bytes hashed per read.
+      use_mmap: Map the file into memory instead of reading it.
+
+    Returns:
+      A dict of algorithm name -> hex digest.
+
+    Raises:
+      IOError: filename is not a file or could not be read.
+
+    """
+    hash_functions = [hashlib.new(name) for name in algorithms]
+    _update(filename, hash_functions, block_size, use_mmap)
+    return dict((name, hash_function.hexdigest())
+                for name, hash_function in zip(algorithms, hash_functions))
+
+
+def _identity(st):
+    """Return the (device, inode, size, mtime in ns) identity of a stat."""
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(st.st_mtime * 10**9)
+    return (st.st_dev, st.st_ino, st.st_size, mtime_ns)
+
+
+def _paranoid():
+    """Return True when hash_cache_paranoid is set in config.ini."""
+    return CONFIG.get('hash_cache_paranoid', '').lower() in ('1', 'true',
+                                                             'yes', 'on')
+
+
+def _connect():
+    """Return the shared hash cache connection or None when disabled."""
+    global _db
+    path = CONFIG.get('hash_cache_path', '')
+    if not path:
+        return None
+    with _db_lock:
+        if _db is not None:
+            return _db
+        parent = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        # A single connection guarded by _db_lock serves every thread while
+        # sqlite's own locking keeps other processes safe.
+        db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        try:
+            db.execute('PRAGMA journal_mode=WAL')
+        except sqlite3.DatabaseError:
+            pass
+        db.execute('CREATE TABLE IF NOT EXISTS hashes ('
+                   'path TEXT, algorithm TEXT, dev INTEGER, ino INTEGER, '
+                   'size INTEGER, mtime_ns INTEGER, digest TEXT, '
+                   'PRIMARY KEY (path, algorithm))')
+        db.commit()
+        _db = db
+    return _db
+
+
+def _lookup(db, path, identity, algorithms):
+    """Return cached digests for path when its identity is unchanged."""
+    digests = {}
+    with _db_lock:
+        rows = db.execute('SELECT algorithm, dev, ino, size, mtime_ns, '
+                          'digest FROM hashes WHERE path = ?',
+                          (path,)).fetchall()
+    for algorithm, dev, ino, size, mtime_ns, digest in rows:
+        if (dev, ino, size, mtime_ns) == identity:
+            digests[algorithm] = digest
+    if all(name in digests for name in algorithms):
+        return dict((name, digests[name]) for name in algorithms)
+    return None
+
+
+def _store(db, path, identity, digests):
+    """Save digests for path under its identity."""
+    rows = [(path, name) + identity + (digest,)
+            for name, digest in digests.items()]
+    with _db_lock:
+        db.executemany('INSERT OR REPLACE INTO hashes VALUES '
+                       '(?, ?, ?, ?, ?, ?, ?)', rows)
+        db.commit()
+
+
+def getcachedhashes(filename, algorithms=('sha256',), paranoid=None,
+                    block_size=BLOCK_SIZE, use_mmap=False):
+    """
+    Return gethashes() for a file, using the on-disk hash cache.
+
+    The cached digests are used when the path, device, inode, size and
+    modification time all match the file on disk. Anything else hashes the
+    file again and updates the cache.
+
+    Args:
+      filename: The file name to calculate the hash values of.
+      algorithms: hashlib algorithm names, e.g. ['sha256', 'md5'].
+      paranoid: Always re-hash the file. Defaults to hash_cache_paranoid.
+      block_size: The number of bytes hashed per read.
+      use_mmap: Map the file into memory instead of reading it.
+
+    Raises:
+      IOError: filename is not a file or could not be read.
+
+    """
+    try:
+        db = _connect()
+    except (sqlite3.Error, OSError) as err:
+        log.debug("Hash cache is unavailable: {}".format(err))
+        db = None
+    if db is None:
+        return gethashes(filename, algorithms, block_size, use_mmap)
+    if paranoid is None:
+        paranoid = _paranoid()
+    _check_file(filename)
+    path = os.path.abspath(filename)
+    identity = _identity(os.stat(path))
+    cached = None
+    try:
+        cached = _lookup(db, path, identity, algorithms)
+    except sqlite3.Error as err:
+        log.debug("Hash cache lookup failed: {}".format(err))
+    if cached and not paranoid:
+        return cached
+    digests = gethashes(path, algorithms, block_size, use_mmap)
+    if cached and cached != digests:
+        log.warn("'{}' changed without a change to its size or "
+                 "modification time".format(path))
+    st = os.stat(path)
+    # Only cache a file that did not change while it was hashed and that
+    # is not so new it could change again within the same mtime tick
+    if (_identity(st) == identity and
+            st.st_mtime < time.time() - RACY_SECONDS):
+        try:
+            _store(db, path, identity, digests)
+        except sqlite3.Error as err:
+            log.debug("Hash cache update failed: {}".format(err))
+    return digests
+
+
+def hash_files(filenames, algorithms=('sha256',), workers=None,
+               block_size=BLOCK_SIZE, use_mmap=False, use_cache=False):
+    """
+    Hash many files in a thread pool.
+
+    Args:
+      filenames: The file names to hash.
+      algorithms: hashlib algorithm names computed for every file.
+      workers: Number of threads. Defaults to the number of CPUs.
+      block_size: The number of bytes hashed per read.
+      use_mmap: Map each file into memory instead of reading it.
+      use_cache: Look up and store digests in the on-disk hash cache.
+
+    Returns:
+      A dict of filename -> {algorithm name: hex digest}.
+
+    Raises:
+      IOError: a file is missing or could not be read.
+
+    """
+    filenames = list(filenames)
+    if not filenames:
+        return {}
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    workers = max(1, min(int(workers), len(filenames)))
+    if use_cache:
+        hasher = getcachedhashes
+    else:
+        hasher = gethashes
+
+    def work(filename):
+        return (filename,
+                hasher(filename, algorithms, block_size=block_size,
+                       use_mmap=use_mmap))
+
+    with trace.span('hash', files=len(filenames), workers=workers):
+        if workers == 1:
+            return dict(work(filename) for filename in filenames)
+        pool = ThreadPool(workers)
+        try:
+            return dict(pool.imap_unordered(work, filenames, chunksize=8))
+        finally:
+            pool.close()
+            pool.join()
+
+
 def getsha256hash(filename):
     """Return the SHA-256 hash value of a file as a hex string."""
     hash_function = hashlib.sha256()
     return gethash(filename, hash_function)
 
 
+def getcachedsha256hash(filename, paranoid=None):
+    """Return the SHA-256 hash value of a file using the hash cache."""
+    return getcachedhashes(filename, ['sha256'], paranoid)['sha256']
+
+
 if __name__ == '__main__':
     print 'This is a library of support tools'
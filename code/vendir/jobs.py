@@ -0,0 +1,161 @@
+"""
+Functions for running make with a host aware number of jobs.
+
+The job count comes from make_jobs in config.ini. When it is blank the count
+is detected from the number of CPUs, capped by free memory and the current
+load average.
+
+When build.py runs several components at the same time it starts a GNU make
+jobserver and exports it through MAKEFLAGS. Every make started by a setup
+script then draws from that one shared pool of job slots instead of each
+component using every CPU on its own.
+
+Usage:
+    cmd = jobs.make_cmd('install', parallel=False)
+    with jobs.jobserver(jobs.make_jobs()):
+        ...                             makes started here share the slots
+"""
+
+import contextlib
+import multiprocessing
+import os
+import re
+import subprocess
+
+from vendir import config
+from vendir import log
+
+CONFIG = config.ConfigSectionMap()
+
+MAKE = '/usr/bin/make'
+JOBSERVER_FLAG = '--jobserver-fds'
+
+
+def cpu_count():
+    """Return the number of CPUs or 1 if it can not be determined."""
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def free_memory():
+    """Return the free memory in bytes or None if it can not be found."""
+    # Linux
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, ValueError):
+        pass
+    # macOS. Inactive pages can be reclaimed so count them as free as well.
+    try:
+        output = subprocess.Popen(['/usr/bin/vm_stat'],
+                                  stdout=subprocess.PIPE,
+                                  stderr=subprocess.PIPE).communicate()[0]
+    except OSError:
+        return None
+    page_size = re.search(r'page size of (\d+) bytes', output)
+    pages = 0
+    for key in ('Pages free', 'Pages inactive', 'Pages speculative'):
+        match = re.search(r'{}:\s+(\d+)'.format(key), output)
+        if match:
+            pages += int(match.group(1))
+    if not page_size or not pages:
+        return None
+    return pages * int(page_size.group(1))
+
+
+def load_average():
+    """Return the one minute load average or None if unavailable."""
+    try:
+        return os.getloadavg()[0]
+    except (AttributeError, OSError):
+        return None
+
+
+def detect():
+    """
+    Return the number of make jobs this host can run right now.
+
+    Starts from the CPU count, then caps it so each job has
+    make_job_memory_mb of free memory and so the jobs plus the current load
+    average do not exceed the CPU count.
+    """
+    cpus = cpu_count()
+    count = cpus
+    memory = free_memory()
+    per_job = int(CONFIG.get('make_job_memory_mb') or 0) * 1024 * 1024
+    if memory and per_job:
+        count = min(count, memory // per_job)
+    load = load_average()
+    if load is not None:
+        count = min(count, int(cpus - load + 0.5))
+    count = max(1, count)
+    log.debug("Detected {} make jobs ({} cpus, {} free memory, load "
+              "{})".format(count, cpus, memory, load))
+    return count
+
+
+def make_jobs():
+    """Return the make job count from config.ini or detect it."""
+    value = CONFIG.get('make_jobs', '')
+    if value and value != 'auto':
+        return max(1, int(value))
+    return detect()
+
+
+def has_jobserver():
+    """Return True when a shared jobserver is exported through MAKEFLAGS."""
+    return JOBSERVER_FLAG in os.environ.get('MAKEFLAGS', '')
+
+
+def make_cmd(*targets, **kwargs):
+    """
+    Return a make command for targets.
+
+    Args:
+      targets: make targets and variable assignments
+      parallel: False for steps that are not safe to run with -j
+
+    When a jobserver is exported the -j flag is left off so make joins the
+    shared pool. Serial steps always pass -j1 which makes them leave it.
+    """
+    cmd = [MAKE]
+    if not kwargs.get('parallel', True):
+        cmd.append('-j1')
+    elif not has_jobserver():
+        cmd.append('-j{}'.format(make_jobs()))
+    return cmd + list(targets)
+
+
+@contextlib.contextmanager
+def jobserver(slots):
+    """
+    Export a GNU make jobserver with `slots` jobs for child processes.
+
+    Every make started while the context is active, including makes started
+    by child processes, shares the same job slots. Each make also has one
+    implicit slot of its own, as with any GNU make jobserver.
+    """
+    slots = max(1, int(slots))
+    read_fd, write_fd = os.pipe()
+    os.write(write_fd, '+' * (slots - 1))
+    previous = os.environ.get('MAKEFLAGS')
+    flags = ' {}={},{} -j'.format(JOBSERVER_FLAG, read_fd, write_fd)
+    os.environ['MAKEFLAGS'] = (previous or '') + flags
+    log.debug("Started a make jobserver with {} slots".format(slots))
+    try:
+        yield
+    finally:
+        if previous is None:
+            os.environ.pop('MAKEFLAGS', None)
+        else:
+            os.environ['MAKEFLAGS'] = previous
+        os.close(read_fd)
+        os.close(write_fd)
+
+
+if __name__ == '__main__':
+    print 'This is a library of support tools'
@@ -0,0 +1,154 @@
+"""
+Functions for describing a package payload and what changed in it.
+
+A manifest lists every path below a payload root with its type, mode, size
+and sha256 digest (or link target), plus the package metadata like the
+version and identifier. Files are hashed in parallel through the hash
+cache so unchanged files are not read again.
+
+package.pkg() writes the manifest next to each package as
+`<output>.manifest.json`. When the next build produces the same manifest
+and the package still exists, pkgbuild is skipped. Otherwise the
+difference to the previous manifest is logged to show how the payload grew
+between releases.
+
+Usage:
+    current = manifest.build(payload_dir, {'version': '1.0.2o'})
+    changes = manifest.diff(manifest.load(path), current)
+    manifest.report(changes)
+    manifest.write(path, current)
+"""
+
+import json
+import os
+import stat
+import tempfile
+
+from vendir import hash_helper
+from vendir import log
+
+SUFFIX = '.manifest.json'
+
+
+def path_for(output):
+    """Return the manifest path of a package."""
+    return output + SUFFIX
+
+
+def build(root, meta=None):
+    """
+    Return the manifest of every path below root.
+
+    Args:
+      root: the payload directory
+      meta: JSON serializable package metadata that is part of the manifest
+    """
+    entries = {}
+    files = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in dirnames + filenames:
+            path = os.path.join(dirpath, name)
+            rel = os.path.relpath(path, root)
+            st = os.lstat(path)
+            entry = {'mode': stat.S_IMODE(st.st_mode)}
+            if stat.S_ISLNK(st.st_mode):
+                entry['type'] = 'link'
+                entry['target'] = os.readlink(path)
+            elif stat.S_ISDIR(st.st_mode):
+                entry['type'] = 'dir'
+            else:
+                entry['type'] = 'file'
+                entry['size'] = st.st_size
+                files.append(path)
+            entries[rel] = entry
+    digests = hash_helper.hash_files(files, use_cache=True)
+    for path, digest in digests.items():
+        entries[os.path.relpath(path, root)]['sha256'] = digest['sha256']
+    # The root is not compared by diff(). vendir.dedup reads the payload
+    # files through it.
+    return {'meta': meta or {}, 'root': os.path.abspath(root),
+            'files': entries}
+
+
+def load(path):
+    """Return the manifest stored at path or None if there is none."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def write(path, manifest):
+    """Atomically write manifest to path."""
+    parent = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=parent, prefix='.tmp-')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.rename(temp_path, path)
+
+
+def _size(entry):
+    """Return the size of a manifest entry in bytes."""
+    return entry.get('size', 0) if entry else 0
+
+
+def diff(old, new):
+    """
+    Return the difference between two manifests.
+
+    Returns:
+      A dict with the sorted 'added', 'removed' and 'changed' paths, the
+      byte counts of each, the total size before and after, and whether
+      the package metadata changed.
+
+    """
+    old_files = (old or {}).get('files', {})
+    new_files = new.get('files', {})
+    added = sorted(set(new_files) - set(old_files))
+    removed = sorted(set(old_files) - set(new_files))
+    changed = sorted(path for path in set(old_files) & set(new_files)
+                     if old_files[path] != new_files[path])
+    return {
+        'added': added,
+        'removed': removed,
+        'changed': changed,
+        'added_bytes': sum(_size(new_files[path]) for path in added),
+        'removed_bytes': sum(_size(old_files[path]) for path in removed),
+        'changed_bytes': sum(_size(new_files[path]) -
+                             _size(old_files[path]) for path in changed),
+        'old_bytes': sum(_size(entry) for entry in old_files.values()),
+        'new_bytes': sum(_size(entry) for entry in new_files.values()),
+        'meta_changed': (old or {}).get('meta') != new.get('meta'),
+    }
+
+
+def unchanged(changes):
+    """Return True when a diff() found no difference."""
+    return not (changes['added'] or changes['removed'] or
+                changes['changed'] or changes['meta_changed'])
+
+
+def _human(size):
+    """Format a byte count with its sign in KB or MB."""
+    if abs(size) < 2**20:
+        return '{:+.1f} KB'.format(size / 2.0**10)
+    return '{:+.2f} MB'.format(size / 2.0**20)
+
+
+def report(changes):
+    """Log a diff() as a short summary plus the changed paths."""
+    log.info("Payload: {} added ({}), {} removed ({}), {} changed ({}). "
+             "{:.2f} MB total ({})".format(
+                 len(changes['added']), _human(changes['added_bytes']),
+                 len(changes['removed']), _human(-changes['removed_bytes']),
+                 len(changes['changed']), _human(changes['changed_bytes']),
+                 changes['new_bytes'] / 2.0**20,
+                 _human(changes['new_bytes'] - changes['old_bytes'])))
+    for key, sign in (('added', '+'), ('removed', '-'), ('changed', '~')):
+        for path in changes[key]:
+            log.debug("{} {}".format(sign, path))
+
+
+if __name__ == '__main__':
+    print 'This is a library of support tools'
@@ -2,14 +2,339 @@
 Functions for packaging.
 
 TODO: Better doc string message as I was getting lazy on this one
+
+Every package gets a payload manifest next to it (see vendir.manifest) so an
+unchanged payload is not packaged again.
+
+The package format comes from pkg_backend in config.ini. `pkgbuild` builds
+a native macOS package. `tar` builds a `.tar.gz`, `.tar.xz` or `.tar.zst`
+archive (pkg_compression) that can be built and installed on Linux as
+well. The archive is written by tarfile and compressed by an external
+multi-threaded compressor (pigz, xz -T0 or zstd -T0) so it uses every core.
+Other backends can be added with register().
+
+With pkg_deterministic set, identical payloads give byte identical
+packages. Tar members are sorted, their mtimes are clamped to
+SOURCE_DATE_EPOCH (the environment variable or source_date_epoch in
+config.ini), everything is owned by root:wheel and hardlinks are stored as
+regular files since they depend on how the payload was staged. gzip is run
+with -n and xz with a fixed block size so the thread count does not change
+the output. For pkgbuild the payload mtimes are normalized on disk, on
+private copies of hardlinked files, but the xar table of contents still
+records the build time. pkg(verify=True) builds the package a second time
+and compares the digests.
+
+Usage:
+    rc = package.pkg(root=payload, version='1.0', output='openssl-1.0.pkg')
+    package.output_path('openssl-1.0.pkg')      'openssl-1.0.tar.zst' for tar
+    package.install('openssl-1.0.pkg')
+    package.pkg(..., verify=True)               non-zero if not reproducible
 """
 
-import sys
+from distutils.spawn import find_executable
+import grp
+import multiprocessing
+import os
+import pwd
 import subprocess
+import sys
+import tarfile
+import tempfile
 
 from vendir import config
+from vendir import hash_helper
+from vendir import log
+from vendir import manifest
+from vendir import runner
+from vendir import stage
+from vendir import trace
 CONFIG = config.ConfigSectionMap()
 
+# Compressors tried in order for each pkg_compression value. {threads} is
+# replaced by the CPU count for compressors that need an explicit number.
+COMPRESSORS = {
+    'gz': [['pigz', '-p', '{threads}', '-c'], ['gzip', '-c']],
+    'xz': [['xz', '-T0', '-c']],
+    'zst': [['zstd', '-T0', '-q', '-c']],
+}
+
+# Extra compressor arguments so the output only depends on the input
+DETERMINISTIC_ARGS = {
+    'pigz': ['-n'],
+    'gzip': ['-n'],
+    'xz': ['--block-size=16MiB'],
+}
+
+# backend name -> (build function, install function)
+BACKENDS = {}
+
+
+def register(name, build, install):
+    """
+    Add a package backend.
+
+    Args:
+      name: the pkg_backend value that selects it
+      build: called as build(root, output, meta) and returns an exit code.
+          meta has the version, identifier, install_location, sign and
+          ownership arguments of pkg().
+      install: called as install(output) and returns an exit code
+    """
+    BACKENDS[name] = (build, install)
+
+
+def backend_name(backend=None):
+    """Return the backend to use, defaulting to pkg_backend."""
+    name = backend or CONFIG.get('pkg_backend') or 'pkgbuild'
+    if name not in BACKENDS:
+        raise ValueError("Unknown package backend '{}'. Expected one of: "
+                         "{}".format(name, ', '.join(sorted(BACKENDS))))
+    return name
+
+
+def compression():
+    """Return the tar compression from pkg_compression."""
+    value = CONFIG.get('pkg_compression') or 'gz'
+    if value not in COMPRESSORS:
+        raise ValueError("Unknown pkg_compression '{}'. Expected one of: "
+                         "{}".format(value, ', '.join(sorted(COMPRESSORS))))
+    return value
+
+
+def output_path(output, backend=None):
+    """Return the file a backend writes for a requested `.pkg` output."""
+    if backend_name(backend) != 'tar':
+        return output
+    base = output[:-len('.pkg')] if output.endswith('.pkg') else output
+    return '{}.tar.{}'.format(base, compression())
+
+
+def deterministic():
+    """Return True when pkg_deterministic is set in config.ini."""
+    return CONFIG.get('pkg_deterministic', '').lower() in ('1', 'true',
+                                                           'yes', 'on')
+
+
+def source_date_epoch():
+    """Return SOURCE_DATE_EPOCH from the environment or config.ini."""
+    value = (os.environ.get('SOURCE_DATE_EPOCH') or
+             CONFIG.get('source_date_epoch') or 0)
+    return int(value)
+
+
+def compressor_cmd(kind, reproducible=False):
+    """Return the compressor command for kind or None if none is found."""
+    for cmd in COMPRESSORS[kind]:
+        path = find_executable(cmd[0])
+        if path:
+            threads = str(multiprocessing.cpu_count())
+            args = [arg.replace('{threads}', threads) for arg in cmd[1:]]
+            if reproducible:
+                args += DETERMINISTIC_ARGS.get(cmd[0], [])
+            return [path] + args
+    return None
+
+
+def _owner(info, ownership):
+    """Set the owner of a tar member like pkgbuild --ownership does."""
+    if ownership == 'preserve' or (ownership == 'preserve-other' and
+                                   info.uid != os.getuid()):
+        try:
+            info.uname = pwd.getpwuid(info.uid).pw_name
+        except KeyError:
+            info.uname = ''
+        try:
+            info.gname = grp.getgrgid(info.gid).gr_name
+        except KeyError:
+            info.gname = ''
+        return info
+    # recommended: everything is owned by root:wheel
+    info.uid = 0
+    info.gid = 0
+    info.uname = 'root'
+    info.gname = 'wheel'
+    return info
+
+
+def _members(root):
+    """Yield root and every path below it, parents before children."""
+    yield root
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in dirnames + sorted(filenames):
+            yield os.path.join(dirpath, name)
+
+
+def write_tar(root, fileobj, install_location='/', ownership='recommended',
+              epoch=None):
+    """
+    Write root to fileobj as an uncompressed tar stream.
+
+    Members are named by their install path without the leading slash, so
+    the archive extracts into place with `tar -x -C /`.
+
+    When epoch is set the archive is deterministic: mtimes are clamped to
+    epoch, every member is owned by root:wheel and hardlinks are stored as
+    regular files.
+    """
+    write_combined_tar([(root, install_location)], fileobj, ownership, epoch)
+
+
+def write_combined_tar(payloads, fileobj, ownership='recommended',
+                       epoch=None, links=None):
+    """
+    Write several payloads to fileobj as one uncompressed tar stream.
+
+    Args:
+      payloads: a list of (root, install_location) in archive order
+      links: a dict of payload file path -> content key, see vendir.dedup.
+          The first file of each key is stored, every later one becomes a
+          hardlink to it. These hardlinks only depend on the content so
+          they are kept in deterministic archives.
+    """
+    if epoch is not None:
+        ownership = 'recommended'
+    links = links or {}
+    stored = {}
+    archive = tarfile.open(fileobj=fileobj, mode='w|',
+                           format=tarfile.PAX_FORMAT)
+    try:
+        for root, install_location in payloads:
+            prefix = install_location.strip('/')
+            for path in _members(root):
+                arcname = os.path.normpath(os.path.join(
+                    prefix, os.path.relpath(path, root)))
+                if arcname == '.':
+                    # Never change the owner or mode of / itself
+                    continue
+                info = _owner(archive.gettarinfo(path, arcname), ownership)
+                if epoch is not None:
+                    info.mtime = min(info.mtime, epoch)
+                    if info.islnk():
+                        info.type = tarfile.REGTYPE
+                        info.linkname = ''
+                        info.size = os.lstat(path).st_size
+                key = links.get(path)
+                if key is not None and key in stored:
+                    info.type = tarfile.LNKTYPE
+                    info.linkname = stored[key]
+                    info.size = 0
+                elif key is not None:
+                    stored[key] = arcname
+                if info.isreg():
+                    with open(path, 'rb') as f:
+                        archive.addfile(info, f)
+                else:
+                    archive.addfile(info)
+    finally:
+        archive.close()
+
+
+def compress(output, writer, reproducible=False):
+    """
+    Write output by piping writer(fileobj) through the compressor.
+
+    Returns:
+      0 on success, otherwise an exit code
+
+    """
+    kind = compression()
+    cmd = compressor_cmd(kind, reproducible=reproducible)
+    if cmd is None:
+        log.error("No compressor for '{}' found. Install one of: {}".format(
+                  kind, ', '.join(c[0] for c in COMPRESSORS[kind])))
+        return 1
+    parent = os.path.dirname(os.path.abspath(output))
+    fd, temp_path = tempfile.mkstemp(dir=parent, prefix='.tmp-')
+    try:
+        written = False
+        with os.fdopen(fd, 'wb') as out:
+            proc, started = runner.start(cmd, stdin=subprocess.PIPE,
+                                         stdout=out)
+            try:
+                writer(proc.stdin)
+                written = True
+            except (IOError, OSError) as err:
+                log.error("Unable to write '{}': {}".format(output, err))
+            finally:
+                proc.stdin.close()
+                rc = runner.wait(proc, started)
+        if rc != 0 or not written:
+            log.error("Compressing '{}' with '{}' failed".format(
+                      output, cmd[0]))
+            return rc or 1
+        os.chmod(temp_path, 0o644)
+        os.rename(temp_path, output)
+        return 0
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def _tar(root, output, meta):
+    """Build a compressed tar payload with a multi-threaded compressor."""
+    if meta.get('sign'):
+        log.warn("tar packages are not signed. Ignoring sign_cert_cn.")
+    return compress(output, lambda fileobj: write_tar(
+                    root, fileobj, meta['install_location'],
+                    meta['ownership'], meta.get('epoch')),
+                    reproducible=meta.get('epoch') is not None)
+
+
+def _install_tar(output):
+    """Extract a tar payload into /."""
+    cmd = ['/usr/bin/tar', '-x', '-p', '-f', output, '-C', '/']
+    return runner.Popen(cmd)[2]
+
+
+def normalize_mtimes(root, epoch):
+    """
+    Clamp the mtime of root and everything below it to epoch.
+
+    A payload is usually staged with hardlinks to the install, so files are
+    made private before their mtime changes.
+    """
+    for path in _members(root):
+        st = os.lstat(path)
+        # os.utime follows symlinks so leave those alone
+        if not os.path.islink(path) and st.st_mtime > epoch:
+            if os.path.isfile(path):
+                stage.make_private(path)
+            os.utime(path, (epoch, epoch))
+
+
+def _pkgbuild(root, output, meta):
+    """Build a native macOS package with pkgbuild."""
+    if meta.get('epoch') is not None:
+        normalize_mtimes(root, meta['epoch'])
+    cmd = ['/usr/bin/pkgbuild', '--root', root,
+           '--install-location', meta['install_location'],
+           '--identifier', meta['identifier'],
+           '--version', meta['version'],
+           '--ownership', meta['ownership']]
+    # When sign_cert_cn are passed we should sign the package
+    if meta['sign']:
+        cmd.append('--sign')
+        cmd.append(meta['sign'])
+    # Always append the output path so signing will work
+    cmd.append(output)
+    log.detail("Running: {}".format(' '.join(cmd)))
+    out = runner.Popen(cmd, stdout=sys.stdout)
+    return out[2]
+
+
+def _install_pkg(output):
+    """Install a macOS package on the boot volume."""
+    cmd = ['/usr/sbin/installer', '-pkg', output, '-tgt', '/']
+    out = runner.Popen(cmd)
+    if out[2] != 0:
+        log.error("{}".format(out[1]))
+    return out[2]
+
+
+register('pkgbuild', _pkgbuild, _install_pkg)
+register('tar', _tar, _install_tar)
+
 
 def pkg(root,
         version,
@@ -17,34 +342,98 @@ def pkg(root,
         identifier=CONFIG['pkgid'],
         install_location='/',
         sign=CONFIG['sign_cert_cn'],
-        ownership='recommended'
+        ownership='recommended',
+        force=False,
+        backend=None,
+        verify=False
         ):
     """
     Create a package.
 
     Most of the input parameters should be recognizable for most admins.
-    `output` is the path so make sure and attach the pkg extension.
+    `output` is the path so make sure and attach the pkg extension. Other
+    backends change the extension, see output_path().
+
+    The package is not rebuilt when it exists and the payload and parameters
+    match the manifest written by the last successful run. Pass force=True
+    to always build. Pass verify=True to build it a second time and check
+    the two are byte for byte identical.
 
     Return:
-      The exit code from pkgbuild. If non-zero an error has occurred
+      The exit code from the backend. If non-zero an error has occurred
     """
-    cmd = ['/usr/bin/pkgbuild', '--root', root,
-           '--install-location', install_location,
-           '--identifier', identifier,
-           '--version', version,
-           '--ownership', ownership]
-    # When sign_cert_cn are passed we should sign the package
-    if sign:
-        cmd.append('--sign')
-        cmd.append(sign)
-    # Always append the output path so signing will work
-    cmd.append(output)
-    print(cmd)
-    proc = subprocess.Popen(cmd, shell=False, bufsize=-1,
-                            stdin=subprocess.PIPE,
-                            stdout=sys.stdout, stderr=subprocess.PIPE)
-    (output, dummy_error) = proc.communicate()
-    return proc.returncode
+    name = backend_name(backend)
+    output = output_path(output, name)
+    manifest_path = manifest.path_for(output)
+    meta = {'version': version, 'identifier': identifier,
+            'install_location': install_location, 'sign': sign,
+            'ownership': ownership, 'backend': name,
+            'epoch': source_date_epoch() if deterministic() else None}
+    with trace.span('manifest'):
+        current = manifest.build(root, meta)
+    changes = manifest.diff(manifest.load(manifest_path), current)
+    if (not force and os.path.isfile(output) and
+            manifest.unchanged(changes)):
+        log.info("Payload of '{}' is unchanged. Skipping {}.".format(
+                 output, name))
+        return verify_pkg(root, output, meta) if verify else 0
+    manifest.report(changes)
+    with trace.span(name, output=output):
+        rc = BACKENDS[name][0](root, output, meta)
+    if rc == 0:
+        manifest.write(manifest_path, current)
+    elif os.path.isfile(manifest_path):
+        # Never let a failed build leave a manifest matching an old package
+        os.remove(manifest_path)
+    if rc == 0 and verify:
+        return verify_pkg(root, output, meta)
+    return rc
+
+
+def verify_pkg(root, output, meta):
+    """
+    Build the package again and compare it with output.
+
+    Return:
+      0 when both builds have the same sha256 digest, 1 otherwise
+    """
+    name = meta['backend']
+    if meta.get('epoch') is None:
+        log.warn("pkg_deterministic is not set so the packages will most "
+                 "likely differ")
+    base, ext = os.path.splitext(output)
+    if base.endswith('.tar'):
+        base, ext = os.path.splitext(base)[0], '.tar' + ext
+    rebuild = '{}.verify{}'.format(base, ext)
+    try:
+        with trace.span('verify', output=output):
+            rc = BACKENDS[name][0](root, rebuild, meta)
+        if rc != 0:
+            log.error("Rebuilding '{}' to verify it failed".format(output))
+            return rc
+        expected = hash_helper.getsha256hash(output)
+        actual = hash_helper.getsha256hash(rebuild)
+    finally:
+        if os.path.isfile(rebuild):
+            os.remove(rebuild)
+    if expected != actual:
+        log.error("'{}' is not reproducible. The rebuild hash '{}' does not "
+                  "match '{}'".format(output, actual, expected))
+        return 1
+    log.info("'{}' is reproducible: {}".format(output, expected))
+    return 0
+
+
+def install(output, backend=None):
+    """
+    Install a package built by pkg() from its requested `.pkg` output.
+
+    Return:
+      The exit code from the installer. If non-zero an error has occurred
+    """
+    name = backend_name(backend)
+    with trace.span('install'):
+        return BACKENDS[name][1](output_path(output, name))
 
 
 if __name__ == '__main__':
@@ -1,9 +1,61 @@
-"""Wrapper functions for os.system and subprocess.Popen."""
+"""
+Wrapper functions for os.system and subprocess.Popen.
 
+stream() runs long commands like make without holding their output in
+memory. Every line is passed to an optional callback, echoed, written to a
+per-step log file under log_dir from config.ini, and only the last lines
+are kept to explain a failure.
+
+run_many() runs a batch of independent commands at the same time, up to a
+limit, and returns a CommandResult with the exit code, timings and output
+tails of each. Python 2 has no asyncio so the batch runs on threads that
+each wait on their own child process.
+
+Every child is reaped with os.wait4() so the wall time, CPU time, peak
+memory and block I/O of its process tree are recorded by vendir.usage.
+Children whose pipes the caller reads or writes itself, like a download or
+a compressor, are started with start() and reaped with wait().
+
+When VENDIR_TOOLS_DIR is set, a command whose executable has a file of the
+same name in that directory runs that file instead, like a stub `make` or
+`pkgbuild` in tests/benchmark.py. Relative paths like ./configure are never
+replaced.
+
+Usage:
+    out = runner.Popen(['/usr/bin/otool', '-L', dylib])
+    out = runner.stream(['/usr/bin/make'], log_file=runner.step_log('make'))
+    out[2]                              the exit code
+    results = runner.run_many([cmd1, cmd2], limit=2)
+    results[0].returncode, results[0].elapsed
+    proc, started = runner.start(cmd, stdout=subprocess.PIPE)
+    runner.wait(proc, started)          the exit code
+"""
+
+import collections
+import errno
+import multiprocessing
 import subprocess
 import os
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
 
+from . import config
 from . import log
+from . import trace
+from . import usage
+
+CONFIG = config.ConfigSectionMap()
+
+# Number of output lines stream() keeps for error reporting
+TAIL_LINES = 50
+
+# Longer lines are split so a single line can not use unbounded memory
+MAX_LINE = 2**16
+
+# Directory of stand-in executables, see tool()
+TOOLS_DIR_ENV = 'VENDIR_TOOLS_DIR'
 
 
 def pprint(data, level='debug'):
@@ -27,6 +79,69 @@ def pprint(data, level='debug'):
         log.info(data[2])
 
 
+def tool(path):
+    """Return the stand-in for an executable from VENDIR_TOOLS_DIR or path."""
+    directory = os.environ.get(TOOLS_DIR_ENV)
+    if not directory or (os.sep in path and not os.path.isabs(path)):
+        return path
+    stub = os.path.join(directory, os.path.basename(path))
+    return stub if os.path.isfile(stub) else path
+
+
+def tool_cmd(cmd):
+    """Return cmd, a list or a shell string, with its executable tool()ed."""
+    if isinstance(cmd, basestring):
+        parts = cmd.split(' ', 1)
+        return ' '.join([tool(parts[0])] + parts[1:])
+    return [tool(cmd[0])] + list(cmd[1:])
+
+
+def wait(proc, started):
+    """
+    Reap proc with os.wait4() and record its resource usage.
+
+    Sets proc.returncode like Popen.wait() and returns it. Never call
+    proc.wait() or proc.poll() on a process started by start(), since they
+    reap it without recording its usage.
+    """
+    while 1:
+        try:
+            _, status, rusage = os.wait4(proc.pid, 0)
+            break
+        except OSError as err:
+            if err.errno != errno.EINTR:
+                raise
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+    usage.record(proc.vendir_cmd, time.time() - started, rusage,
+                 proc.returncode)
+    return proc.returncode
+
+
+def start(cmd, **kwargs):
+    """
+    Start cmd with subprocess.Popen and remember it for wait().
+
+    The executable is tool()ed. kwargs are passed to subprocess.Popen.
+
+    Returns:
+      (the Popen object, the start time wait() needs)
+
+    """
+    started = time.time()
+    proc = subprocess.Popen(tool_cmd(cmd), **kwargs)
+    proc.vendir_cmd = cmd
+    return proc, started
+
+
+def _read(pipe, chunks):
+    """Read all of pipe into chunks."""
+    chunks.append(pipe.read())
+    pipe.close()
+
+
 def system(cmd):
     """
     Wrap system calls.
@@ -38,8 +153,9 @@ def system(cmd):
 
     Returns the exit code of the command
     """
-    rc = os.WIFEXITED(os.system(' '.join(cmd)))
-    return rc
+    # The same shell os.system() uses, but reaped with wait4
+    proc, started = start(' '.join(cmd), shell=True)
+    return wait(proc, started)
 
 
 def Popen(cmd, shell=False, bufsize=-1,
@@ -56,10 +172,27 @@ def Popen(cmd, shell=False, bufsize=-1,
     Returns tuple of of the run in the order of:
       (output, error, returncode)
     """
-    proc = subprocess.Popen(cmd, shell=shell, bufsize=bufsize,
-                            stdin=stdin,
-                            stdout=stdout, stderr=stderr)
-    (output, error) = proc.communicate()
+    proc, started = start(cmd, shell=shell, bufsize=bufsize,
+                          stdin=stdin,
+                          stdout=stdout, stderr=stderr)
+    if proc.stdin:
+        proc.stdin.close()
+    # Like communicate() but the child is reaped by wait() afterwards
+    outputs = {}
+    threads = []
+    for name, pipe in (('output', proc.stdout), ('error', proc.stderr)):
+        if pipe is None:
+            continue
+        outputs[name] = []
+        thread = threading.Thread(target=_read, args=(pipe, outputs[name]))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    wait(proc, started)
+    output = ''.join(outputs.get('output', []))
+    error = ''.join(outputs.get('error', []))
     # For values that are empty string convert them to None
     if output == '':
         output = None
@@ -68,5 +201,189 @@ def Popen(cmd, shell=False, bufsize=-1,
     return (output, error, proc.returncode)
 
 
+def step_log(step, component=None):
+    """
+    Return the log file path for a build step or None when logging is off.
+
+    Args:
+      step: the step name, like 'make' or 'configure'
+      component: defaults to the component name of the current trace
+    """
+    directory = CONFIG.get('log_dir', '')
+    if not directory:
+        return None
+    if component is None:
+        component = trace.component
+    name = '{}-{}.log'.format(component, step).replace(' ', '-')
+    return os.path.join(directory, name)
+
+
+def _pump(pipe, name, ring, on_line, echo, log_f, lock):
+    """Read pipe line by line until it is closed."""
+    for line in iter(lambda: pipe.readline(MAX_LINE), ''):
+        ring.append(line)
+        if log_f is not None:
+            with lock:
+                log_f.write(line)
+        if echo is not None:
+            with lock:
+                echo.write(line)
+                echo.flush()
+        if on_line is not None:
+            try:
+                on_line(line, name)
+            except Exception as err:  # noqa
+                # Keep draining the pipe so the child can not block on it
+                log.debug("Output callback failed: {}".format(err))
+    pipe.close()
+
+
+def stream(cmd, on_line=None, log_file=None, tail=TAIL_LINES, echo=True,
+           cwd=None, env=None):
+    """
+    Run cmd and process its output while it runs.
+
+    stdout and stderr are read by their own threads so the child can never
+    block on a full pipe, and only the last `tail` lines of each are kept.
+
+    Args:
+      cmd: the command to run in list format
+      on_line: called with (line, 'stdout' or 'stderr') for every line
+      log_file: path both streams are written to as they arrive
+      tail: the number of lines kept of each stream
+      echo: write stdout to sys.stdout and stderr to sys.stderr as they
+          arrive
+      cwd, env: passed to subprocess.Popen
+
+    Returns tuple of of the run in the order of:
+      (last lines of output, last lines of error, returncode)
+    """
+    log_f = None
+    if log_file:
+        parent = os.path.dirname(os.path.abspath(log_file))
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        log_f = open(log_file, 'w')
+        log.debug("Writing output of '{}' to '{}'".format(cmd[0], log_file))
+    lock = threading.Lock()
+    rings = {'stdout': collections.deque(maxlen=tail),
+             'stderr': collections.deque(maxlen=tail)}
+    devnull = open(os.devnull, 'r')
+    try:
+        proc, started = start(cmd, bufsize=-1, stdin=devnull,
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE, cwd=cwd, env=env)
+        threads = []
+        for name, pipe, out in (('stdout', proc.stdout,
+                                 sys.stdout if echo else None),
+                                ('stderr', proc.stderr,
+                                 sys.stderr if echo else None)):
+            thread = threading.Thread(target=_pump,
+                                      args=(pipe, name, rings[name], on_line,
+                                            out, log_f, lock))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            # Join with a timeout so Ctrl-C still reaches the main thread
+            while thread.is_alive():
+                thread.join(1)
+        returncode = wait(proc, started)
+    finally:
+        devnull.close()
+        if log_f is not None:
+            log_f.close()
+    # For values that are empty string convert them to None like Popen()
+    output = ''.join(rings['stdout']) or None
+    error = ''.join(rings['stderr']) or None
+    return (output, error, returncode)
+
+
+class CommandResult(object):
+    """
+    The outcome of a command run by run_many().
+
+    Indexing works like the (output, error, returncode) tuple of Popen() so
+    a result can be passed to pprint().
+    """
+
+    def __init__(self, cmd, output, error, returncode, started, elapsed):
+        """Record the outcome of cmd, started at a time.time() value."""
+        self.cmd = cmd
+        self.output = output
+        self.error = error
+        self.returncode = returncode
+        self.started = started
+        self.elapsed = elapsed
+
+    def __getitem__(self, index):
+        """Return the output, error or returncode like Popen()."""
+        return (self.output, self.error, self.returncode)[index]
+
+    def __len__(self):
+        """Return the length of the Popen() tuple."""
+        return 3
+
+    @property
+    def ok(self):
+        """Return True when the command exited with 0."""
+        return self.returncode == 0
+
+    def __repr__(self):
+        """Return the command, its returncode and how long it took."""
+        return '<CommandResult {!r} returncode={} elapsed={:.2f}s>'.format(
+            ' '.join(self.cmd), self.returncode, self.elapsed)
+
+
+def _run_one(cmd, tail, cwd, env):
+    """Run a single command of a batch and return its CommandResult."""
+    started = time.time()
+    with trace.span(os.path.basename(cmd[0]), cmd=' '.join(cmd)):
+        try:
+            output, error, returncode = stream(cmd, tail=tail, echo=False,
+                                               cwd=cwd, env=env)
+        except OSError as err:
+            # The command could not be started, like a missing binary
+            output, error, returncode = None, str(err), 127
+    return CommandResult(cmd, output, error, returncode, started,
+                         time.time() - started)
+
+
+def run_many(cmds, limit=None, tail=TAIL_LINES, cwd=None, env=None):
+    """
+    Run independent commands at the same time and wait for all of them.
+
+    Args:
+      cmds: a list of commands in list format
+      limit: the most commands running at once. Defaults to the CPU count.
+      tail: the number of output lines kept of each command
+      cwd, env: passed to subprocess.Popen for every command
+
+    Returns:
+      A list of CommandResult in the same order as cmds. A failing command
+      does not stop the others.
+
+    """
+    cmds = list(cmds)
+    if not cmds:
+        return []
+    if limit is None:
+        limit = multiprocessing.cpu_count()
+    limit = max(1, min(int(limit), len(cmds)))
+    log.debug("Running {} commands, {} at a time".format(len(cmds), limit))
+
+    def work(cmd):
+        return _run_one(cmd, tail, cwd, env)
+
+    if limit == 1:
+        return [work(cmd) for cmd in cmds]
+    pool = ThreadPool(limit)
+    try:
+        return pool.map(work, cmds)
+    finally:
+        pool.close()
+        pool.join()
+
+
 if __name__ == '__main__':
     print 'This is a library of support tools'
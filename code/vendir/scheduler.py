@@ -0,0 +1,186 @@
+"""
+Functions for running tasks in dependency order.
+
+Each task is a callable plus the names of the tasks it depends on. A task
+starts once all of its dependencies have succeeded and up to `jobs` tasks
+run at the same time in worker threads. When a task fails every task that
+depends on it, directly or not, is skipped.
+
+Usage:
+    tasks = {
+        'openssl': (build_openssl, []),
+        'python2': (build_python2, ['openssl']),
+    }
+    results = scheduler.run(tasks, jobs=2)
+    results['python2']                  'success', 'failed' or 'skipped'
+    critical_path(tasks, {'openssl': 300, 'python2': 600})
+                                        (['openssl', 'python2'], 900)
+
+A task succeeds when its callable returns 0, None or True.
+"""
+
+import Queue
+import sys
+import threading
+import time
+
+from vendir import log
+
+SUCCESS = 'success'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+
+class CycleError(Exception):
+    """Raised when the task dependencies contain a cycle."""
+
+
+def order(tasks):
+    """
+    Return the task names in a valid dependency order.
+
+    Raises:
+      KeyError: a task depends on a task that does not exist
+      CycleError: the dependencies contain a cycle
+
+    """
+    for name, (_, deps) in tasks.items():
+        for dep in deps:
+            if dep not in tasks:
+                raise KeyError("Task '{}' depends on unknown task "
+                               "'{}'".format(name, dep))
+    ordered = []
+    visiting = set()
+    visited = set()
+
+    def visit(name, path):
+        if name in visited:
+            return
+        if name in visiting:
+            raise CycleError("Dependency cycle: {}".format(
+                             ' -> '.join(path + [name])))
+        visiting.add(name)
+        for dep in sorted(tasks[name][1]):
+            visit(dep, path + [name])
+        visiting.discard(name)
+        visited.add(name)
+        ordered.append(name)
+
+    for name in sorted(tasks):
+        visit(name, [])
+    return ordered
+
+
+def _succeeded(rc):
+    """Return True when a task return value means success."""
+    return rc is None or rc is True or rc == 0
+
+
+def _worker(name, func, done):
+    """Run a single task and report the outcome on the done queue."""
+    start = time.time()
+    try:
+        ok = _succeeded(func())
+    except SystemExit as err:
+        ok = _succeeded(err.code)
+    except Exception as err:  # noqa
+        log.error("Task '{}' raised: {}".format(name, err))
+        ok = False
+    done.put((name, ok, time.time() - start))
+
+
+def run(tasks, jobs=1):
+    """
+    Run tasks in dependency order with up to `jobs` running at once.
+
+    Args:
+      tasks: dict of name -> (callable, [dependency names])
+      jobs: the maximum number of tasks running at the same time
+
+    Returns:
+      dict of name -> SUCCESS, FAILED or SKIPPED
+
+    """
+    jobs = max(1, int(jobs))
+    pending = order(tasks)
+    results = {}
+    running = set()
+    done = Queue.Queue()
+    while pending or running:
+        # Skip anything downstream of a failure
+        for name in list(pending):
+            deps = tasks[name][1]
+            if any(results.get(dep) in (FAILED, SKIPPED) for dep in deps):
+                log.warn("Skipping '{}' because a dependency "
+                         "failed".format(name))
+                results[name] = SKIPPED
+                pending.remove(name)
+        # Start everything that is ready while we have free workers
+        for name in list(pending):
+            if len(running) >= jobs:
+                break
+            deps = tasks[name][1]
+            if all(results.get(dep) == SUCCESS for dep in deps):
+                log.info("Starting '{}'...".format(name))
+                pending.remove(name)
+                running.add(name)
+                thread = threading.Thread(target=_worker,
+                                          args=(name, tasks[name][0], done))
+                thread.daemon = True
+                thread.start()
+        if not running:
+            continue
+        # Wait with a timeout so Ctrl-C still reaches the main thread
+        while 1:
+            try:
+                name, ok, elapsed = done.get(timeout=1)
+                break
+            except Queue.Empty:
+                pass
+        running.discard(name)
+        results[name] = SUCCESS if ok else FAILED
+        if ok:
+            log.info("Finished '{}' in {:.1f}s".format(name, elapsed))
+        else:
+            log.error("'{}' failed after {:.1f}s".format(name, elapsed))
+        sys.stdout.flush()
+    return results
+
+
+def critical_path(tasks, durations):
+    """
+    Return the chain of dependent tasks that took the longest.
+
+    No amount of parallelism finishes the tasks sooner than this chain so it
+    is where speeding up a task shortens the whole run.
+
+    Args:
+      tasks: dict of name -> (callable, [dependency names])
+      durations: dict of name -> seconds. Missing tasks count as 0.
+
+    Returns:
+      A tuple of ([task names in order], total seconds)
+
+    """
+    finish = {}
+    previous = {}
+    for name in order(tasks):
+        deps = tasks[name][1]
+        before = max(deps, key=lambda dep: finish[dep]) if deps else None
+        previous[name] = before
+        start = finish[before] if before else 0
+        finish[name] = start + durations.get(name, 0)
+    if not finish:
+        return ([], 0)
+    # Prefer ending on a task that ran over one that was skipped
+    name = max(finish, key=lambda name: (finish[name], name in durations))
+    total = finish[name]
+    path = []
+    while name:
+        path.insert(0, name)
+        name = previous[name]
+    return (path, total)
+
+
+if __name__ == '__main__':
+    print 'This is a library of support tools'
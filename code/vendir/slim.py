@@ -0,0 +1,203 @@
+"""
+Functions for slimming a payload while it is staged for packaging.
+
+A make install brings test suites, man pages, static libraries and debug
+symbols that no client ever uses but every client downloads and installs.
+stage_payload() stages an install into a payload directory and leaves out
+what the slimming profile names, then strips the debug symbols of the
+shared objects that are left. The install itself is never changed, so the
+other components can still build against it. Payload files are hardlinked
+to the install unless pkg_deterministic is set, when they are reflinked or
+copied since packaging then clamps their mtimes. Every step that changes
+a payload file in place, like strip() and package.normalize_mtimes(),
+makes it private with stage.make_private() first.
+
+payload_profile in config.ini selects the profile. Each profile is a
+slim_<profile> key with a list of shell patterns, separated by commas or
+new lines. A pattern is matched against the path inside the payload with a
+leading /, so `/include` only matches the top level include directory and
+`*/test` matches every test directory. A matching directory leaves out
+everything in it. Profiles can build on each other with
+`%(slim_standard)s`. The `full` profile ships the install as it is, so
+nothing is left out or stripped.
+
+With payload_strip set, every .so and .dylib in a slimmed payload is
+stripped with `strip -S`, a few files per command and up to the make job
+count of commands at once. Stripped files are first made private so the
+install keeps its symbols.
+
+Usage:
+    stats = slim.stage_payload(install_dir, payload_dir, 'python2')
+    slim.stage_payload(install_dir, payload_dir, 'openssl', 'minimal')
+    slim.patterns('standard')
+"""
+
+import fnmatch
+import os
+import shutil
+import time
+
+from vendir import config
+from vendir import jobs
+from vendir import log
+from vendir import package
+from vendir import runner
+from vendir import stage
+from vendir import trace
+
+CONFIG = config.ConfigSectionMap()
+
+STRIP = '/usr/bin/strip'
+# Shared objects that are stripped
+STRIP_SUFFIXES = ('.so', '.dylib')
+# Files per strip command
+STRIP_BATCH = 16
+
+
+def profile():
+    """Return the slimming profile from payload_profile."""
+    return CONFIG.get('payload_profile') or 'full'
+
+
+def patterns(name):
+    """
+    Return the patterns of a slimming profile.
+
+    Raises:
+      ValueError: the profile is not defined in config.ini
+
+    """
+    if name == 'full':
+        return []
+    key = 'slim_{}'.format(name)
+    if key not in CONFIG:
+        raise ValueError("Unknown payload_profile '{}'. Add a '{}' key to "
+                         "config.ini.".format(name, key))
+    return [pattern for pattern in
+            CONFIG[key].replace(',', ' ').split() if pattern]
+
+
+def strip_enabled():
+    """Return True when payload_strip is set in config.ini."""
+    return CONFIG.get('payload_strip', '').lower() in ('1', 'true', 'yes',
+                                                       'on')
+
+
+def matcher(pattern_list):
+    """Return an exclude function for stage.stage_tree()."""
+    def excluded(path):
+        path = '/' + path.lstrip('/')
+        return any(fnmatch.fnmatchcase(path, pattern)
+                   for pattern in pattern_list)
+    return excluded
+
+
+def tree_size(root):
+    """Return the number of files and their total size below root."""
+    files = size = 0
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            if not os.path.islink(path):
+                files += 1
+                size += os.path.getsize(path)
+    return files, size
+
+
+def shared_objects(root):
+    """Return the shared objects below root that can be stripped."""
+    found = []
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            if name.endswith(STRIP_SUFFIXES) and not os.path.islink(path):
+                found.append(path)
+    return sorted(found)
+
+
+def strip(paths, limit=None):
+    """
+    Strip the debug symbols of shared objects in place.
+
+    Returns:
+      The number of files stripped
+
+    """
+    if not paths:
+        return 0
+    modes = {}
+    for path in paths:
+        stage.make_private(path)
+        modes[path] = os.stat(path).st_mode
+        os.chmod(path, modes[path] | 0o200)
+    batches = [paths[i:i + STRIP_BATCH]
+               for i in range(0, len(paths), STRIP_BATCH)]
+    with trace.span('strip', files=len(paths)):
+        results = runner.run_many([[STRIP, '-S'] + batch
+                                   for batch in batches],
+                                  limit=limit or jobs.make_jobs())
+    for path, mode in modes.items():
+        os.chmod(path, mode)
+    stripped = 0
+    for batch, result in zip(batches, results):
+        if result.ok:
+            stripped += len(batch)
+        else:
+            log.warn("Unable to strip {} files: {}".format(
+                     len(batch), result.error))
+    return stripped
+
+
+def _mb(size):
+    """Format a byte count in MB."""
+    return '{:.2f} MB'.format(size / 2.0**20)
+
+
+def stage_payload(src, dest, component, name=None):
+    """
+    Stage src into dest with a slimming profile applied.
+
+    dest is replaced. The full profile stages src unchanged.
+
+    Args:
+      src: the install directory
+      dest: the payload directory to package
+      component: the component name used in the report, like 'openssl'
+      name: the profile. Defaults to payload_profile.
+
+    Returns:
+      A dict with the 'profile', the file count and size 'before' and
+      'after' as (files, bytes) and the number of files 'stripped'
+
+    """
+    name = name or profile()
+    exclude = patterns(name)
+    started = time.time()
+    if os.path.isdir(dest):
+        shutil.rmtree(dest)
+    before = tree_size(src)
+    with trace.span('slim', profile=name):
+        stage.stage_tree(src, dest, mutable=package.deterministic(),
+                         exclude=matcher(exclude) if exclude else None)
+        stripped = 0
+        if name != 'full' and strip_enabled():
+            stripped = strip(shared_objects(dest))
+    stats = {'profile': name, 'before': before, 'after': tree_size(dest),
+             'stripped': stripped, 'seconds': time.time() - started}
+    report(component, stats)
+    return stats
+
+
+def report(component, stats):
+    """Log the before and after size of a stage_payload()."""
+    files, size = stats['before']
+    slim_files, slim_size = stats['after']
+    saved = 100.0 * (size - slim_size) / size if size else 0.0
+    log.info("{} payload ({} profile): {} files, {} -> {} files, {} "
+             "({:.1f}% smaller, {} files stripped)".format(
+                 component, stats['profile'], files, _mb(size), slim_files,
+                 _mb(slim_size), saved, stats['stripped']))
+
+
+if __name__ == '__main__':
+    print 'This is a library of support tools'
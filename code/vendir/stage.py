@@ -0,0 +1,205 @@
+"""
+Functions for staging files into build and payload directories.
+
+Files are staged with the cheapest method the filesystem supports:
+
+  reflink   a copy-on-write clone (FICLONE on Linux, clonefile on APFS)
+            that shares the data blocks until either side is written
+  hardlink  a second name for the same inode. Only used for files that are
+            not modified after staging, since a write or chmod of one name
+            changes both.
+  copy      a plain copy when neither of the above is possible
+
+Before a staged file is modified in place, for example by install_name_tool
+or chmod, call make_private() so the change can not reach the original
+through a shared hardlink.
+
+Usage:
+    stage.stage_file(src, dest)                     'reflink' or 'hardlink'
+    stage.stage_file(dylib, tmp, mutable=True)      never a hardlink
+    stage.stage_tree(install_dir, payload_dir)      {'hardlink': 1523, ...}
+    stage.make_private(tmp)
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import os
+import shutil
+import sys
+import tempfile
+
+from vendir import log
+
+# _IOW(0x94, 9, int) from linux/fs.h
+FICLONE = 0x40049409
+
+# Errors that mean a method is not supported between two paths
+UNSUPPORTED = (errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL,
+               errno.ENOSYS, errno.EPERM, errno.EMLINK)
+
+# Devices a method already failed on so it is not tried for every file
+_unsupported = set()
+_libc = None
+
+
+def _clonefile():
+    """Return the macOS clonefile function or None."""
+    global _libc
+    if sys.platform != 'darwin':
+        return None
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    return getattr(_libc, 'clonefile', None)
+
+
+def reflink(src, dest):
+    """
+    Clone src to dest sharing its data blocks.
+
+    Raises:
+      OSError: the filesystem or platform does not support cloning
+
+    """
+    clonefile = _clonefile()
+    if clonefile is not None:
+        if clonefile(src, dest, 0) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), dest)
+        return
+    if not sys.platform.startswith('linux'):
+        raise OSError(errno.EOPNOTSUPP, 'Cloning is not supported', dest)
+    with open(src, 'rb') as source:
+        fd = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        try:
+            fcntl.ioctl(fd, FICLONE, source.fileno())
+        except IOError as err:
+            os.close(fd)
+            os.remove(dest)
+            raise OSError(err.errno, err.strerror, dest)
+        os.close(fd)
+    shutil.copystat(src, dest)
+
+
+def _try(method, src, dest):
+    """Stage src to dest with method. Return False when unsupported."""
+    key = (method, os.stat(os.path.dirname(os.path.abspath(dest))).st_dev)
+    if key in _unsupported:
+        return False
+    try:
+        if method == 'reflink':
+            reflink(src, dest)
+        else:
+            os.link(src, dest)
+    except OSError as err:
+        if err.errno not in UNSUPPORTED:
+            raise
+        log.debug("Can not {} '{}': {}".format(method, dest, err))
+        _unsupported.add(key)
+        return False
+    return True
+
+
+def stage_file(src, dest, mutable=False):
+    """
+    Stage src at dest, replacing any existing dest.
+
+    Args:
+      src: the file to stage
+      dest: the destination path or an existing directory
+      mutable: dest will be modified in place so never hardlink it
+
+    Returns:
+      The method used: 'reflink', 'hardlink' or 'copy'
+
+    Raises:
+      IOError or OSError: src does not exist or dest could not be written
+
+    """
+    if os.path.isdir(dest):
+        dest = os.path.join(dest, os.path.basename(src))
+    if not os.path.isfile(src):
+        raise IOError(errno.ENOENT, 'No such file', src)
+    if os.path.lexists(dest):
+        os.remove(dest)
+    methods = ['reflink'] if mutable else ['reflink', 'hardlink']
+    for method in methods:
+        if _try(method, src, dest):
+            return method
+    shutil.copy2(src, dest)
+    return 'copy'
+
+
+def stage_tree(src, dest, mutable=False, exclude=None):
+    """
+    Stage every file below src into dest, keeping symlinks as symlinks.
+
+    Args:
+      mutable: the caller changes the staged files in place, so they are
+          never hardlinked. Callers that only change a few of them pass
+          False and call make_private() on each file before changing it.
+      exclude: called with the path of every file, symlink and directory
+          relative to src. Paths it returns True for are not staged, and
+          neither is anything below an excluded directory.
+
+    Returns:
+      A dict of method -> number of files staged with it
+
+    """
+    counts = {'reflink': 0, 'hardlink': 0, 'copy': 0}
+    for dirpath, dirnames, filenames in os.walk(src):
+        rel = os.path.relpath(dirpath, src)
+        target_dir = os.path.normpath(os.path.join(dest, rel))
+        if not os.path.isdir(target_dir):
+            os.makedirs(target_dir)
+        shutil.copymode(dirpath, target_dir)
+        for name in list(dirnames) + filenames:
+            path = os.path.join(dirpath, name)
+            if exclude is not None and exclude(
+                    os.path.normpath(os.path.join(rel, name))):
+                if name in dirnames:
+                    dirnames.remove(name)
+                continue
+            target = os.path.join(target_dir, name)
+            if os.path.islink(path):
+                if os.path.lexists(target):
+                    os.remove(target)
+                os.symlink(os.readlink(path), target)
+                # os.walk does not follow it so stage it as a link only
+                if name in dirnames:
+                    dirnames.remove(name)
+            elif name in filenames:
+                counts[stage_file(path, target, mutable)] += 1
+    log.detail("Staged '{}': {} reflinked, {} hardlinked, {} copied".format(
+               src, counts['reflink'], counts['hardlink'], counts['copy']))
+    return counts
+
+
+def make_private(path):
+    """
+    Give path its own inode before it is modified in place.
+
+    A hardlinked file is replaced by a reflink or copy of itself so writes
+    and chmod no longer reach the other names. Reflinked and copied files
+    are already private.
+    """
+    if os.stat(path).st_nlink < 2:
+        return path
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(
+                                     os.path.abspath(path)), prefix='.tmp-')
+    os.close(fd)
+    os.remove(temp_path)
+    try:
+        if not _try('reflink', path, temp_path):
+            shutil.copy2(path, temp_path)
+        os.rename(temp_path, path)
+    finally:
+        if os.path.lexists(temp_path):
+            os.remove(temp_path)
+    log.debug("Made '{}' private before modifying it".format(path))
+    return path
+
+
+if __name__ == '__main__':
+    print 'This is a library of support tools'
@@ -0,0 +1,240 @@
+"""
+Functions for timing build phases.
+
+Every span records a complete ("X") event in the Chrome trace event format
+so the timeline can be opened in chrome://tracing or https://ui.perfetto.dev
+to see where build time goes. Spans nest per thread and each process shows
+up as its own track named after its component.
+
+The events are written to `<component>.trace.json` in report_dir from
+config.ini when the process exits. build.py points every component at one
+directory per run through the VENDIR_REPORT_DIR and VENDIR_COMPONENT
+environment variables, then merges the files into a single `trace.json`
+and prints a summary table. Leave report_dir blank to disable tracing.
+
+Usage:
+    with trace.span('make', jobs=8):
+        ...
+    trace.report(trace.merge(run_dir, os.path.join(run_dir, 'trace.json')))
+"""
+
+import atexit
+import contextlib
+import glob
+import json
+import os
+import sys
+import threading
+import time
+
+from vendir import config
+from vendir import log
+
+CONFIG = config.ConfigSectionMap()
+
+# Environment variables build.py uses to configure its child processes
+REPORT_DIR_ENV = 'VENDIR_REPORT_DIR'
+COMPONENT_ENV = 'VENDIR_COMPONENT'
+
+TRACE_SUFFIX = '.trace.json'
+
+# The name of this process in the trace. Defaults to the directory of the
+# running script, like 'openssl' for openssl/setup.py.
+component = os.environ.get(COMPONENT_ENV) or os.path.basename(
+    os.path.dirname(os.path.abspath(sys.argv[0] or '.')))
+
+_events = []
+_lock = threading.Lock()
+_local = threading.local()
+_started = time.time()
+
+
+def report_dir():
+    """Return the directory traces are written to or None when disabled."""
+    return os.environ.get(REPORT_DIR_ENV, CONFIG.get('report_dir', '')) or None
+
+
+def enabled():
+    """Return True when tracing is configured."""
+    return report_dir() is not None
+
+
+def _now():
+    """Return the current time in microseconds."""
+    return int(time.time() * 10**6)
+
+
+def _stack():
+    """Return the names of the spans open in this thread."""
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def current():
+    """Return the name of the innermost span open in this thread or None."""
+    stack = _stack()
+    return stack[-1] if stack else None
+
+
+@contextlib.contextmanager
+def span(name, **args):
+    """
+    Time the code inside the context as a named span.
+
+    Args:
+      name: the phase name, like 'configure' or 'make'
+      args: extra values shown with the span in the trace viewer
+    """
+    if not enabled():
+        yield
+        return
+    stack = _stack()
+    stack.append(name)
+    start = _now()
+    try:
+        yield
+    except BaseException as err:
+        args['error'] = repr(err)
+        raise
+    finally:
+        stack.pop()
+        event = {'name': name,
+                 'cat': stack[0] if stack else name,
+                 'ph': 'X',
+                 'ts': start,
+                 'dur': _now() - start,
+                 'pid': os.getpid(),
+                 'tid': threading.current_thread().ident,
+                 'args': args}
+        with _lock:
+            _events.append(event)
+
+
+def events():
+    """Return the events of this process including the track names."""
+    pid = os.getpid()
+    with _lock:
+        recorded = list(_events)
+    meta = [{'name': 'process_name', 'ph': 'M', 'pid': pid,
+             'args': {'name': component}},
+            {'name': component, 'cat': component, 'ph': 'X',
+             'ts': int(_started * 10**6),
+             'dur': _now() - int(_started * 10**6),
+             'pid': pid, 'tid': 0, 'args': {}},
+            {'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': 0,
+             'args': {'name': 'total'}}]
+    return meta + recorded
+
+
+def _dump(trace_events, path):
+    """Atomically write trace_events to path in the JSON object format."""
+    temp_path = '{}.tmp-{}'.format(path, os.getpid())
+    with open(temp_path, 'w') as f:
+        json.dump({'traceEvents': trace_events,
+                   'displayTimeUnit': 'ms'}, f)
+    os.rename(temp_path, path)
+
+
+def write(path=None):
+    """
+    Write the events of this process to path.
+
+    Defaults to `<component>.trace.json` in the report directory. Returns
+    the path written or None when tracing is disabled.
+    """
+    directory = report_dir()
+    if path is None:
+        if directory is None:
+            return None
+        path = os.path.join(directory, component + TRACE_SUFFIX)
+    parent = os.path.dirname(os.path.abspath(path))
+    try:
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        _dump(events(), path)
+    except (IOError, OSError) as err:
+        log.warn("Unable to write the build trace '{}': {}".format(path, err))
+        return None
+    return path
+
+
+def _write_at_exit():
+    """Write the trace when the process exits, even after sys.exit()."""
+    if enabled() and _events:
+        write()
+
+
+atexit.register(_write_at_exit)
+
+
+def load(path):
+    """Return the events of a trace file."""
+    with open(path) as f:
+        data = json.load(f)
+    if isinstance(data, list):
+        return data
+    return data.get('traceEvents', [])
+
+
+def merge(directory, output):
+    """
+    Merge the trace files in directory and this process into output.
+
+    Returns:
+      The merged list of events
+
+    """
+    merged = events()
+    pid = os.getpid()
+    for path in sorted(glob.glob(os.path.join(directory,
+                                              '*' + TRACE_SUFFIX))):
+        if os.path.abspath(path) == os.path.abspath(output):
+            continue
+        try:
+            merged.extend(event for event in load(path)
+                          if event.get('pid') != pid)
+        except (IOError, ValueError) as err:
+            log.warn("Skipping unreadable trace '{}': {}".format(path, err))
+    _dump(merged, output)
+    return merged
+
+
+def summary(trace_events):
+    """
+    Return the time spent in each span per component.
+
+    Returns:
+      A list of (component, span name, count, seconds) tuples in the order
+      each span first started. Nested spans are counted on their own so the
+      seconds of a component do not add up to its total.
+
+    """
+    names = {}
+    for event in trace_events:
+        if event.get('ph') == 'M' and event.get('name') == 'process_name':
+            names[event['pid']] = event['args']['name']
+    rows = {}
+    first = {}
+    for event in trace_events:
+        if event.get('ph') != 'X':
+            continue
+        key = (names.get(event['pid'], str(event['pid'])), event['name'])
+        count, dur = rows.get(key, (0, 0))
+        rows[key] = (count + 1, dur + event['dur'])
+        first[key] = min(first.get(key, event['ts']), event['ts'])
+    return [row + (rows[row][0], rows[row][1] / 10.0**6)
+            for row in sorted(rows, key=first.get)]
+
+
+def report(trace_events):
+    """Log the summary() of trace_events as a table."""
+    log.info("{:<12} {:<24} {:>6} {:>10}".format('component', 'span',
+                                                 'count', 'seconds'))
+    for name, span_name, count, seconds in summary(trace_events):
+        log.info("{:<12} {:<24} {:>6} {:>10.1f}".format(name, span_name[:24],
+                                                        count, seconds))
+
+
+if __name__ == '__main__':
+    print 'This is a library of support tools'
@@ -0,0 +1,189 @@
+"""
+Functions for recording the resources used by child processes.
+
+runner.Popen(), runner.system(), runner.stream() and runner.wait() reap
+their children with os.wait4() and pass the resource usage of the whole
+child process tree to record(). Each command is recorded with its wall
+time, user and system CPU time, peak resident memory and block I/O counts,
+along with the trace span it ran in.
+
+Like the trace, the records are written to `<component>.usage.json` in the
+report directory when the process exits, and build.py merges them into a
+`usage.json` summary per component.
+
+A CPU time close to `wall x jobs` means a step was CPU bound. A lower one
+with high block counts means it waited on the disk. Peak memory is what
+each make job needs when sizing a build machine or make_job_memory_mb.
+
+Usage:
+    usage.record(cmd, wall, rusage, returncode)
+    usage.report(usage.merge(run_dir, os.path.join(run_dir, 'usage.json')))
+"""
+
+import atexit
+import glob
+import json
+import os
+import sys
+import threading
+
+from vendir import log
+from vendir import trace
+
+USAGE_SUFFIX = '.usage.json'
+
+_records = []
+_lock = threading.Lock()
+
+
+def max_rss_bytes(rusage):
+    """Return ru_maxrss in bytes. macOS reports bytes and Linux kilobytes."""
+    if sys.platform == 'darwin':
+        return rusage.ru_maxrss
+    return rusage.ru_maxrss * 1024
+
+
+def record(cmd, wall, rusage, returncode=None):
+    """
+    Record the resources used by a finished command.
+
+    Args:
+      cmd: the command in list format or as a shell string
+      wall: seconds from start to exit
+      rusage: the resource usage returned by os.wait4()
+      returncode: the exit code of the command
+    """
+    if isinstance(cmd, basestring):
+        name = cmd.split()[0] if cmd.split() else cmd
+    else:
+        name = cmd[0]
+    entry = {'command': os.path.basename(name),
+             'step': trace.current(),
+             'wall': wall,
+             'user': rusage.ru_utime,
+             'sys': rusage.ru_stime,
+             'max_rss': max_rss_bytes(rusage),
+             'inblock': rusage.ru_inblock,
+             'oublock': rusage.ru_oublock,
+             'returncode': returncode}
+    with _lock:
+        _records.append(entry)
+    log.debug("'{}' used {:.1f}s wall, {:.1f}s user, {:.1f}s sys, {:.0f} MB "
+              "peak memory".format(entry['command'], wall, entry['user'],
+                                   entry['sys'], entry['max_rss'] / 2.0**20))
+
+
+def records():
+    """Return the commands recorded by this process."""
+    with _lock:
+        return list(_records)
+
+
+def _total(entries):
+    """Return the combined usage of entries."""
+    total = {'commands': len(entries), 'wall': 0.0, 'user': 0.0,
+             'sys': 0.0, 'max_rss': 0, 'inblock': 0, 'oublock': 0}
+    for entry in entries:
+        for key in ('wall', 'user', 'sys', 'inblock', 'oublock'):
+            total[key] += entry[key]
+        total['max_rss'] = max(total['max_rss'], entry['max_rss'])
+    return total
+
+
+def summarize(entries):
+    """
+    Return the total usage of entries and the usage per step and command.
+
+    Commands that ran at the same time each add their own wall time so the
+    total wall time can be longer than the build took.
+    """
+    summary = {'total': _total(entries), 'steps': {}, 'commands': {}}
+    for group, key in (('steps', 'step'), ('commands', 'command')):
+        names = set(entry[key] for entry in entries)
+        for name in names:
+            summary[group][name or '-'] = _total(
+                [entry for entry in entries if entry[key] == name])
+    return summary
+
+
+def _dump(data, path):
+    """Atomically write data to path as JSON."""
+    temp_path = '{}.tmp-{}'.format(path, os.getpid())
+    with open(temp_path, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+    os.rename(temp_path, path)
+
+
+def write(path=None):
+    """
+    Write the records of this process to path.
+
+    Defaults to `<component>.usage.json` in the report directory. Returns
+    the path written or None when reporting is disabled.
+    """
+    if path is None:
+        directory = trace.report_dir()
+        if directory is None:
+            return None
+        path = os.path.join(directory, trace.component + USAGE_SUFFIX)
+    parent = os.path.dirname(os.path.abspath(path))
+    try:
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        _dump({'component': trace.component, 'records': records()}, path)
+    except (IOError, OSError) as err:
+        log.warn("Unable to write the usage report '{}': {}".format(
+                 path, err))
+        return None
+    return path
+
+
+def _write_at_exit():
+    """Write the records when the process exits, even after sys.exit()."""
+    if trace.enabled() and _records:
+        write()
+
+
+atexit.register(_write_at_exit)
+
+
+def merge(directory, output):
+    """
+    Summarize every usage file in directory per component into output.
+
+    Returns:
+      A dict of component -> summarize() of its records
+
+    """
+    merged = {}
+    for path in sorted(glob.glob(os.path.join(directory,
+                                              '*' + USAGE_SUFFIX))):
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (IOError, ValueError) as err:
+            log.warn("Skipping unreadable usage '{}': {}".format(path, err))
+            continue
+        merged[data['component']] = summarize(data['records'])
+    _dump(merged, output)
+    return merged
+
+
+def report(merged):
+    """Log the total usage of each component from merge() as a table."""
+    log.info("{:<12} {:>9} {:>9} {:>9} {:>6} {:>9} {:>10} {:>10}".format(
+             'component', 'wall', 'user', 'sys', 'cpu%', 'peak MB',
+             'in blocks', 'out blocks'))
+    for name in sorted(merged):
+        total = merged[name]['total']
+        cpu = total['user'] + total['sys']
+        rate = 100.0 * cpu / total['wall'] if total['wall'] else 0.0
+        log.info("{:<12} {:>9.1f} {:>9.1f} {:>9.1f} {:>6.0f} {:>9.0f} "
+                 "{:>10} {:>10}".format(name, total['wall'], total['user'],
+                                        total['sys'], rate,
+                                        total['max_rss'] / 2.0**20,
+                                        total['inblock'], total['oublock']))
+
+
+if __name__ == '__main__':
+    print 'This is a library of support tools'
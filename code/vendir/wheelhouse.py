@@ -0,0 +1,281 @@
+"""
+Functions for installing Python requirements offline from prebuilt wheels.
+
+Installing requirements from PyPI builds packages like pyobjc, which is
+dozens of subpackages, from source on every build. A wheelhouse is built
+once per interpreter and requirements file instead:
+
+1. `pip download` resolves every requirement and its dependencies, plus
+   pip, setuptools and wheel, into a download directory.
+2. Downloads that are already wheels are kept as they are. Every source
+   distribution is built with `pip wheel --no-deps` at the same time, up
+   to the make job count. A build that fails is retried in the next wave
+   once the wheels of the first wave are available to it, which covers
+   packages that need another package of the set to build, like
+   pyobjc-core for the pyobjc frameworks. The downloaded wheel package is
+   unpacked onto PYTHONPATH for these builds, so setup.py bdist_wheel works
+   without installing it into the vendored Python.
+3. The wheels are renamed into
+   `<wheelhouse_dir>/<implementation><version>-<key>` where the key is a
+   sha256 hash of the interpreter version, ABI and platform and of the
+   requirements.
+
+Later builds install with `--no-index --find-links <wheelhouse>` and never
+touch the network. Leave wheelhouse_dir in config.ini blank to always
+install from PyPI.
+
+Usage:
+    house = wheelhouse.prepare(python, 'requirements2.txt')
+    cmd = [python, '-m', 'pip', 'install', '-r', 'requirements2.txt']
+    cmd += wheelhouse.offline_args(house)       [] when there is none
+"""
+
+import glob
+import json
+import os
+import shutil
+import tempfile
+import zipfile
+
+from vendir import config
+from vendir import fingerprint
+from vendir import jobs
+from vendir import log
+from vendir import runner
+from vendir import trace
+
+CONFIG = config.ConfigSectionMap()
+
+MARKER = 'wheelhouse.json'
+
+# Prints what the wheels of an interpreter depend on. Runs on Python 2.7
+# and 3.
+TAG_SCRIPT = ("import json, platform, sys, sysconfig; "
+              "print(json.dumps({"
+              "'implementation': platform.python_implementation(), "
+              "'version': list(sys.version_info[:3]), "
+              "'soabi': sysconfig.get_config_var('SOABI'), "
+              "'maxunicode': sys.maxunicode, "
+              "'platform': sysconfig.get_platform()}))")
+
+# Short implementation names used in the directory name
+IMPLEMENTATIONS = {'CPython': 'cp', 'PyPy': 'pp'}
+
+
+def wheelhouse_dir():
+    """Return the wheelhouse directory or None when it is disabled."""
+    path = CONFIG.get('wheelhouse_dir', '')
+    return os.path.abspath(path) if path else None
+
+
+def interpreter(python):
+    """
+    Return the implementation, version, ABI and platform of an interpreter.
+
+    Returns:
+      A dict or None when the interpreter could not be run
+
+    """
+    try:
+        out = runner.Popen([python, '-c', TAG_SCRIPT])
+    except OSError as err:
+        log.warn("Unable to run '{}': {}".format(python, err))
+        return None
+    if out[2] != 0 or not out[0]:
+        log.warn("Unable to read the ABI of '{}': {}".format(python, out[1]))
+        return None
+    try:
+        return json.loads(out[0].strip().splitlines()[-1])
+    except ValueError:
+        return None
+
+
+def requirements(path):
+    """Return the requirement lines of a requirements file."""
+    lines = []
+    with open(path) as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if line:
+                lines.append(line)
+    return lines
+
+
+def path_for(tag, requirement_lines):
+    """Return the wheelhouse directory of an interpreter and requirements."""
+    key = fingerprint.digest(tag, requirement_lines)
+    name = '{}{}{}-{}'.format(IMPLEMENTATIONS.get(tag['implementation'],
+                                                  tag['implementation']),
+                              tag['version'][0], tag['version'][1], key[:16])
+    return os.path.join(wheelhouse_dir(), name)
+
+
+def complete(path):
+    """Return True when path is a finished wheelhouse."""
+    return os.path.isfile(os.path.join(path, MARKER))
+
+
+def offline_args(path):
+    """Return the pip install arguments to only use the wheelhouse."""
+    if not path:
+        return []
+    return ['--no-index', '--find-links', path]
+
+
+def remove(path):
+    """Remove a wheelhouse, for example after an offline install failed."""
+    log.warn("Removing the wheelhouse '{}'".format(path))
+    shutil.rmtree(path, ignore_errors=True)
+
+
+def _wheel_cmd(python, sdist, downloads, wheels):
+    """Return the command that builds one source distribution."""
+    return [python, '-m', 'pip', 'wheel', '--no-deps', '--no-index',
+            '--find-links', downloads, '--find-links', wheels,
+            '--wheel-dir', wheels, sdist]
+
+
+def build_wheels(python, sdists, downloads, wheels, limit=None, env=None):
+    """
+    Build source distributions into wheels, independent ones in parallel.
+
+    Args:
+      env: the environment of the pip wheel commands
+
+    Returns:
+      The source distributions that could not be built
+
+    """
+    pending = sorted(sdists)
+    wave = 0
+    while pending:
+        wave += 1
+        log.info("Building {} wheels (wave {})...".format(len(pending), wave))
+        with trace.span('wheels', wave=wave, count=len(pending)):
+            results = runner.run_many([_wheel_cmd(python, sdist, downloads,
+                                                  wheels)
+                                       for sdist in pending], limit=limit,
+                                      env=env)
+        failed = [sdist for sdist, result in zip(pending, results)
+                  if not result.ok]
+        for sdist, result in zip(pending, results):
+            if result.ok:
+                log.detail("Built a wheel of '{}' in {:.1f}s".format(
+                           os.path.basename(sdist), result.elapsed))
+        if len(failed) == len(pending):
+            for sdist, result in zip(pending, results):
+                log.warn("Unable to build a wheel of '{}': {}".format(
+                         os.path.basename(sdist), result.error))
+            return failed
+        pending = failed
+    return []
+
+
+def build(python, requirements_file, path, limit=None):
+    """
+    Build the wheelhouse at path.
+
+    The wheels are built in a temporary directory next to path and only
+    renamed into place when every requirement has a wheel.
+
+    Returns:
+      True when the wheelhouse was built
+
+    """
+    parent = os.path.dirname(path)
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    staging = tempfile.mkdtemp(dir=parent, prefix='.tmp-')
+    downloads = os.path.join(staging, 'downloads')
+    try:
+        log.info("Downloading the requirements for the wheelhouse...")
+        cmd = [python, '-m', 'pip', 'download', '--dest', downloads,
+               'pip', 'setuptools', 'wheel', '-r', requirements_file]
+        with trace.span('wheel download'):
+            out = runner.stream(cmd, log_file=runner.step_log(
+                                'wheel download'))
+        if out[2] != 0:
+            log.warn("Unable to download the requirements: {}".format(
+                     out[1]))
+            return False
+        sdists = []
+        for download in glob.glob(os.path.join(downloads, '*')):
+            if download.endswith('.whl'):
+                os.rename(download, os.path.join(
+                          staging, os.path.basename(download)))
+            else:
+                sdists.append(download)
+        # setuptools finds bdist_wheel through the entry points of the
+        # unpacked wheel package
+        env = dict(os.environ)
+        tools = glob.glob(os.path.join(staging, 'wheel-*.whl'))
+        if tools:
+            tools_dir = os.path.join(downloads, '.tools')
+            with zipfile.ZipFile(tools[0]) as archive:
+                archive.extractall(tools_dir)
+            env['PYTHONPATH'] = os.pathsep.join(
+                [tools_dir] + filter(None, [env.get('PYTHONPATH')]))
+        if build_wheels(python, sdists, downloads, staging, limit, env):
+            return False
+        shutil.rmtree(downloads, ignore_errors=True)
+        wheels = sorted(os.path.basename(wheel) for wheel in
+                        glob.glob(os.path.join(staging, '*.whl')))
+        with open(os.path.join(staging, MARKER), 'w') as f:
+            json.dump({'interpreter': interpreter(python),
+                       'requirements': requirements(requirements_file),
+                       'wheels': wheels}, f, indent=2, sort_keys=True)
+        os.chmod(staging, 0o755)
+        try:
+            os.rename(staging, path)
+        except OSError:
+            # Another build of the same interpreter finished first
+            if not complete(path):
+                raise
+        log.info("Built a wheelhouse of {} wheels in '{}'".format(
+                 len(wheels), path))
+        return True
+    finally:
+        if os.path.isdir(staging):
+            shutil.rmtree(staging, ignore_errors=True)
+
+
+def prepare(python, requirements_file, limit=None):
+    """
+    Return the wheelhouse for an interpreter and requirements file.
+
+    The wheelhouse is built first when it does not exist yet.
+
+    Args:
+      python: path of the interpreter the requirements are installed into
+      requirements_file: the pip requirements file
+      limit: the most wheels built at once. Defaults to the make job count.
+
+    Returns:
+      The wheelhouse directory or None to install from the network
+
+    """
+    if wheelhouse_dir() is None:
+        return None
+    tag = interpreter(python)
+    if tag is None:
+        return None
+    path = path_for(tag, requirements(requirements_file))
+    if complete(path):
+        log.info("Using the wheelhouse '{}'".format(path))
+        return path
+    if limit is None:
+        limit = jobs.make_jobs()
+    with trace.span('wheelhouse'):
+        try:
+            built = build(python, requirements_file, path, limit)
+        except (IOError, OSError) as err:
+            log.warn("Unable to build the wheelhouse: {}".format(err))
+            built = False
+    if not built:
+        log.warn("Installing the requirements from the network instead")
+        return None
+    return path
+
+
+if __name__ == '__main__':
+    print 'This is a library of support tools'